@@ -21,6 +21,8 @@ parser_logger = logging.getLogger('TestManagerParser')
 
 import sublime
 from .texpl import *
+from .texpl.helpers import close_test_data
+from .texpl.test_frameworks.pytest_worker import stop_workers
 
 
 def plugin_loaded():
@@ -42,4 +44,7 @@ def plugin_loaded():
     setup_log_file(parser_logger, settings.get('parser_log_file'))
 
 def plugin_unloaded():
+    close_test_data()
+    stop_workers()
+
     logging.shutdown()
@@ -0,0 +1,105 @@
+# coding: utf-8
+"""
+Stop after the first failure ("max_failures") with tests running in parallel slots. Run outside of
+Sublime Text, from the root of the package:
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import time
+import types
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+
+# Load the plugin modules without the Sublime Text API, and without registering the commands
+# (texpl/__init__.py).
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for name, path in [('texpl', 'texpl'), ('texpl.test_frameworks', os.path.join('texpl', 'test_frameworks'))]:
+    package = types.ModuleType(name)
+    package.__path__ = [os.path.join(ROOT, path)]
+    sys.modules[name] = package
+
+sys.modules.setdefault('sublime', types.ModuleType('sublime'))
+
+from texpl import test_data  # noqa: E402
+from texpl.transport import ProcessBudget, get_workers  # noqa: E402
+from texpl.test_frameworks import scheduler  # noqa: E402
+
+SUITE_ID = 'suite'
+EXECUTABLE = 'tests'
+
+
+class MaxFailuresTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = test_data.TestData(self.directory.name)
+
+        self.run_ids = [f'S.t{i}' for i in range(8)]
+        tests = [test_data.DiscoveredTest(full_name=[EXECUTABLE, 'S', f't{i}'], suite_id=SUITE_ID, run_id=run_id,
+                                          report_id=run_id,
+                                          location=test_data.TestLocation(EXECUTABLE, 'test.cpp', i))
+                 for i, run_id in enumerate(self.run_ids)]
+        self.data.notify_discovered_tests(tests, datetime.now())
+        self.paths = [t.full_name for t in tests]
+
+    def tearDown(self):
+        self.data.close()
+        self.directory.cleanup()
+
+    def test_no_batch_after_first_failure(self):
+        self.data.notify_run_started(test_data.StartedRun(self.paths, max_failures=1))
+
+        # Slow database commits: the test events are applied long after they are reported.
+        commit = self.data.commit
+
+        def slow_commit(*args, **kwargs):
+            time.sleep(1.0)
+            commit(*args, **kwargs)
+
+        self.data.commit = slow_commit
+
+        suite = types.SimpleNamespace(suite_id=SUITE_ID, workers=get_workers([{'slots': 2}]), shards=len(self.run_ids),
+                                      test_timeout=None, process_timeout=None, test_ranks={}, test_durations={},
+                                      process_budget=ProcessBudget(), run_priority=0)
+        framework = types.SimpleNamespace(test_data=self.data, suite=suite,
+                                          get_batches=lambda executable, test_ids, transport: [test_ids])
+
+        mutex = threading.Lock()
+        batch_starts = []
+        failure_times = []
+
+        def run_tests(executable, test_ids, watchdog):
+            with mutex:
+                batch_starts.append((time.time(), test_ids))
+
+            test_list = watchdog.get_test_list()
+            for run_id in test_ids:
+                path = test_list.find_test_by_report_id(SUITE_ID, executable, run_id)
+                watchdog.notify_test_started(test_data.StartedTest(path))
+                time.sleep(0.05 if run_id == 'S.t1' else 0.3)
+
+                status = test_data.TestStatus.FAILED if run_id == 'S.t1' else test_data.TestStatus.PASSED
+                if status == test_data.TestStatus.FAILED:
+                    failure_times.append(time.time())
+
+                watchdog.notify_test_finished(test_data.FinishedTest(path, status))
+
+        scheduler.run_grouped_tests(framework, {EXECUTABLE: self.run_ids}, run_tests, queue='test')
+
+        self.data.commit = commit
+        self.data.notify_run_finished(test_data.FinishedRun(self.paths))
+
+        self.assertEqual(len(failure_times), 1)
+        self.assertEqual([ids for start, ids in batch_starts if start > failure_times[0]], [])
+        self.assertTrue(self.data.run_cancelled)
+        self.assertEqual(self.data.run_failures, 1)
+
+        test_list = self.data.get_test_list()
+        self.assertEqual(test_list.find_test(self.paths[1]).last_status, test_data.TestStatus.FAILED)
+
+
+if __name__ == '__main__':
+    unittest.main()
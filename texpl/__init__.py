@@ -14,7 +14,7 @@ from .list import (TestManagerListCommand, TestManagerRefreshAllCommand, TestMan
 from .output import (TestManagerOpenSelectedOutput, TestManagerOpenSingleOutput, TestManagerOpenRunOutput,
                      TestManagerOutputRefresh, TestManagerOutputRefreshAllCommand, TestManagerOutputEventListener)
 
-from .discover import (TestManagerDiscoverCommand, TestManagerResetCommand)
+from .discover import (TestManagerDiscoverCommand, TestManagerDiscoverSelectedCommand, TestManagerResetCommand)
 
 from .run import (TestManagerStartSelectedCommand, TestManagerStartCommand, TestManagerStopCommand)
 
@@ -22,6 +22,12 @@ from .suites import (TestManagerAddTestSuiteCommand)
 
 from .testmanager import (TestManagerVersionCommand)
 
+from .report import (TestManagerShowResourceUsageCommand)
+
+from .watch import (TestManagerStartWatchCommand, TestManagerStopWatchCommand)
+
+from .results import (TestManagerImportResultsCommand)
+
 # import test frameworks handlers
 
 from . import test_frameworks
@@ -3,14 +3,15 @@ import os
 import logging
 from datetime import datetime
 from functools import partial
-from typing import List
+from typing import Dict, List, Optional
 
 import sublime
-from sublime_plugin import WindowCommand
+from sublime_plugin import WindowCommand, TextCommand
 
 from .helpers import TestDataHelper
+from .list import TestManagerTextCmd
 from .test_suite import TestSuite
-from .test_data import DiscoveryError, TestData, clear_test_data
+from .test_data import DiscoveryError, DiscoveryScope, TestData, TestItem, clear_test_data, test_name_to_path
 from .errors import FrameworkError
 from .util import SettingsHelper
 
@@ -34,6 +35,99 @@ ALREADY_DISCOVERING = ("Test discovery is already running, please wait.")
 MAX_ERROR_LENGTH = 256
 
 
+class TestDiscoveryHelper:
+    def display_in_panel(self, content):
+        window = self.view.window() if hasattr(self, 'view') else self.window
+        panel_name = 'TestManager.discovery'
+        panel = window.create_output_panel(panel_name)
+        panel.run_command('test_manager_panel_write', {'content': content})
+        window.run_command('show_panel', {'panel': f'output.{panel_name}'})
+
+    def get_discovery_suites(self, data: TestData, project: str) -> Optional[List[TestSuite]]:
+        if data.is_running_tests():
+            sublime.error_message(CANNOT_DISCOVER_WHILE_RUNNING_DIALOG)
+            return None
+        if data.is_discovering_tests():
+            sublime.error_message(ALREADY_DISCOVERING)
+            return None
+
+        suites_json = self.get_setting('test_suites')
+        if not suites_json:
+            if not sublime.ok_cancel_dialog(NO_TEST_SUITE_CONFIGURED, 'Add suite'):
+                return None
+
+            window = self.view.window() if hasattr(self, 'view') else self.window
+            window.run_command('test_manager_add_test_suite')
+            return None
+
+        root_dir = os.path.dirname(project)
+        try:
+            return [TestSuite.from_json(data, root_dir, f) for f in suites_json]
+        except FrameworkError as e:
+            sublime.error_message(e.message)
+            return None
+
+    def discover_tests(self, data: TestData, suites: List[TestSuite],
+                       scopes: Optional[List[DiscoveryScope]] = None, interactive=True):
+        """
+        Run test discovery for all the suites, or only within the given scopes. If not
+        'interactive' (e.g., in watch mode), errors are logged and shown in the status bar
+        instead of a dialog. Returns True if the discovery succeeded.
+        """
+        start = datetime.now()
+        data.notify_discovery_started()
+        sublime.run_command('test_manager_refresh_all', {'data_location': data.location})
+
+        def report_error(message, details=None):
+            logger.error(message)
+            if interactive:
+                sublime.error_message(message)
+            else:
+                sublime.status_message(f'TestManager: {message}')
+
+            if details:
+                logger.error(details)
+                if interactive:
+                    self.display_in_panel(details)
+
+        # TODO: turn this into parallel jobs
+        try:
+            if scopes is None:
+                discovered_tests = [t for s in suites for t in s.discover()]
+            else:
+                discovered_tests = [t for scope in scopes for s in suites if s.suite_id == scope.suite_id
+                                    for t in s.discover(scope)]
+        except DiscoveryError as e:
+            report_error(str(e), '\n'.join(e.details) if e.details else None)
+            data.notify_discovery_ended()
+            return False
+        except Exception as e:
+            message = str(e)
+            if len(message) < MAX_ERROR_LENGTH:
+                report_error(message)
+            else:
+                report_error('Error running test discovery; see panel for more information.', message)
+            data.notify_discovery_ended()
+            return False
+
+        end = datetime.now()
+
+        logger.info(f'Discovered {len(discovered_tests)} tests in {end - start} seconds')
+
+        disc_id = 0
+        for t in discovered_tests:
+            t.discovery_id = disc_id
+            disc_id += 1
+
+        data.notify_discovered_tests(discovered_tests, discovery_time=start, scopes=scopes)
+        sublime.run_command('test_manager_refresh_all', {'data_location': data.location})
+
+        if len(discovered_tests) == 0 and scopes is None and interactive:
+            sublime.error_message(NO_TESTS_DISCOVERED)
+
+        return True
+
+
 class TestManagerResetCommand(WindowCommand, TestDataHelper):
 
     def is_visible(self):
@@ -58,7 +152,7 @@ class TestManagerResetCommand(WindowCommand, TestDataHelper):
             sublime.run_command('test_manager_refresh_all', {'data_location': data.location})
 
 
-class TestManagerDiscoverCommand(WindowCommand, TestDataHelper, SettingsHelper):
+class TestManagerDiscoverCommand(WindowCommand, TestDataHelper, TestDiscoveryHelper, SettingsHelper):
 
     def is_visible(self):
         return True
@@ -72,73 +166,53 @@ class TestManagerDiscoverCommand(WindowCommand, TestDataHelper, SettingsHelper):
         if not project:
             return
 
-        if data.is_running_tests():
-            sublime.error_message(CANNOT_DISCOVER_WHILE_RUNNING_DIALOG)
-            return
-        if data.is_discovering_tests():
-            sublime.error_message(ALREADY_DISCOVERING)
+        suites = self.get_discovery_suites(data, project)
+        if suites is None:
             return
 
-        suites_json = self.get_setting('test_suites')
-        if not suites_json:
-            if not sublime.ok_cancel_dialog(NO_TEST_SUITE_CONFIGURED, 'Add suite'):
-                return
-
-            self.window.run_command('test_manager_add_test_suite')
-            return
+        sublime.set_timeout_async(partial(self.discover_tests, data, suites))
 
-        root_dir = os.path.dirname(project)
-        try:
-            suites = [TestSuite.from_json(data, root_dir, f) for f in suites_json]
-        except FrameworkError as e:
-            sublime.error_message(e.message)
-            return
 
-        sublime.set_timeout_async(partial(self.discover_tests, data, suites))
+class TestManagerDiscoverSelectedCommand(TextCommand, TestDataHelper, TestDiscoveryHelper, TestManagerTextCmd):
+    """
+    Discover again the selected tests and folders of the test list, leaving the other tests
+    untouched. The scope of the discovery is decided by each framework (e.g., the executables or
+    files that contain the selected tests).
+    """
 
-    def display_in_panel(self, content):
-        panel_name = 'TestManager.discovery'
-        panel = self.window.create_output_panel(panel_name)
-        panel.run_command('test_manager_panel_write', {'content': content})
-        self.window.run_command('show_panel', {'panel': f'output.{panel_name}'})
+    def is_visible(self):
+        return False
 
-    def discover_tests(self, data: TestData, suites: List[TestSuite]):
-        start = datetime.now()
-        data.notify_discovery_started()
-        sublime.run_command('test_manager_refresh_all', {'data_location': data.location})
+    def run(self, edit):
+        data = self.get_test_data()
+        if not data:
+            return
 
-        # TODO: turn this into parallel jobs
-        try:
-            discovered_tests = [t for s in suites for t in s.discover()]
-        except DiscoveryError as e:
-            sublime.error_message(str(e))
-            logger.error(str(e))
-            logger.error(e.details)
-            if e.details:
-                self.display_in_panel('\n'.join(e.details))
+        project = self.get_project()
+        if not project:
             return
-        except Exception as e:
-            message = str(e)
-            logger.error(message)
-            if len(message) < MAX_ERROR_LENGTH:
-                sublime.error_message(message)
-            else:
-                sublime.error_message('Error running test discovery; see panel for more information.')
-                self.display_in_panel(message)
-            data.notify_discovery_ended()
+
+        suites = self.get_discovery_suites(data, project)
+        if suites is None:
             return
 
-        end = datetime.now()
+        test_list = data.get_test_list()
+        selected: Dict[str, List[TestItem]] = {}
 
-        logger.info(f'Discovered {len(discovered_tests)} tests in {end - start} seconds')
+        def add_test(item: TestItem):
+            if item.children is not None:
+                for child in item.children.values():
+                    add_test(child)
+            else:
+                selected.setdefault(item.suite_id, []).append(item)
 
-        disc_id = 0
-        for t in discovered_tests:
-            t.discovery_id = disc_id
-            disc_id += 1
+        for name in self.get_selected_tests() + self.get_selected_folders():
+            item = test_list.find_test(test_name_to_path(name))
+            if item is not None:
+                add_test(item)
 
-        data.notify_discovered_tests(discovered_tests, discovery_time=start)
-        sublime.run_command('test_manager_refresh_all', {'data_location': data.location})
+        scopes = [s.framework.get_scope(selected[s.suite_id]) for s in suites if s.suite_id in selected]
+        if len(scopes) == 0:
+            return
 
-        if len(discovered_tests) == 0:
-            sublime.error_message(NO_TESTS_DISCOVERED)
+        sublime.set_timeout_async(partial(self.discover_tests, data, suites, scopes))
@@ -0,0 +1,33 @@
+import os
+import hashlib
+
+# Read files by chunks of this size when hashing their content.
+HASH_CHUNK_SIZE = 1024*1024
+
+
+def get_stat_key(path: str) -> str:
+    """
+    Cheap fingerprint of a file, from its metadata. It changes whenever the file is rewritten or
+    replaced, but may also change when the content does not (e.g., the file was only touched).
+    """
+    stat = os.stat(path)
+    return f'{stat.st_size}:{stat.st_mtime_ns}:{stat.st_ino}'
+
+
+def get_data_hash(data: str) -> str:
+    """
+    Fingerprint of a string (e.g., settings serialized to JSON).
+    """
+    return hashlib.blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def get_content_hash(path: str) -> str:
+    """
+    Fingerprint of the content of a file. Slower than 'get_stat_key()', as the whole file is read.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
@@ -18,6 +18,13 @@ NO_TEST_DATAL_LOCATION_DIALOG = ("No configured location for storing test metada
 TEST_DATA_LOOKUP = {}
 
 
+def close_test_data():
+    for data in TEST_DATA_LOOKUP.values():
+        data.close()
+
+    TEST_DATA_LOOKUP.clear()
+
+
 class TestDataHelper(SettingsHelper):
     # Find project and data
     def get_project(self):
@@ -115,7 +122,9 @@ class TestDataHelper(SettingsHelper):
         self.set_project_setting('data_location', os.path.relpath(location, start=base))
 
         if init:
-            TestData(location).init()
+            data = TestData(location)
+            data.init()
+            data.close()
 
     def get_test_data(self, location=None, create=True) -> Optional[TestData]:
         if not location:
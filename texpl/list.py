@@ -49,7 +49,8 @@ STATUS_MARKER = {
     'skipped': '\u200b\ufeff',
     'passed':  '\u200c\u200b',
     'running': '\u200c\u200c',
-    'queued':  '\u200c\u200d'
+    'queued':  '\u200c\u200d',
+    'cached':  '\u200c\u2060'
 }
 
 DEFAULT_STATUS_SYMBOL = {
@@ -60,7 +61,8 @@ DEFAULT_STATUS_SYMBOL = {
     'skipped': '/',
     'passed':  '.',
     'running': '@',
-    'queued':  ':'
+    'queued':  ':',
+    'cached':  ','
 }
 
 STATUS_NAME = {
@@ -72,6 +74,7 @@ STATUS_NAME = {
     'passed':  'passed',
     'running': 'running',
     'queued':  'queued',
+    'cached':  'cached',
     'total':   'total'
 }
 
@@ -80,7 +83,7 @@ NO_TESTS_VISIBLE = "No test to show with the current filters."
 
 TEST_MANAGER_HELP = """
 # Running:
-#    d = run test discovery
+#    d = run test discovery, D = discover selected tests again
 #    s = run app/suite/case, S = run all tests
 #    k = stop tests
 #
@@ -181,7 +184,7 @@ class TestManagerListBuilder(TestDataHelper, SettingsHelper):
             for line in TEST_MANAGER_HELP.split('\n'):
                 add_line(line)
 
-            for status_id in ['not_run', 'stopped', 'queued', 'running', 'skipped', 'failed', 'crashed', 'passed']:
+            for status_id in ['not_run', 'stopped', 'queued', 'running', 'skipped', 'failed', 'crashed', 'passed', 'cached']:
                 add_line(f"#    [{STATUS_MARKER[status_id]}{self.status_symbol[status_id]}] = {STATUS_NAME[status_id]}")
 
         return status, structure
@@ -249,6 +252,8 @@ class TestManagerListBuilder(TestDataHelper, SettingsHelper):
     def item_display_status(self, item: TestItem) -> str:
         if item.run_status != RunStatus.NOT_RUNNING:
             return item.run_status.name.lower()
+        elif item.cached:
+            return 'cached'
         else:
             return item.last_status.name.lower()
 
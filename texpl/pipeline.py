@@ -0,0 +1,108 @@
+# coding: utf-8
+import logging
+import queue
+import threading
+import time
+import traceback
+from typing import Any, Callable
+
+logger = logging.getLogger('TestManager.pipeline')
+
+PIPELINE_QUEUE_SIZE = 1024
+
+
+class StageStats:
+    """
+    Throughput counters for a single pipeline stage. 'busy_time' is the time spent processing
+    items, 'blocked_time' is the time producers spent waiting because the stage's queue was full
+    (i.e., backpressure applied by this stage).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.mutex = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.mutex:
+            self.start_time = time.time()
+            self.items = 0
+            self.busy_time = 0.0
+            self.blocked_time = 0.0
+
+    def add_processed(self, count: int, duration: float):
+        with self.mutex:
+            self.items += count
+            self.busy_time += duration
+
+    def add_blocked(self, duration: float):
+        with self.mutex:
+            self.blocked_time += duration
+
+    def report(self) -> str:
+        with self.mutex:
+            elapsed = max(time.time() - self.start_time, 1e-6)
+            rate = self.items / self.busy_time if self.busy_time > 0 else 0.0
+            return (f'{self.name}: {self.items} items in {elapsed:.2f}s, '
+                    f'busy {self.busy_time:.2f}s ({100*self.busy_time/elapsed:.0f}%, {rate:.0f} items/s), '
+                    f'producers blocked {self.blocked_time:.2f}s')
+
+
+class PipelineStage:
+    """
+    A processing stage running on its own thread, fed through a bounded queue.
+    Items are passed to 'handler' in the order they were queued. Exceptions raised by the
+    handler are logged and do not stop the stage.
+    """
+
+    STOP = object()
+
+    def __init__(self, name: str, handler: Callable[[Any], None], max_size=PIPELINE_QUEUE_SIZE):
+        self.name = name
+        self.handler = handler
+        self.queue = queue.Queue(max_size)
+        self.stats = StageStats(name)
+        self.thread = threading.Thread(target=self.process, name=f'TestManager.{name}', daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            start = time.time()
+            self.queue.put(item)
+            self.stats.add_blocked(time.time() - start)
+
+    def process(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is PipelineStage.STOP:
+                    return
+
+                start = time.time()
+                try:
+                    self.handler(item)
+                except Exception as e:
+                    logger.error("[%s] error in pipeline stage: %s\n%s", self.name, e, traceback.format_exc())
+
+                self.stats.add_processed(1, time.time() - start)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """
+        Wait until all the items queued so far have been processed.
+        """
+        if threading.current_thread() is self.thread:
+            # Called from the handler itself; waiting would deadlock.
+            return
+
+        self.queue.join()
+
+    def close(self):
+        """
+        Process all the remaining items, then stop the stage thread.
+        """
+        self.put(PipelineStage.STOP)
+        self.thread.join()
@@ -1,15 +1,21 @@
 # coding: utf-8
 import sublime
 import os
+import signal
 import subprocess
 import sys
+import time
 import logging
 import threading
 import queue
 from functools import partial
 import sys
 import traceback
-from typing import Callable, List
+from typing import Callable, List, Optional
+
+from .pipeline import PipelineStage, StageStats
+from .test_data import ResourceUsage
+from .transport import Transport
 
 
 def get_thread_stack(thread):
@@ -30,6 +36,22 @@ DECODING_ERROR = ("Could not decode output from {bin}. The following encodings "
 
 process_ERROR = ("process '{bin}' was not found.")
 
+# Time given to a stopped process to exit after SIGTERM, before it is sent SIGKILL.
+STOP_GRACE_PERIOD = 2.0  # seconds
+# Time given to the output reader to reach EOF after the process group was killed.
+STOP_READER_TIMEOUT = 1.0  # seconds
+# Maximum size of the output read at once, in chunked mode (see 'run()').
+OUTPUT_CHUNK_SIZE = 64*1024
+# Environment variable giving the child process the file descriptor of the event pipe (see 'run()').
+EVENTS_FD_VARIABLE = 'SUBLIME_TEST_EVENTS_FD'
+
+
+def has_event_pipe():
+    """
+    Whether child processes can be given an event pipe (POSIX only).
+    """
+    return sys.platform != 'win32'
+
 
 class JobError(Exception):
     pass
@@ -138,6 +160,149 @@ def decode(stream, encoding, fallback_encoding=[]):
         raise
 
 
+def get_process_group_options():
+    # Start the process in its own session / process group, so that it can be stopped
+    # along with all its descendants.
+    if os.name == 'posix':
+        return {'start_new_session': True}
+    elif hasattr(subprocess, 'CREATE_NEW_PROCESS_GROUP'):
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        return {}
+
+
+def terminate_process_group(proc: subprocess.Popen):
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid, signal.SIGTERM)
+        else:
+            proc.terminate()
+    except OSError:
+        pass
+
+
+def kill_process_group(proc: subprocess.Popen):
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            subprocess.call(['taskkill', '/F', '/T', '/PID', str(proc.pid)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+    except OSError:
+        pass
+
+    try:
+        proc.kill()
+    except OSError:
+        pass
+
+
+def poll_process(proc: subprocess.Popen, usage: Optional[ResourceUsage] = None):
+    """
+    Same as proc.poll(), but also collects the resource usage of the process when it is reaped
+    (POSIX only; elsewhere only the wall time is recorded by the caller).
+    """
+    if proc.returncode is not None or usage is None or not hasattr(os, 'wait4'):
+        return proc.poll()
+
+    try:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+    except ChildProcessError:
+        # Already reaped elsewhere.
+        return proc.poll()
+
+    if pid == 0:
+        return None
+
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+
+    usage.user_time += rusage.ru_utime
+    usage.system_time += rusage.ru_stime
+    # ru_maxrss is in kilobytes on Linux, and in bytes on macOS.
+    max_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+    usage.max_rss = max(usage.max_rss, max_rss)
+
+    return proc.returncode
+
+
+def wait_process(proc: subprocess.Popen, timeout: float, usage: Optional[ResourceUsage] = None):
+    deadline = time.time() + timeout
+    while poll_process(proc, usage) is None and time.time() < deadline:
+        time.sleep(0.01)
+
+    return proc.returncode
+
+
+def read_chunks(stream):
+    """
+    Yield the output as soon as it is available, in chunks of whole lines.
+    """
+    remainder = b''
+    while True:
+        chunk = stream.read1(OUTPUT_CHUNK_SIZE)
+        if not chunk:
+            break
+
+        chunk = remainder + chunk
+        end = chunk.rfind(b'\n') + 1
+        remainder = chunk[end:]
+        if end > 0:
+            yield chunk[:end]
+
+    if remainder:
+        yield remainder
+
+
+def split_lines(output: str) -> List[str]:
+    """
+    Split a chunk of output into lines, keeping the line jumps. Unlike 'str.splitlines()', only
+    splits on '\\n', as when reading line by line.
+    """
+    lines = [line + '\n' for line in output.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    if len(lines[-1]) == 0:
+        lines.pop()
+
+    return lines
+
+
+class ReaderState:
+    """
+    What the thread reading the output of a process is doing. 'reading_since' is the time it
+    started waiting on the output pipe, or None while it hands over output to the parser
+    (which may block, when the parser stage is full).
+    """
+
+    def __init__(self):
+        self.reading_since: Optional[float] = time.time()
+
+    def is_blocked_on_pipe(self, timeout: float):
+        since = self.reading_since
+        return since is not None and time.time() - since >= timeout
+
+
+def stop_process_group(proc: subprocess.Popen, reader_thread: threading.Thread,
+                       usage: Optional[ResourceUsage] = None):
+    """
+    Stop the process and its descendants: SIGTERM to the whole group, then SIGKILL to
+    whatever is left (or still holds the output pipe) after the grace period.
+    """
+    deadline = time.time() + STOP_GRACE_PERIOD
+    terminate_process_group(proc)
+
+    wait_process(proc, STOP_GRACE_PERIOD, usage)
+
+    reader_thread.join(max(0.0, deadline - time.time()))
+
+    if poll_process(proc, usage) is None or reader_thread.is_alive():
+        kill_process_group(proc)
+        wait_process(proc, STOP_READER_TIMEOUT, usage)
+
+
 def worker_run(job: Callable, queue: WorkQueue, task_id=None, timeout=None):
     if not task_id:
         task_id = queue.next_task_id()
@@ -167,9 +332,21 @@ def worker_run(job: Callable, queue: WorkQueue, task_id=None, timeout=None):
 
 
 def run(command: List[str], queue='default', stdin=None, cwd=None, env={}, stream_reader=None,
-        stop_token=None, ignore_errors=False, encoding='utf-8', fallback_encoding=[]):
+        stop_token=None, ignore_errors=False, encoding='utf-8', fallback_encoding=[],
+        usage: Optional[ResourceUsage] = None, transport: Optional[Transport] = None, chunked=False,
+        event_reader: Optional[Callable[[str], None]] = None):
+    """
+    Run a command on a work queue. If 'stream_reader' is given, it is called with each line of
+    output as it comes; if 'chunked', it is called with larger chunks of whole lines instead.
+    If 'event_reader' is also given, the process gets a pipe to send structured events separately
+    from its output: the pipe's file descriptor is given in EVENTS_FD_VARIABLE, and 'event_reader'
+    is called with chunks of the lines written to it (see 'has_event_pipe()').
+    """
     queue = get_queue(queue)
 
+    if transport is not None:
+        command, cwd, env = transport.wrap(command, cwd, env)
+
     environment = os.environ.copy()
     environment.update(env)
     task_id = queue.next_task_id()
@@ -177,7 +354,7 @@ def run(command: List[str], queue='default', stdin=None, cwd=None, env={}, strea
     logger.debug("[%s,%s] cmd: %s", threading.get_ident(), task_id, command)
 
     def job(command, queue, stdin, cwd, environment, stream_reader,
-            ignore_errors, encoding, fallback_encoding, task_id):
+            ignore_errors, encoding, fallback_encoding, task_id, usage):
         try:
             if stdin and hasattr(stdin, 'encode'):
                 stdin = stdin.encode(encoding)
@@ -189,44 +366,147 @@ def run(command: List[str], queue='default', stdin=None, cwd=None, env={}, strea
                 startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
                 startupinfo.wShowWindow = subprocess.SW_HIDE
 
-            with subprocess.Popen(command,
-                                  stdin=subprocess.PIPE,
-                                  stdout=subprocess.PIPE,
-                                  stderr=subprocess.STDOUT,
-                                  startupinfo=startupinfo,
-                                  cwd=cwd,
-                                  env=environment) as proc:
+            events = None
+            pass_fds: List[int] = []
+            if stream_reader is not None and event_reader is not None:
+                events, events_writer = os.pipe()
+                environment = dict(environment)
+                environment[EVENTS_FD_VARIABLE] = str(events_writer)
+                pass_fds = [events_writer]
+
+            start = time.time()
+            try:
+                proc = subprocess.Popen(command,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        startupinfo=startupinfo,
+                                        cwd=cwd,
+                                        env=environment,
+                                        pass_fds=pass_fds,
+                                        **get_process_group_options())
+            except:
+                if events is not None:
+                    os.close(events)
+                raise
+            finally:
+                # Only the child keeps the write end open, so the reader gets EOF when it exits.
+                for fd in pass_fds:
+                    os.close(fd)
+
+            with proc:
                 if stream_reader is not None:
-                    def read_stdout(proc, stream_reader, encoding, fallback_encoding, queue, task_id):
+                    # The reader thread only decodes lines; parsing happens on a separate stage, so a
+                    # slow parser (or a slow TestData update) does not stall the child process.
+                    reader_stats = StageStats(f'reader[{task_id}]')
+                    if events is None:
+                        parser_stage = PipelineStage(f'parser[{task_id}]', stream_reader)
+                    else:
+                        # Output and events are handled in the order they come, on the same stage.
+                        parser_stage = PipelineStage(f'parser[{task_id}]', lambda item: item[0](item[1]))
+
+                    def put_output(line):
+                        parser_stage.put(line if events is None else (stream_reader, line))
+
+                    def read_events(events, parser_stage):
+                        try:
+                            with open(events, 'rb') as f:
+                                for chunk in read_chunks(f):
+                                    parser_stage.put((event_reader, chunk.decode('utf-8')))
+                        except:
+                            pass
+
+                    events_thread = None
+                    if events is not None:
+                        events_thread = threading.Thread(target=partial(read_events, events, parser_stage),
+                                                         daemon=True)
+                        events_thread.start()
+
+                    def read_stdout(proc, parser_stage, reader_stats, reader_state, encoding, fallback_encoding,
+                                    queue, task_id):
                         try:
-                            for line in proc.stdout:
+                            lines = iter(read_chunks(proc.stdout) if chunked else proc.stdout)
+                            while True:
+                                reader_state.reading_since = time.time()
+                                line = next(lines, None)
+                                reader_state.reading_since = None
+                                if line is None:
+                                    break
+
+                                start = time.time()
                                 try:
-                                    stream_reader(decode(line, encoding, fallback_encoding))
+                                    line = decode(line, encoding, fallback_encoding)
                                 except Exception as e:
                                     logger.error("[%s,%s,%s] error in stream reader: %s\n%s", queue.name,
                                                  threading.get_ident(), task_id, e, traceback.format_exc())
+                                    continue
+
+                                reader_stats.add_processed(1, time.time() - start)
+                                put_output(line)
                         except:
                             pass
 
                     # Process in a thread
+                    reader_state = ReaderState()
                     process_thread = threading.Thread(target=partial(
-                        read_stdout, proc, stream_reader, encoding, fallback_encoding, queue, task_id))
+                        read_stdout, proc, parser_stage, reader_stats, reader_state, encoding, fallback_encoding,
+                        queue, task_id), daemon=True)
                     process_thread.start()
 
                     # Wait for process to finish
                     assert stop_token is not None
-                    while not stop_token.wait(0.1) and proc.poll() is None:
+                    while not stop_token.wait(0.1) and poll_process(proc, usage) is None:
                         pass
 
+                    exited = time.time()
+                    killed = None
                     if stop_token.is_set():
-                        try:
-                            proc.kill()
-                        except:
-                            pass
-
-                    process_thread.join()
-
-                    return (proc.poll(), None, None)
+                        stop_process_group(proc, process_thread, usage)
+                        killed = time.time()
+
+                    # Wait for the reader to reach EOF. While it hands over output to the parser, it is
+                    # only held back by a busy parser or state stage: keep waiting. If it still waits on
+                    # the pipe a grace period after the process exited, orphaned descendants are holding
+                    # the pipe open.
+                    while process_thread.is_alive():
+                        if (killed is None and time.time() - exited >= STOP_GRACE_PERIOD and
+                                reader_state.reading_since is not None):
+                            kill_process_group(proc)
+                            killed = time.time()
+                        elif (killed is not None and time.time() - killed >= STOP_READER_TIMEOUT and
+                                reader_state.is_blocked_on_pipe(STOP_READER_TIMEOUT)):
+                            logger.warning("[%s,%s,%s] output pipe still open after killing the process group; "
+                                           "giving up on remaining output", queue.name, threading.get_ident(),
+                                           task_id)
+                            # Closing the pipe would block until the reader thread returns. The output
+                            # read so far is already queued on the parser stage.
+                            proc.stdout = None
+                            break
+
+                        process_thread.join(0.1)
+
+                    if events_thread is not None:
+                        events_thread.join(STOP_READER_TIMEOUT)
+                        if events_thread.is_alive():
+                            logger.warning("[%s,%s,%s] event pipe still open after the process exited; "
+                                           "giving up on remaining events", queue.name, threading.get_ident(),
+                                           task_id)
+
+                    parser_stage.close()
+
+                    logger.info("[%s,%s,%s] %s", queue.name, threading.get_ident(), task_id, reader_stats.report())
+                    logger.info("[%s,%s,%s] %s", queue.name, threading.get_ident(), task_id,
+                                parser_stage.stats.report())
+
+                    return_code = poll_process(proc, usage)
+                    if usage is not None:
+                        usage.wall_time += time.time() - start
+                        usage.processes += 1
+                        logger.info("[%s,%s,%s] usage: %.2fs wall, %.2fs user, %.2fs system, %d kB peak RSS",
+                                    queue.name, threading.get_ident(), task_id, usage.wall_time,
+                                    usage.user_time, usage.system_time, usage.max_rss // 1024)
+
+                    return (return_code, None, None)
                 else:
                     stdout, stderr = proc.communicate(stdin)
                     stdout = decode(stdout, encoding, fallback_encoding)
@@ -248,7 +528,7 @@ def run(command: List[str], queue='default', stdin=None, cwd=None, env={}, strea
             return JobError("[%s,%s,%s] Could not execute command: %s" % (threading.get_ident(), task_id, command))
 
     return worker_run(partial(job, command, queue, stdin, cwd, environment, stream_reader,
-                              ignore_errors, encoding, fallback_encoding, task_id), queue, task_id=task_id)
+                              ignore_errors, encoding, fallback_encoding, task_id, usage), queue, task_id=task_id)
 
 
 def get_output(command: List[str], ignore_errors=False, success_codes=[0], *args, **kwargs):
@@ -269,12 +549,15 @@ def get_output_streamed(command: List[str], stream_reader, stop_token=None,
     if stop_token is None:
         stop_token = threading.Event()
 
+    usage = ResourceUsage(executable=command[0])
     error_code, _, _ = run(command, *args, stream_reader=stream_reader,
-                           stop_token=stop_token, ignore_errors=ignore_errors, **kwargs)
+                           stop_token=stop_token, ignore_errors=ignore_errors, usage=usage, **kwargs)
     if not ignore_errors and error_code not in success_codes:
         command_str = ' '.join(command)
         raise JobError(f'Error when executing command "{command_str}" (exit code {error_code}).')
 
+    return usage
+
 
 def get_error(bin):
     return process_ERROR.format(bin=bin)
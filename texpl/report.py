@@ -0,0 +1,51 @@
+# coding: utf-8
+import logging
+
+from sublime_plugin import WindowCommand
+
+from .helpers import TestDataHelper
+from .util import readable_date_delta
+
+logger = logging.getLogger('TestManager.report')
+
+NO_USAGE_RECORDED = "No resource usage recorded yet; run some tests first."
+
+
+def format_size(size: int) -> str:
+    for unit in ['B', 'kB', 'MB']:
+        if size < 1024:
+            return f'{size:.0f} {unit}'
+        size /= 1024
+
+    return f'{size:.1f} GB'
+
+
+class TestManagerShowResourceUsageCommand(WindowCommand, TestDataHelper):
+    """
+    Show the wall time, CPU time, and peak memory of the test processes launched in the last
+    run of each executable, most expensive first.
+    """
+
+    def run(self):
+        data = self.get_test_data()
+        if not data:
+            return
+
+        usages = sorted(data.get_resource_usage(), key=lambda u: u.user_time + u.system_time, reverse=True)
+
+        if len(usages) == 0:
+            content = NO_USAGE_RECORDED
+        else:
+            header = ['suite', 'executable', 'processes', 'wall', 'user', 'system', 'peak RSS', 'last run']
+            rows = [[u.suite_id, u.executable, str(u.processes),
+                     f'{u.wall_time:.2f}s', f'{u.user_time:.2f}s', f'{u.system_time:.2f}s',
+                     format_size(u.max_rss), readable_date_delta(u.last_run) if u.last_run else '--'] for u in usages]
+
+            widths = [max(len(r[i]) for r in [header] + rows) for i in range(len(header))]
+            content = '\n'.join('  '.join(c.ljust(w) for c, w in zip(r, widths)).rstrip()
+                                for r in [header] + rows)
+
+        panel_name = 'TestManager.usage'
+        panel = self.window.create_output_panel(panel_name)
+        panel.run_command('test_manager_panel_write', {'content': content})
+        self.window.run_command('show_panel', {'panel': f'output.{panel_name}'})
@@ -0,0 +1,257 @@
+# coding: utf-8
+import os
+import json
+import logging
+import traceback
+from datetime import datetime
+from functools import partial
+from xml.etree import ElementTree
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import sublime
+from sublime_plugin import WindowCommand
+
+from .helpers import TestDataHelper
+from .test_data import (TestData, TestStatus, StartedRun, FinishedRun, StartedTest, TestOutput, FinishedTest,
+                        TestEvent, test_name_to_path)
+from .test_frameworks.common import make_header
+from .test_frameworks.junit import JUnitTestCase, read_report as read_junit_report
+from . import process
+
+logger = logging.getLogger('TestManager.results')
+
+CANNOT_IMPORT_WHILE_RUNNING_DIALOG = ("Tests are currently running; please wait or stop the tests "
+                                      "before importing test results.")
+
+# Number of imported results sent to the TestData at once.
+IMPORT_EVENT_BATCH_SIZE = 1000
+
+
+def read_catch2_report(path: str) -> Iterator[JUnitTestCase]:
+    """
+    Read the test cases of a Catch2 XML report ('--reporter xml'), one at a time.
+    """
+    parents: List[ElementTree.Element] = []
+    for event, element in ElementTree.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+
+        parents.pop()
+        if element.tag != 'TestCase':
+            continue
+
+        status = TestStatus.FAILED
+        duration = None
+        output = []
+        for child in element.iter():
+            if child.tag == 'Expression' and child.attrib.get('success', 'true') == 'false':
+                original = (child.findtext('Original') or '').strip()
+                expanded = (child.findtext('Expanded') or '').strip()
+                output.append(f"FAILED\n  at {child.attrib.get('filename', '')}:{child.attrib.get('line', '')}\n"
+                              f"Expected: {child.attrib.get('type', '')}({original})\n"
+                              f"Actual:   {expanded}\n")
+            elif child.tag in ['Exception', 'FatalErrorCondition']:
+                result = 'EXCEPTION' if child.tag == 'Exception' else 'CRASH'
+                output.append(f"{result}\n{(child.text or '').strip()}\n")
+            elif child.tag in ['StdOut', 'StdErr'] and (child.text or '').strip():
+                output.append(f'{make_header(child.tag.upper())}\n{child.text.strip()}\n')
+            elif child.tag == 'OverallResult':
+                status = TestStatus.PASSED if child.attrib.get('success', '') == 'true' else TestStatus.FAILED
+                if child.attrib.get('skips', '0') != '0':
+                    status = TestStatus.SKIPPED
+                if 'durationInSeconds' in child.attrib:
+                    duration = float(child.attrib['durationInSeconds'])
+
+        yield JUnitTestCase(classname='', name=element.attrib.get('name', ''),
+                            file=element.attrib.get('filename', ''), line=int(element.attrib.get('line', 0)),
+                            duration=duration, status=status, output='\n'.join(output))
+
+        if len(parents) > 0:
+            parents[-1].remove(element)
+
+
+def read_gtest_report(path: str) -> Iterator[JUnitTestCase]:
+    """
+    Read the test cases of a GoogleTest JSON report ('--gtest_output=json').
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    for suite in data.get('testsuites', []):
+        for test in suite.get('testsuite', []):
+            failures = [f.get('failure', '') for f in test.get('failures', [])]
+            if test.get('result', '') == 'SKIPPED' or test.get('status', 'RUN') == 'NOTRUN':
+                status = TestStatus.SKIPPED
+            elif len(failures) > 0:
+                status = TestStatus.FAILED
+            else:
+                status = TestStatus.PASSED
+
+            try:
+                duration = float(test.get('time', '').rstrip('s'))
+            except ValueError:
+                duration = None
+
+            yield JUnitTestCase(classname=suite.get('name', ''), name=test.get('name', ''),
+                                file=test.get('file', ''), line=test.get('line', 0),
+                                duration=duration, status=status, output='\n'.join(failures))
+
+
+def get_report_reader(path: str):
+    if path.endswith('.json'):
+        return read_gtest_report
+
+    if not path.endswith('.xml'):
+        return None
+
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        head = f.read(4096)
+
+    return read_catch2_report if '<Catch2TestRun' in head else read_junit_report
+
+
+def read_results(directory: str) -> Iterator[Tuple[str, JUnitTestCase]]:
+    """
+    Read the test results of all the JUnit XML, GoogleTest JSON, and Catch2 XML reports found in
+    a directory (recursively), with the path of the report they come from.
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            try:
+                reader = get_report_reader(path)
+                if reader is None:
+                    continue
+
+                for testcase in reader(path):
+                    yield path, testcase
+            except (OSError, ValueError, KeyError, AttributeError, ElementTree.ParseError) as e:
+                logger.warning(f'could not read test results from {path}: {e}')
+
+
+def get_commit(directory: str) -> Optional[str]:
+    try:
+        return process.get_output(['git', 'rev-parse', 'HEAD'], cwd=directory).strip()
+    except Exception:
+        return None
+
+
+def get_report_owner(path: str, owners: List[Tuple[str, str]]) -> Optional[Tuple[str, str]]:
+    """
+    The (suite ID, executable) a result from the report at 'path' belongs to, among those with a
+    test of the same report ID. If there are several, the report must be named after the
+    executable (e.g., 'foo_test.xml' for 'bin/foo_test'); otherwise the result is ambiguous.
+    """
+    if len(owners) == 1:
+        return owners[0]
+
+    def strip(name: str):
+        return os.path.splitext(os.path.basename(name))[0]
+
+    matches = [o for o in owners if strip(o[1]) == strip(path)]
+    return matches[0] if len(matches) == 1 else None
+
+
+def import_results(data: TestData, directory: str, commit: Optional[str]) -> Tuple[int, int]:
+    """
+    Record the results found in 'directory' for the tests with a matching report ID, as if
+    they had been run. Returns the number of imported and unknown results; results matching
+    tests in several suites or executables are counted as unknown (see 'get_report_owner()').
+    """
+    test_list = data.get_test_list()
+    # Tests by report ID, then by suite and executable (the same ID may be used in several).
+    tests: Dict[str, Dict[Tuple[str, str], List[List[str]]]] = {}
+    for item in test_list.tests():
+        executable = item.location.executable if item.location is not None else ''
+        tests.setdefault(item.report_id, {}).setdefault((item.suite_id, executable), []).append(
+            test_name_to_path(item.full_name))
+
+    results: Dict[Tuple[str, Tuple[str, str]], Tuple[str, JUnitTestCase]] = {}
+    unknown = 0
+    for path, testcase in read_results(directory):
+        # Reports may not qualify names the same way the test frameworks do.
+        report_id = next((i for i in [testcase.get_report_id(), f'{testcase.classname}::{testcase.name}',
+                                      testcase.name] if i in tests), None)
+        if report_id is None:
+            unknown += 1
+            continue
+
+        owner = get_report_owner(path, list(tests[report_id].keys()))
+        if owner is None:
+            logger.debug(f'{report_id} from {path} matches tests in several suites or executables')
+            unknown += 1
+            continue
+
+        results[(report_id, owner)] = (path, testcase)
+
+    test_paths = [p for report_id, owner in results for p in tests[report_id][owner]]
+    if len(test_paths) == 0:
+        return 0, unknown
+
+    commit_info = f' (commit {commit})' if commit else ''
+
+    data.notify_run_started(StartedRun(test_paths))
+    try:
+        events: List[TestEvent] = []
+        for (report_id, owner), (path, testcase) in results.items():
+            end_time = datetime.fromtimestamp(os.path.getmtime(path))
+            for test in tests[report_id][owner]:
+                events.append(StartedTest(test, start_time=end_time))
+                events.append(TestOutput(test, f'Imported from {path}{commit_info}\n\n{testcase.output}'))
+                events.append(FinishedTest(test, testcase.status, duration=testcase.duration, end_time=end_time))
+
+            if len(events) >= 3*IMPORT_EVENT_BATCH_SIZE:
+                data.notify_test_events(events)
+                events = []
+
+        data.notify_test_events(events)
+    finally:
+        data.notify_run_finished(FinishedRun(test_paths))
+
+    return len(test_paths), unknown
+
+
+class TestManagerImportResultsCommand(WindowCommand, TestDataHelper):
+    """
+    Import test results produced elsewhere (e.g., by CI on the same commit), instead of running
+    the tests locally.
+    """
+
+    def run(self, directory=None, commit=None):
+        project = self.get_project()
+        if not project:
+            return
+
+        data = self.get_test_data()
+        if not data:
+            return
+
+        if data.is_running_tests():
+            sublime.error_message(CANNOT_IMPORT_WHILE_RUNNING_DIALOG)
+            return
+
+        if directory is None:
+            self.window.show_input_panel('Directory with test results:', os.path.dirname(project),
+                                         partial(self.start_import, data, project, commit), None, None)
+        else:
+            self.start_import(data, project, commit, directory)
+
+    def start_import(self, data: TestData, project: str, commit: Optional[str], directory: str):
+        root_dir = os.path.dirname(project)
+        directory = os.path.join(root_dir, os.path.expanduser(directory))
+        sublime.set_timeout_async(partial(self.import_results, data, root_dir, commit, directory))
+
+    def import_results(self, data: TestData, root_dir: str, commit: Optional[str], directory: str):
+        try:
+            if commit is None:
+                commit = get_commit(root_dir)
+
+            imported, unknown = import_results(data, directory, commit)
+            logger.info(f'imported {imported} test results from {directory}; {unknown} unknown tests')
+            sublime.status_message(f'TestManager: imported {imported} test results ({unknown} unknown tests)')
+        except Exception as e:
+            logger.error("error when importing test results: %s\n%s", e, traceback.format_exc())
+        finally:
+            sublime.run_command('test_manager_refresh_all', {'data_location': data.location})
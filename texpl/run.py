@@ -2,7 +2,8 @@
 import time
 import logging
 import os
-from typing import List
+import threading
+from typing import Dict, List, Optional
 from functools import partial
 import traceback
 
@@ -14,7 +15,9 @@ from .list import TestManagerTextCmd
 from .test_suite import TestSuite
 from .discover import NO_TEST_SUITE_CONFIGURED
 from .util import SettingsHelper
-from .test_data import TestData, TestList, TestItem, StartedRun, FinishedRun, test_name_to_path, ROOT_NAME
+from .transport import ProcessBudget
+from .test_data import (TestData, TestList, TestItem, TestStatus, StartedRun, FinishedRun,
+                        test_name_to_path, ROOT_NAME)
 
 logger = logging.getLogger('TestManager.runner')
 
@@ -23,6 +26,35 @@ TEST_STOP_CONFIRM_DIALOG = ("You are about to stop all currently-running tests.
 CANNOT_START_WHILE_RUNNING_DIALOG = ("Tests are currently running; please wait or stop the tests "
                                      "before running new tests.")
 
+RUN_ORDER_DEFAULT = 'default'
+RUN_ORDER_FAILED_FIRST = 'failed_first'
+
+
+def get_run_priority(item: TestItem, root_dir: str, mtimes: Dict[str, Optional[float]]):
+    """
+    Sort key for the 'failed_first' run order: tests that failed or crashed in their last run
+    come first, then tests whose source file changed since their last run (most recent change
+    first), then all the other tests.
+    """
+    if item.last_status in [TestStatus.FAILED, TestStatus.CRASHED]:
+        return (0, 0.0)
+
+    if item.location is None or not item.location.file:
+        return (2, 0.0)
+
+    file = os.path.join(root_dir, item.location.file)
+    if file not in mtimes:
+        try:
+            mtimes[file] = os.path.getmtime(file)
+        except OSError:
+            mtimes[file] = None
+
+    mtime = mtimes[file]
+    if mtime is not None and (item.last_run is None or mtime > item.last_run.timestamp()):
+        return (1, -mtime)
+
+    return (2, 0.0)
+
 
 class TestRunHelper(SettingsHelper):
     def get_test_suites(self, data: TestData, project: str):
@@ -45,12 +77,17 @@ class TestRunHelper(SettingsHelper):
 
         sublime.set_timeout(self.refresh_loop, self.refresh_interval)
 
-    def run_tests(self, data: TestData, test_list: TestList, suites: List[TestSuite], tests: List[str]):
+    def run_tests(self, data: TestData, test_list: TestList, suites: List[TestSuite], tests: List[str],
+                  max_failures: Optional[int] = None):
         try:
             settings = self.get_settings()
             self.refresh_interval = settings.get('list_refresh_interval', 0.1) * 1000
+            run_order = settings.get('run_order', RUN_ORDER_DEFAULT)
+            if max_failures is None:
+                max_failures = settings.get('max_failures', 0)
             test_ids = {}
             test_paths = []
+            selected = []
 
             def add_test(path: List[str], item: TestItem):
                 path = path + [item.name] if item.name != ROOT_NAME or len(path) > 0 else path
@@ -60,8 +97,7 @@ class TestRunHelper(SettingsHelper):
                 else:
                     assert item.location is not None
                     test_paths.append(path)
-                    test_ids.setdefault(item.suite_id, {}).setdefault(
-                        item.location.executable, []).append(item.run_id)
+                    selected.append(item)
 
             for test in tests:
                 logger.debug(f'running {test}...')
@@ -73,10 +109,31 @@ class TestRunHelper(SettingsHelper):
 
                 add_test(path[:-1], item)
 
+            if run_order == RUN_ORDER_FAILED_FIRST:
+                root_dir = os.path.dirname(self.get_project())
+                mtimes = {}
+                selected.sort(key=lambda item: get_run_priority(item, root_dir, mtimes))
+            elif run_order != RUN_ORDER_DEFAULT:
+                logger.warning(f'unknown run order "{run_order}"; using default')
+                run_order = RUN_ORDER_DEFAULT
+
+            # Suites and executables are run in order of their first selected test.
+            test_ranks = {}
+            test_durations = {}
+            for rank, item in enumerate(selected):
+                assert item.location is not None
+                key = (item.location.executable, item.run_id)
+                test_ids.setdefault(item.suite_id, {}).setdefault(
+                    item.location.executable, []).append(item.run_id)
+                if run_order != RUN_ORDER_DEFAULT:
+                    test_ranks.setdefault(item.suite_id, {}).setdefault(key, rank)
+                if item.last_duration is not None:
+                    test_durations.setdefault(item.suite_id, {})[key] = item.last_duration
+
             logger.info(f'collected {len(test_paths)} tests')
             start = time.time()
 
-            data.notify_run_started(StartedRun(test_paths))
+            data.notify_run_started(StartedRun(test_paths, max_failures=max_failures))
             sublime.run_command('test_manager_refresh_all', {'data_location': data.location})
 
             self.running = True
@@ -84,15 +141,26 @@ class TestRunHelper(SettingsHelper):
             sublime.set_timeout(self.refresh_loop, self.refresh_interval)
 
             try:
-                for suite_id, grouped_tests in test_ids.items():
-                    logger.debug(f'running {len(grouped_tests)} tests for {suite_id}...')
+                # Suites share nothing, so they run at the same time; the number of test processes
+                # running at once is bounded by 'max_processes' across all suites. When the budget
+                # is exhausted, suites get processes in order of their first selected test.
+                budget = ProcessBudget(settings.get('max_processes', 0))
+                threads = []
+                for priority, (suite_id, grouped_tests) in enumerate(test_ids.items()):
                     suite = next((f for f in suites if f.suite_id == suite_id), None)
                     if suite is None:
                         logger.warning(f'{suite_id} not found in test suites')
                         continue
 
-                    suite.run(grouped_tests)
-                    logger.debug(f'done.')
+                    run_suite = partial(self.run_suite, suite, grouped_tests, test_ranks.get(suite_id, {}),
+                                        test_durations.get(suite_id, {}), budget, priority)
+                    threads.append(threading.Thread(target=run_suite, name=f'TestManager.run.{suite_id}'))
+
+                for thread in threads:
+                    thread.start()
+
+                for thread in threads:
+                    thread.join()
             finally:
                 data.notify_run_finished(FinishedRun(test_paths))
                 self.running = False
@@ -101,9 +169,25 @@ class TestRunHelper(SettingsHelper):
             end = time.time()
             logger.info(f'test run duration: {end - start}')
 
+            if data.run_cancelled:
+                sublime.status_message(f'TestManager: test run stopped after {data.run_failures} failures')
+
         except Exception as e:
             logger.error("error when running tests: %s\n%s", e, traceback.format_exc())
 
+    def run_suite(self, suite: TestSuite, grouped_tests: Dict[str, List[str]], test_ranks: Dict,
+                  test_durations: Dict, budget: ProcessBudget, priority: int):
+        if suite.test_data.stop_tests_event.is_set():
+            return
+
+        logger.debug(f'running {len(grouped_tests)} executables for {suite.suite_id}...')
+        try:
+            suite.run(grouped_tests, test_ranks, test_durations, process_budget=budget, run_priority=priority)
+        except Exception as e:
+            logger.error("error when running tests of %s: %s\n%s", suite.suite_id, e, traceback.format_exc())
+
+        logger.debug(f'{suite.suite_id} done.')
+
 
 class TestManagerStartSelectedCommand(TextCommand, TestDataHelper, TestRunHelper, TestManagerTextCmd):
 
@@ -142,7 +226,7 @@ class TestManagerStartSelectedCommand(TextCommand, TestDataHelper, TestRunHelper
 
 class TestManagerStartCommand(WindowCommand, TestDataHelper, TestRunHelper, TestManagerTextCmd):
 
-    def run(self, start='all'):
+    def run(self, start='all', max_failures=None):
         project = self.get_project()
         if not project:
             return
@@ -169,7 +253,19 @@ class TestManagerStartCommand(WindowCommand, TestDataHelper, TestRunHelper, Test
             self.window.show_quick_panel(choices, partial(self.run_one_test, data,
                                                           test_list, suites, choices), sublime.MONOSPACE_FONT)
         elif start == "all":
-            sublime.set_timeout_async(partial(self.run_tests, data, test_list, suites, ['']))
+            sublime.set_timeout_async(partial(self.run_tests, data, test_list, suites, [''],
+                                              max_failures=max_failures))
+        elif start == "affected":
+            tests, unknown = data.get_affected_tests(os.path.dirname(project))
+            if unknown > 0:
+                logger.warning(f'{unknown} tests have no recorded coverage and were not considered')
+
+            if len(tests) == 0:
+                sublime.status_message('TestManager: no test affected by the modified files')
+                return
+
+            sublime.set_timeout_async(partial(self.run_tests, data, test_list, suites, tests,
+                                              max_failures=max_failures))
 
     def run_one_test(self, data: TestData, test_list: TestList,
                      suites: List[TestSuite], choices: List[str], test_id: int):
@@ -1,13 +1,17 @@
 import os
+import json
 import logging
 import time
 import copy
 import enum
 import threading
 from datetime import datetime
-from typing import Optional, List, Dict, Set
+from typing import Hashable, Optional, List, Dict, Set, Tuple, Union
 import sqlite3
 from contextlib import closing
+from functools import partial
+
+from .pipeline import PipelineStage
 
 ROOT_NAME = ''
 TEST_SEPARATOR = '/'
@@ -90,6 +94,63 @@ class DiscoveredTest:
         self.report_id = report_id
         self.location = location
 
+    def to_json(self):
+        return {'full_name': self.full_name,
+                'discovery_id': self.discovery_id,
+                'suite_id': self.suite_id,
+                'run_id': self.run_id,
+                'report_id': self.report_id,
+                'location': [self.location.executable, self.location.file, self.location.line]}
+
+    @staticmethod
+    def from_json(data: Dict):
+        executable, file, line = data['location']
+        return DiscoveredTest(full_name=data['full_name'],
+                              discovery_id=data['discovery_id'],
+                              suite_id=data['suite_id'],
+                              run_id=data['run_id'],
+                              report_id=data['report_id'],
+                              location=TestLocation(executable=executable, file=file, line=line))
+
+
+def is_in_path(file: str, path: str):
+    file = os.path.normpath(file)
+    path = os.path.normpath(path)
+    return file == path or file.startswith(path.rstrip(os.sep) + os.sep)
+
+
+class DiscoveryScope:
+    """
+    The tests covered by a partial discovery: all the tests of a suite, or only the tests of
+    some of its executables, and/or only the tests whose source file or executable is within
+    some paths (relative to the project root).
+    """
+
+    def __init__(self, suite_id: str, executables: Optional[List[str]] = None,
+                 paths: Optional[List[str]] = None):
+        self.suite_id = suite_id
+        self.executables = executables
+        self.paths = paths
+
+    def contains(self, item: 'TestItem'):
+        if item.suite_id != self.suite_id:
+            return False
+
+        if self.executables is not None:
+            if item.location is None or item.location.executable not in self.executables:
+                return False
+
+        if self.paths is not None:
+            if item.location is None or not any(is_in_path(item.location.file, p) or
+                                                is_in_path(item.location.executable, p) for p in self.paths):
+                return False
+
+        return True
+
+    def describe(self):
+        filters = (self.executables or []) + (self.paths or [])
+        return self.suite_id + (f' ({", ".join(filters)})' if len(filters) > 0 else '')
+
 
 class StartedTest:
     def __init__(self, full_name: List[str] = [], start_time=None):
@@ -98,10 +159,15 @@ class StartedTest:
 
 
 class FinishedTest:
-    def __init__(self, full_name: List[str] = [], status=TestStatus.NOT_RUN, message=''):
+    def __init__(self, full_name: List[str] = [], status=TestStatus.NOT_RUN, message='',
+                 duration: Optional[float] = None, end_time=None, cached=False):
         self.full_name = full_name
         self.status = status
         self.message = message
+        self.duration = duration  # seconds, as reported by the framework (if any)
+        self.end_time = datetime.now() if end_time is None else end_time
+        # Result reused from the result cache; the test was not run.
+        self.cached = cached
 
 
 class TestOutput:
@@ -110,9 +176,98 @@ class TestOutput:
         self.output = output
 
 
+TestEvent = Union[StartedTest, TestOutput, FinishedTest]
+
+
+class TestEventBuffer:
+    """
+    Stands in for the TestData of an output parser: test events are collected, and only sent
+    as a single batch when flushed (see 'TestData.notify_test_events()').
+    """
+
+    def __init__(self, test_data):
+        self.test_data = test_data
+        self.events: List[TestEvent] = []
+
+    def get_test_list(self) -> 'TestList':
+        return self.test_data.get_test_list()
+
+    def notify_test_started(self, test: StartedTest):
+        self.events.append(test)
+
+    def notify_test_output(self, test: TestOutput):
+        self.events.append(test)
+
+    def notify_test_finished(self, test: FinishedTest):
+        self.events.append(test)
+
+    def flush(self):
+        if len(self.events) > 0:
+            self.test_data.notify_test_events(self.events)
+            self.events = []
+
+
+class RunningTests:
+    """
+    Tests started by an output parser and not finished yet, by key (e.g., report ID or flow ID),
+    so that tests running concurrently within one process can be reported.
+    """
+
+    def __init__(self, test_data):
+        self.test_data = test_data
+        self.tests: Dict[Hashable, List[str]] = {}
+        self.statuses: Dict[Hashable, TestStatus] = {}
+
+    def keys(self) -> List[Hashable]:
+        return list(self.tests.keys())
+
+    def get(self, key: Hashable) -> Optional[List[str]]:
+        return self.tests.get(key, None)
+
+    def get_last(self) -> Optional[List[str]]:
+        """
+        The test started last, for output that cannot be attributed to a specific test.
+        """
+        return next(reversed(self.tests.values()), None)
+
+    def get_status(self, key: Hashable, default: TestStatus) -> TestStatus:
+        return self.statuses.get(key, default)
+
+    def update_status(self, key: Hashable, status: TestStatus):
+        """
+        Record an intermediate status, to be used when the test finishes; the worst status is kept.
+        """
+        if key in self.tests:
+            self.statuses[key] = TestStatus(max(self.statuses.get(key, TestStatus.NOT_RUN).value, status.value))
+
+    def start(self, key: Hashable, test: List[str]):
+        # Started again without finishing first: the previous run did not complete.
+        self.finish(key, TestStatus.CRASHED)
+
+        self.tests[key] = test
+        self.test_data.notify_test_started(StartedTest(test))
+
+    def output(self, key: Optional[Hashable], output: str):
+        test = self.get_last() if key is None else self.get(key)
+        if test is not None:
+            self.test_data.notify_test_output(TestOutput(test, output))
+
+    def finish(self, key: Hashable, status: TestStatus, duration: Optional[float] = None):
+        test = self.tests.pop(key, None)
+        self.statuses.pop(key, None)
+        if test is not None:
+            self.test_data.notify_test_finished(FinishedTest(test, status, duration=duration))
+
+    def finish_all(self, status: TestStatus = TestStatus.CRASHED):
+        for key in self.keys():
+            self.finish(key, status)
+
+
 class StartedRun:
-    def __init__(self, tests: List[List[str]]):
+    def __init__(self, tests: List[List[str]], max_failures: Optional[int] = None):
         self.tests = tests
+        # Stop the run after this many failed or crashed tests (None or 0: no limit).
+        self.max_failures = max_failures
 
 
 class FinishedRun:
@@ -120,10 +275,146 @@ class FinishedRun:
         self.tests = tests
 
 
+class ResourceUsage:
+    def __init__(self, suite_id='', executable='', last_run=None, wall_time=0.0,
+                 user_time=0.0, system_time=0.0, max_rss=0, processes=0):
+        self.suite_id = suite_id
+        self.executable = executable
+        self.last_run: Optional[datetime] = last_run
+        self.wall_time = wall_time  # seconds
+        self.user_time = user_time  # seconds
+        self.system_time = system_time  # seconds
+        self.max_rss = max_rss  # bytes
+        self.processes = processes
+
+    @staticmethod
+    def from_row(row: sqlite3.Row):
+        return ResourceUsage(suite_id=row['suite_id'],
+                             executable=row['executable'],
+                             last_run=date_from_db(row['last_run']),
+                             wall_time=row['wall_time'],
+                             user_time=row['user_time'],
+                             system_time=row['system_time'],
+                             max_rss=row['max_rss'],
+                             processes=row['processes'])
+
+    def save(self, con: sqlite3.Connection):
+        con.execute('INSERT OR REPLACE INTO process_usage VALUES (?,?,?,?,?,?,?,?)',
+                    (self.suite_id,
+                     self.executable,
+                     self.last_run,
+                     self.wall_time,
+                     self.user_time,
+                     self.system_time,
+                     self.max_rss,
+                     self.processes))
+
+    def add(self, usage: 'ResourceUsage'):
+        self.wall_time += usage.wall_time
+        self.user_time += usage.user_time
+        self.system_time += usage.system_time
+        self.max_rss = max(self.max_rss, usage.max_rss)
+        self.processes += usage.processes
+
+
+class CachedDiscovery:
+    """
+    The tests discovered in one executable, with the fingerprint of the executable and the
+    discovery arguments at the time. The tests can be reused as long as neither changes.
+    """
+
+    def __init__(self, suite_id='', executable='', stat_key='', content_hash='', discovery_key='',
+                 tests: List[DiscoveredTest] = []):
+        self.suite_id = suite_id
+        self.executable = executable
+        self.stat_key = stat_key
+        self.content_hash = content_hash
+        self.discovery_key = discovery_key
+        self.tests = tests
+
+    @staticmethod
+    def from_row(row: sqlite3.Row):
+        return CachedDiscovery(suite_id=row['suite_id'],
+                               executable=row['executable'],
+                               stat_key=row['stat_key'],
+                               content_hash=row['content_hash'],
+                               discovery_key=row['discovery_key'],
+                               tests=[DiscoveredTest.from_json(t) for t in json.loads(row['tests'])])
+
+    @staticmethod
+    def create_table(con: sqlite3.Connection):
+        con.execute("""CREATE TABLE IF NOT EXISTS discovery_cache(
+            suite_id TEXT,
+            executable TEXT,
+            stat_key TEXT,
+            content_hash TEXT,
+            discovery_key TEXT,
+            tests TEXT,
+            PRIMARY KEY (suite_id, executable)
+            )""")
+
+    def save(self, con: sqlite3.Connection):
+        con.execute('INSERT OR REPLACE INTO discovery_cache VALUES (?,?,?,?,?,?)',
+                    (self.suite_id,
+                     self.executable,
+                     self.stat_key,
+                     self.content_hash,
+                     self.discovery_key,
+                     json.dumps([t.to_json() for t in self.tests])))
+
+
+class CachedResult:
+    """
+    The last result of a test, with the cache key of its executable at the time (see
+    'common.get_result_cache_key()'). Passed or skipped results can be reused as long as the
+    key does not change.
+    """
+
+    def __init__(self, suite_id='', executable='', run_id='', cache_key='', status=TestStatus.NOT_RUN):
+        self.suite_id = suite_id
+        self.executable = executable
+        self.run_id = run_id
+        self.cache_key = cache_key
+        self.status = status
+
+    @staticmethod
+    def from_row(row: sqlite3.Row):
+        return CachedResult(suite_id=row['suite_id'],
+                            executable=row['executable'],
+                            run_id=row['run_id'],
+                            cache_key=row['cache_key'],
+                            status=TestStatus[row['status'].upper()])
+
+    @staticmethod
+    def create_table(con: sqlite3.Connection):
+        con.execute("""CREATE TABLE IF NOT EXISTS result_cache(
+            suite_id TEXT,
+            executable TEXT,
+            run_id TEXT,
+            cache_key TEXT,
+            status TEXT,
+            PRIMARY KEY (suite_id, executable, run_id)
+            )""")
+
+    def save(self, con: sqlite3.Connection):
+        con.execute('INSERT OR REPLACE INTO result_cache VALUES (?,?,?,?,?)',
+                    (self.suite_id,
+                     self.executable,
+                     self.run_id,
+                     self.cache_key,
+                     self.status.name.lower()))
+
+
+class TestCoverage:
+    def __init__(self, tests: Dict[str, List[str]]):
+        # Source files (relative to the project root) executed by each test, indexed by full name.
+        self.tests = tests
+
+
 class TestItem:
     def __init__(self, name='', full_name='', discovery_id=0, suite_id='', run_id='', report_id='', location=None,
                  last_status=TestStatus.NOT_RUN, run_status=RunStatus.NOT_RUNNING,
-                 last_run=None, children: Optional[Dict] = None):
+                 last_run=None, last_duration=None, cached=False, children: Optional[Dict] = None):
         self.name: str = name
         self.full_name: str = full_name
         self.discovery_id: int = discovery_id
@@ -134,6 +425,9 @@ class TestItem:
         self.last_status: TestStatus = last_status
         self.run_status: RunStatus = run_status
         self.last_run: Optional[datetime] = last_run
+        self.last_duration: Optional[float] = last_duration
+        # The last status was reused from the result cache, rather than from running the test.
+        self.cached: bool = cached
         self.children: Optional[Dict[str, TestItem]] = children
 
     @staticmethod
@@ -148,10 +442,12 @@ class TestItem:
                         last_status=TestStatus[row['last_status'].upper()],
                         run_status=RunStatus[row['run_status'].upper()],
                         last_run=date_from_db(row['last_run']),
+                        last_duration=row['last_duration'] if 'last_duration' in row.keys() else None,
+                        cached=bool(row['cached']) if 'cached' in row.keys() else False,
                         children=None if row['leaf'] else {})
 
     def save(self, con: sqlite3.Connection):
-        con.execute('INSERT OR REPLACE INTO tests VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)',
+        con.execute('INSERT OR REPLACE INTO tests VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
                     (self.full_name,
                      self.name,
                      self.discovery_id,
@@ -164,7 +460,9 @@ class TestItem:
                      self.last_status.name.lower(),
                      self.run_status.name.lower(),
                      self.last_run,
-                     self.children is None))
+                     self.children is None,
+                     self.last_duration,
+                     self.cached))
 
         if self.children is not None:
             for c in self.children.values():
@@ -180,6 +478,7 @@ class TestItem:
     def from_discovered(test: DiscoveredTest):
         return TestItem(name=test.full_name[-1],
                         full_name=test_path_to_name(test.full_name),
+                        discovery_id=test.discovery_id,
                         suite_id=test.suite_id,
                         run_id=test.run_id,
                         report_id=test.report_id,
@@ -195,9 +494,9 @@ class TestItem:
     def notify_run_queued(self):
         self.run_status = RunStatus.QUEUED
 
-    def notify_run_stopped(self):
+    def notify_run_stopped(self, cancelled=False):
         if self.run_status == RunStatus.RUNNING:
-            self.last_status = TestStatus.CRASHED
+            self.last_status = TestStatus.STOPPED if cancelled else TestStatus.CRASHED
         elif self.run_status == RunStatus.QUEUED:
             self.last_status = TestStatus.STOPPED
         self.run_status = RunStatus.NOT_RUNNING
@@ -205,10 +504,17 @@ class TestItem:
     def update_from_started(self, test: StartedTest):
         self.last_run = test.start_time
         self.run_status = RunStatus.RUNNING
+        self.cached = False
 
     def update_from_finished(self, test: FinishedTest):
+        if test.duration is not None:
+            self.last_duration = test.duration
+        elif self.run_status == RunStatus.RUNNING and self.last_run is not None:
+            self.last_duration = max(0.0, (test.end_time - self.last_run).total_seconds())
+
         self.last_status = test.status
         self.run_status = RunStatus.NOT_RUNNING
+        self.cached = test.cached
 
     def recompute_status(self):
         if self.children is None:
@@ -296,13 +602,46 @@ class TestList:
                         last_status TEXT,
                         run_status TEXT,
                         last_run TIMESTAMP,
-                        leaf BOOL
+                        leaf BOOL,
+                        last_duration REAL,
+                        cached BOOL
                         )""")
 
                     con.execute("""CREATE TABLE test_ouputs(
                         full_name TEXT PRIMARY KEY,
                         output TEXT
                         )""")
+                else:
+                    columns = [r[1] for r in con.execute('PRAGMA table_info(tests)').fetchall()]
+                    if not 'last_duration' in columns:
+                        # Added in a later version; upgrade the existing database.
+                        con.execute('ALTER TABLE tests ADD COLUMN last_duration REAL')
+                    if not 'cached' in columns:
+                        con.execute('ALTER TABLE tests ADD COLUMN cached BOOL')
+
+                if not 'coverage_map' in tables:
+                    con.execute("""CREATE TABLE coverage_map(
+                        full_name TEXT,
+                        file TEXT,
+                        PRIMARY KEY (full_name, file)
+                        )""")
+                    con.execute('CREATE INDEX coverage_map_file ON coverage_map(file)')
+
+                if not 'discovery_cache' in tables:
+                    CachedDiscovery.create_table(con)
+
+                if not 'process_usage' in tables:
+                    con.execute("""CREATE TABLE process_usage(
+                        suite_id TEXT,
+                        executable TEXT,
+                        last_run TIMESTAMP,
+                        wall_time REAL,
+                        user_time REAL,
+                        system_time REAL,
+                        max_rss INT,
+                        processes INT,
+                        PRIMARY KEY (suite_id, executable)
+                        )""")
 
                 if len(refresh_hints) == 0:
                     con.execute("""DELETE FROM tests""")
@@ -443,6 +782,80 @@ class TestList:
                 con.execute('UPDATE test_ouputs SET output=? WHERE full_name=?',
                             (output, test_name))
 
+    def save_coverage(self, coverage: TestCoverage):
+        with closing(sqlite3.connect(os.path.join(self.location, DB_FILE))) as con:
+            with con:
+                for name, files in coverage.tests.items():
+                    con.execute('DELETE FROM coverage_map WHERE full_name=?', (name,))
+                    con.executemany('INSERT OR REPLACE INTO coverage_map VALUES (?,?)',
+                                    [(name, file) for file in files])
+
+    def get_coverage(self) -> Dict[str, List[str]]:
+        coverage: Dict[str, List[str]] = {}
+        with closing(sqlite3.connect(os.path.join(self.location, DB_FILE))) as con:
+            with con:
+                tables = [r[0] for r in con.execute('SELECT name FROM sqlite_master').fetchall()]
+                if not 'coverage_map' in tables:
+                    return coverage
+
+                for name, file in con.execute('SELECT full_name, file FROM coverage_map'):
+                    coverage.setdefault(name, []).append(file)
+
+        return coverage
+
+    def save_cached_discovery(self, cached: CachedDiscovery):
+        with closing(sqlite3.connect(os.path.join(self.location, DB_FILE))) as con:
+            with con:
+                # The table may not exist yet in a database created by an older version.
+                CachedDiscovery.create_table(con)
+                cached.save(con)
+
+    def get_cached_discovery(self, suite_id: str, executable: str) -> Optional[CachedDiscovery]:
+        with closing(sqlite3.connect(os.path.join(self.location, DB_FILE))) as con:
+            with con:
+                tables = [r[0] for r in con.execute('SELECT name FROM sqlite_master').fetchall()]
+                if not 'discovery_cache' in tables:
+                    return None
+
+                con.row_factory = sqlite3.Row
+                row = con.execute('SELECT * FROM discovery_cache WHERE suite_id=? AND executable=?',
+                                  (suite_id, executable)).fetchone()
+                return CachedDiscovery.from_row(row) if row is not None else None
+
+    def save_cached_results(self, results: List[CachedResult]):
+        with closing(sqlite3.connect(os.path.join(self.location, DB_FILE))) as con:
+            with con:
+                CachedResult.create_table(con)
+                for result in results:
+                    result.save(con)
+
+    def get_cached_results(self, suite_id: str, executable: str) -> Dict[str, CachedResult]:
+        with closing(sqlite3.connect(os.path.join(self.location, DB_FILE))) as con:
+            with con:
+                tables = [r[0] for r in con.execute('SELECT name FROM sqlite_master').fetchall()]
+                if not 'result_cache' in tables:
+                    return {}
+
+                con.row_factory = sqlite3.Row
+                rows = con.execute('SELECT * FROM result_cache WHERE suite_id=? AND executable=?',
+                                   (suite_id, executable))
+                return {row['run_id']: CachedResult.from_row(row) for row in rows}
+
+    def save_resource_usage(self, usage: ResourceUsage):
+        with closing(sqlite3.connect(os.path.join(self.location, DB_FILE))) as con:
+            with con:
+                usage.save(con)
+
+    def get_resource_usage(self) -> List[ResourceUsage]:
+        with closing(sqlite3.connect(os.path.join(self.location, DB_FILE))) as con:
+            with con:
+                tables = [r[0] for r in con.execute('SELECT name FROM sqlite_master').fetchall()]
+                if not 'process_usage' in tables:
+                    return []
+
+                con.row_factory = sqlite3.Row
+                return [ResourceUsage.from_row(row) for row in con.execute('SELECT * FROM process_usage')]
+
     def get_test_output(self, item_path: List[str]) -> str:
         test_name = test_path_to_name(item_path)
         if test_name in self.test_output_buffer:
@@ -526,6 +939,8 @@ class TestData:
     def __init__(self, location):
         self.location = location
         self.mutex = threading.Lock()
+        # Test events are applied on a separate thread, so slow DB commits do not stall the parsers.
+        self.update_stage = PipelineStage('state', lambda update: update())
         self.stats: Optional[dict] = None
         self.last_test_finished: Optional[List[str]] = None
         self.tests_started: Set[str] = set()
@@ -533,6 +948,12 @@ class TestData:
         self.test_output_buffer = ''
         self.last_commit_time: Optional[float] = None
         self.tests_refresh_hints: Set[str] = set()
+        self.run_usage: Dict[Tuple[str, str], ResourceUsage] = {}
+        # Failed tests are counted when they are reported, before the events are applied.
+        self.failures_mutex = threading.Lock()
+        self.max_failures: Optional[int] = None
+        self.run_failures = 0
+        self.run_cancelled = False
 
         if not self.is_initialised():
             self.init()
@@ -574,6 +995,12 @@ class TestData:
             logger.error(f'error during load: {e}')
             raise
 
+    def close(self):
+        """
+        Apply the pending test events, and stop the thread applying them.
+        """
+        self.update_stage.close()
+
     def init(self):
         clear_test_data(self.location)
         self.tests_updated = True
@@ -657,7 +1084,12 @@ class TestData:
 
         self.commit(meta=self.meta)
 
-    def notify_discovered_tests(self, discovered_tests: List[DiscoveredTest], discovery_time: datetime):
+    def notify_discovered_tests(self, discovered_tests: List[DiscoveredTest], discovery_time: datetime,
+                                scopes: Optional[List[DiscoveryScope]] = None):
+        """
+        Replace the test list with the discovered tests. If 'scopes' is given, the discovery was
+        partial: only the tests within these scopes are replaced, and the other tests are kept.
+        """
         logger.info('discovery complete')
 
         with self.mutex:
@@ -666,8 +1098,25 @@ class TestData:
 
             old_tests = self.tests
             new_tests = TestList(self.location)
+
+            next_discovery_id = 0
+            if scopes is not None:
+                for item in old_tests.tests():
+                    next_discovery_id = max(next_discovery_id, item.discovery_id + 1)
+                    if not any(s.contains(item) for s in scopes):
+                        new_tests.update_test(test_name_to_path(item.full_name), item)
+                        new_tests.update_compound_status(test_name_to_path(item.full_name)[:-1])
+
             for test in discovered_tests:
                 item = old_tests.find_test(test.full_name)
+                if scopes is not None:
+                    # Keep the position of known tests, and add new tests at the end.
+                    if item is not None and item.children is None:
+                        test.discovery_id = item.discovery_id
+                    else:
+                        test.discovery_id = next_discovery_id
+                        next_discovery_id += 1
+
                 if not item:
                     item = TestItem.from_discovered(test)
                 else:
@@ -681,11 +1130,20 @@ class TestData:
     def notify_run_started(self, run: StartedRun):
         logger.info('test run started')
 
+        self.update_stage.flush()
+        self.update_stage.stats.reset()
+
         with self.mutex:
             self.meta.running = True
             self.stop_tests_event = threading.Event()
 
             self.tests_started.clear()
+            self.run_usage = {}
+
+            with self.failures_mutex:
+                self.max_failures = run.max_failures
+                self.run_failures = 0
+                self.run_cancelled = False
 
             update_list = set()
             for path in run.tests:
@@ -704,6 +1162,10 @@ class TestData:
     def notify_run_finished(self, run: FinishedRun):
         logger.info('test run finished')
 
+        # Make sure all the test events are applied before closing the run.
+        self.update_stage.flush()
+        logger.info(self.update_stage.stats.report())
+
         with self.mutex:
             self.meta.running = False
 
@@ -718,7 +1180,7 @@ class TestData:
                 if not item:
                     raise Exception('Unknown test "{}"'.format(test_path_to_name(path)))
 
-                item.notify_run_stopped()
+                item.notify_run_stopped(cancelled=self.run_cancelled)
                 update_list = update_list.union(parent_names_in_path(path))
 
             for path in update_list:
@@ -726,48 +1188,211 @@ class TestData:
 
         self.commit(meta=self.meta, tests=self.tests)
 
+    def notify_process_finished(self, usage: ResourceUsage):
+        self.update_stage.put(partial(self.apply_process_finished, usage))
+
+    def notify_test_coverage(self, coverage: TestCoverage):
+        self.update_stage.put(partial(self.apply_test_coverage, coverage))
+
     def notify_test_started(self, test: StartedTest):
-        logger.info('started {}'.format(test_path_to_name(test.full_name)))
+        self.update_stage.put(partial(self.apply_test_started, test))
+
+    def notify_test_output(self, test: TestOutput):
+        self.update_stage.put(partial(self.apply_test_output, test))
+
+    def notify_test_finished(self, test: FinishedTest):
+        self.count_failures([test])
+        self.update_stage.put(partial(self.apply_test_finished, test))
+
+    def notify_test_events(self, events: List[TestEvent]):
+        """
+        Apply a batch of test events, in order, with a single lock and commit.
+        """
+        self.count_failures(events)
+        self.update_stage.put(partial(self.apply_test_events, events))
+
+    def count_failures(self, events: List[TestEvent]):
+        """
+        Count the failed tests as soon as they are reported, on the thread of the output parser,
+        so that the run is stopped before the next process starts once 'max_failures' is reached.
+        """
+        if not self.meta.running:
+            return
+
+        with self.failures_mutex:
+            for event in events:
+                if not isinstance(event, FinishedTest):
+                    continue
+
+                if self.run_cancelled and event.status == TestStatus.CRASHED:
+                    # Killed because the run was cancelled; this is not the test's fault.
+                    event.status = TestStatus.STOPPED
+                elif event.status in [TestStatus.FAILED, TestStatus.CRASHED]:
+                    self.run_failures += 1
+                    if self.max_failures and self.run_failures >= self.max_failures and not self.run_cancelled:
+                        logger.warning(f'{self.run_failures} tests failed; cancelling the test run')
+                        self.run_cancelled = True
+                        self.stop_tests_event.set()
+
+    def wait_for_updates(self):
+        """
+        Wait until all the test events notified so far are applied.
+        """
+        self.update_stage.flush()
+
+    def apply_process_finished(self, usage: ResourceUsage):
+        logger.info(f'process finished for {usage.executable}: {usage.wall_time:.2f}s wall, '
+                    f'{usage.user_time:.2f}s user, {usage.system_time:.2f}s system, '
+                    f'{usage.max_rss/(1024*1024):.1f} MB peak RSS')
+
+        with self.mutex:
+            # Accumulate over all the processes launched for this executable in the current run.
+            key = (usage.suite_id, usage.executable)
+            total = self.run_usage.get(key)
+            if total is None:
+                total = ResourceUsage(suite_id=usage.suite_id, executable=usage.executable)
+                self.run_usage[key] = total
+
+            total.last_run = usage.last_run or datetime.now()
+            total.add(usage)
+            self.tests.save_resource_usage(total)
+
+    def get_resource_usage(self) -> List[ResourceUsage]:
+        with self.mutex:
+            return self.tests.get_resource_usage()
 
+    def get_cached_discovery(self, suite_id: str, executable: str) -> Optional[CachedDiscovery]:
         with self.mutex:
-            item = self.tests.find_test(test.full_name)
-            if not item:
-                raise Exception('Unknown test "{}"'.format(test_path_to_name(test.full_name)))
+            return self.tests.get_cached_discovery(suite_id, executable)
 
-            item.update_from_started(test)
-            refresh_hints = [item.full_name]
+    def save_cached_discovery(self, cached: CachedDiscovery):
+        with self.mutex:
+            self.tests.save_cached_discovery(cached)
 
-            if self.last_test_finished is not None:
-                # Update parents of last tests now, rather than in notify_test_finished().
-                # This prevents status flicker.
-                self.tests.update_compound_status(self.last_test_finished[:-1])
-                refresh_hints += parent_names_in_path(self.last_test_finished)
-                self.last_test_finished = None
+    def get_cached_results(self, suite_id: str, executable: str) -> Dict[str, CachedResult]:
+        with self.mutex:
+            return self.tests.get_cached_results(suite_id, executable)
 
-            self.tests.update_compound_status(test.full_name[:-1])
-            self.tests.clear_test_output(test.full_name)
-            self.tests_started.add(test_path_to_name(test.full_name))
-            refresh_hints += parent_names_in_path(test.full_name)
+    def save_cached_results(self, results: List[CachedResult]):
+        with self.mutex:
+            self.tests.save_cached_results(results)
 
-        self.commit(tests=self.tests, refresh_hints=refresh_hints, buffered=True)
+    def apply_test_coverage(self, coverage: TestCoverage):
+        logger.info(f'recording coverage of {len(coverage.tests)} tests')
 
-    def notify_test_output(self, test: TestOutput):
         with self.mutex:
-            self.tests.add_test_output(test.full_name, test.output)
+            self.tests.save_coverage(coverage)
+
+    def get_affected_tests(self, root_dir: str) -> Tuple[List[str], int]:
+        """
+        Return the tests that executed a source file modified after their last run, and the tests
+        that were never run (which may execute any file). Also returns the number of tests
+        without recorded coverage, which cannot be selected this way.
+        """
+        with self.mutex:
+            coverage = self.tests.get_coverage()
+            tests = [(t.full_name, t.last_run) for t in self.tests.tests()]
+
+        mtimes: Dict[str, Optional[float]] = {}
+
+        def get_mtime(file):
+            if file not in mtimes:
+                try:
+                    mtimes[file] = os.path.getmtime(os.path.join(root_dir, file))
+                except OSError:
+                    # Deleted or renamed; the tests using it may be affected.
+                    mtimes[file] = time.time()
+            return mtimes[file]
+
+        affected = []
+        unknown = 0
+        for name, last_run in tests:
+            if last_run is None:
+                affected.append(name)
+            elif name not in coverage:
+                unknown += 1
+            elif any(get_mtime(f) > last_run.timestamp() for f in coverage[name]):
+                affected.append(name)
+
+        return affected, unknown
+
+    def update_test_started(self, test: StartedTest) -> List[str]:
+        """
+        Apply a test started event; the mutex must be held. Returns the names of the updated items.
+        """
+        logger.info('started {}'.format(test_path_to_name(test.full_name)))
 
-    def notify_test_finished(self, test: FinishedTest):
+        item = self.tests.find_test(test.full_name)
+        if not item:
+            raise Exception('Unknown test "{}"'.format(test_path_to_name(test.full_name)))
+
+        item.update_from_started(test)
+        refresh_hints = [item.full_name]
+
+        if self.last_test_finished is not None:
+            # Update parents of last tests now, rather than in update_test_finished().
+            # This prevents status flicker.
+            self.tests.update_compound_status(self.last_test_finished[:-1])
+            refresh_hints += parent_names_in_path(self.last_test_finished)
+            self.last_test_finished = None
+
+        self.tests.update_compound_status(test.full_name[:-1])
+        self.tests.clear_test_output(test.full_name)
+        self.tests_started.add(test_path_to_name(test.full_name))
+        refresh_hints += parent_names_in_path(test.full_name)
+
+        return refresh_hints
+
+    def update_test_finished(self, test: FinishedTest) -> List[str]:
+        """
+        Apply a test finished event; the mutex must be held. Returns the names of the updated items.
+        """
         logger.info('finished {}'.format(test_path_to_name(test.full_name)))
 
+        item = self.tests.find_test(test.full_name)
+        if not item:
+            raise Exception('Unknown test "{}"'.format(test_path_to_name(test.full_name)))
+
+        item.update_from_finished(test)
+        refresh_hints = [item.full_name]
+
+        # Cached results are reported without the test being started.
+        self.tests_started.discard(test_path_to_name(test.full_name))
+        self.last_test_finished = test.full_name
+        self.tests.flush_test_output(test.full_name)
+
+        return refresh_hints
+
+    def apply_test_started(self, test: StartedTest):
         with self.mutex:
-            item = self.tests.find_test(test.full_name)
-            if not item:
-                raise Exception('Unknown test "{}"'.format(test_path_to_name(test.full_name)))
+            refresh_hints = self.update_test_started(test)
+
+        self.commit(tests=self.tests, refresh_hints=refresh_hints, buffered=True)
 
-            item.update_from_finished(test)
-            refresh_hints = [item.full_name]
+    def apply_test_output(self, test: TestOutput):
+        with self.mutex:
+            self.tests.add_test_output(test.full_name, test.output)
 
-            self.tests_started.remove(test_path_to_name(test.full_name))
-            self.last_test_finished = test.full_name
-            self.tests.flush_test_output(test.full_name)
+    def apply_test_finished(self, test: FinishedTest):
+        with self.mutex:
+            refresh_hints = self.update_test_finished(test)
 
         self.commit(tests=self.tests, refresh_hints=refresh_hints, buffered=True)
+
+    def apply_test_events(self, events: List[TestEvent]):
+        refresh_hints: List[str] = []
+        with self.mutex:
+            for event in events:
+                try:
+                    if isinstance(event, StartedTest):
+                        refresh_hints += self.update_test_started(event)
+                    elif isinstance(event, FinishedTest):
+                        refresh_hints += self.update_test_finished(event)
+                    else:
+                        self.tests.add_test_output(event.full_name, event.output)
+                except Exception as e:
+                    # Do not lose the rest of the batch.
+                    logger.error(f'error when applying test event: {e}')
+
+        if len(refresh_hints) > 0:
+            self.commit(tests=self.tests, refresh_hints=refresh_hints, buffered=True)
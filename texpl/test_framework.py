@@ -1,10 +1,10 @@
 from abc import ABC, abstractmethod
-from typing import Callable, Dict, List
+from typing import Callable, Dict, List, Optional, Set
 import copy
 import traceback
 import logging
 
-from .test_data import DiscoveredTest
+from .test_data import DiscoveredTest, DiscoveryScope, TestItem
 from .test_suite import TestSuite
 from .errors import FrameworkError
 
@@ -63,15 +63,57 @@ class TestFramework(ABC):
         self.test_data = suite.test_data
         self.project_root_dir = suite.project_root_dir
         self.suite = suite
+        # Run IDs of all the known tests, by executable; set at the start of a run by the
+        # frameworks that minimize their test filters (see 'common.minimize_filters()').
+        self.run_ids: Dict[str, Set[str]] = {}
 
     @abstractmethod
-    def discover(self) -> List[DiscoveredTest]:
+    def discover(self, scope: Optional[DiscoveryScope] = None) -> List[DiscoveredTest]:
         """
         Run test discovery and return a list of discovered tests. The discovered tests will
         be registered with the TestData class automatically, you do not need to do this yourself.
+        If 'scope' is given, only the tests within this scope need to be discovered. Returning
+        more tests is allowed (e.g., if the framework cannot restrict its discovery).
         """
         pass
 
+    def get_scope(self, tests: List[TestItem]) -> DiscoveryScope:
+        """
+        Return the smallest scope to discover again the given tests (and any new test next to
+        them). By default, this is the whole suite.
+        """
+        return DiscoveryScope(self.suite.suite_id)
+
+    def get_batches(self, executable: str, test_ids: List[str], transport) -> List[List[str]]:
+        """
+        Split the tests of an executable into batches, each run by a separate process, e.g. to
+        keep the command line within the operating system's limits (see 'common.make_batches()').
+        By default, all the tests are run by a single process.
+        """
+        return [test_ids]
+
+    def get_result_cache_key(self, executable: str) -> Optional[str]:
+        """
+        Return a key that changes whenever running the tests of the executable again could give
+        different results (see 'common.get_result_cache_key()'), for the result cache. Return
+        None if the results cannot be cached; this is the default.
+        """
+        return None
+
+    def get_watched_paths(self) -> List[str]:
+        """
+        Directories to monitor for changes in watch mode.
+        """
+        return [self.project_root_dir]
+
+    def get_changed_scope(self, changed_files: List[str]) -> Optional[DiscoveryScope]:
+        """
+        Return which tests must be discovered and run again in watch mode, after the given files
+        were modified, created, or deleted (absolute paths). Return None if no test is affected.
+        By default, any change affects the whole suite.
+        """
+        return DiscoveryScope(self.suite.suite_id) if len(changed_files) > 0 else None
+
     @abstractmethod
     def run(self, grouped_tests: Dict[str, List[str]]) -> None:
         """
@@ -1 +1 @@
-from . import pytest, catch2, doctest_cpp, gtest, teamcity, cargo, phpunit, common
+from . import pytest, catch2, doctest_cpp, gtest, teamcity, cargo, phpunit, junit, common
@@ -5,15 +5,22 @@ from typing import Dict, List, Optional, Union
 
 from ..test_framework import (TestFramework, register_framework)
 from ..test_suite import TestSuite
-from ..test_data import (DiscoveredTest, TestLocation, TestData,
-                         StartedTest, FinishedTest, TEST_SEPARATOR, TestStatus, TestOutput)
+from ..test_data import (DiscoveredTest, DiscoveryScope, TestLocation, TestData,
+                         TestEventBuffer, RunningTests, TEST_SEPARATOR, TestStatus)
 from .. import process
-from . import common
+from . import common, scheduler
 
 logger = logging.getLogger('TestManager.cargo')
 parser_logger = logging.getLogger('TestManagerParser.cargo')
 
 
+CARGO_STATUS_MAP = {
+    'ok': TestStatus.PASSED,
+    'failed': TestStatus.FAILED,
+    'ignored': TestStatus.SKIPPED
+}
+
+
 def get_json(line: str):
     if not line.startswith('{'):
         return None
@@ -31,58 +38,44 @@ def get_json(line: str):
 
 class OutputParser:
     def __init__(self, test_data: TestData, suite_id: str):
-        self.test_data = test_data
+        self.test_data = TestEventBuffer(test_data)
         self.test_list = test_data.get_test_list()
         self.suite_id = suite_id
-        self.current_test: Optional[List[str]] = None
-
-    def finish_current_test(self):
-        if self.current_test is not None:
-            self.test_data.notify_test_finished(FinishedTest(self.current_test, TestStatus.CRASHED))
-            self.current_test = None
+        self.running = RunningTests(self.test_data)
 
     def close(self):
-        self.finish_current_test()
+        self.running.finish_all()
+        self.test_data.flush()
+
+    def feed(self, output: str):
+        # Output comes in chunks of whole lines; test events are sent in one batch per chunk.
+        for line in process.split_lines(output):
+            self.feed_line(line)
 
-    def feed(self, line: str):
+        self.test_data.flush()
+
+    def feed_line(self, line: str):
         parser_logger.debug(line.rstrip())
 
         json_line = get_json(line)
         if json_line is None:
-            if self.current_test:
-                self.test_data.notify_test_output(TestOutput(self.current_test, line))
+            self.running.output(None, line)
             return
 
         if json_line['type'] != 'test':
             return
 
+        name = json_line['name']
         if json_line['event'] == 'started':
-            self.finish_current_test()
-            self.current_test = self.test_list.find_test_by_report_id(
-                self.suite_id, 'cargo', json_line['name'])
-            if self.current_test is None:
-                return
-
-            self.test_data.notify_test_started(StartedTest(self.current_test))
-
-        if json_line['event'] == 'ok':
-            if self.current_test is None:
-                return
+            test = self.test_list.find_test_by_report_id(self.suite_id, 'cargo', name)
+            if test is not None:
+                self.running.start(name, test)
+        elif json_line['event'] in CARGO_STATUS_MAP:
+            # Output captured by the test harness.
+            if len(json_line.get('stdout', '')) > 0:
+                self.running.output(name, json_line['stdout'])
 
-            self.test_data.notify_test_finished(FinishedTest(self.current_test, TestStatus.PASSED))
-            self.current_test = None
-        elif json_line['event'] == 'failed':
-            if self.current_test is None:
-                return
-
-            self.test_data.notify_test_finished(FinishedTest(self.current_test, TestStatus.FAILED))
-            self.current_test = None
-        elif json_line['event'] == 'ignored':
-            if self.current_test is None:
-                return
-
-            self.test_data.notify_test_finished(FinishedTest(self.current_test, TestStatus.SKIPPED))
-            self.current_test = None
+            self.running.finish(name, CARGO_STATUS_MAP[json_line['event']])
 
 
 class Cargo(TestFramework):
@@ -139,7 +132,11 @@ class Cargo(TestFramework):
 
         return [self.cargo]
 
-    def discover(self) -> List[DiscoveredTest]:
+    def get_changed_scope(self, changed_files: List[str]) -> Optional[DiscoveryScope]:
+        return common.get_changed_sources_scope(self, changed_files, extensions=['.rs'],
+                                                file_names=['Cargo.toml', 'Cargo.lock'])
+
+    def discover(self, scope: Optional[DiscoveryScope] = None) -> List[DiscoveredTest]:
         cwd = common.get_working_directory(user_cwd=self.cwd, project_root_dir=self.project_root_dir)
         discover_args = self.get_cargo() + self.discover_args + self.args
         output = process.get_output(discover_args, env=self.env, cwd=cwd)
@@ -178,27 +175,44 @@ class Cargo(TestFramework):
 
         return tests
 
+    def get_filters(self, executable: str, test_ids: List[str]) -> List[str]:
+        # When all the tests are selected, let cargo run them all (no filter).
+        filters = common.minimize_filters(test_ids, self.run_ids.get(executable, set()))
+        return filters if filters is not None else []
+
+    def get_batches(self, executable: str, test_ids: List[str], transport) -> List[List[str]]:
+        if len(self.get_filters(executable, test_ids)) == 0:
+            return [test_ids]
+
+        return common.make_batches(test_ids, self.get_cargo() + self.run_args + self.args, transport)
+
     def run(self, grouped_tests: Dict[str, List[str]]) -> None:
         cwd = common.get_working_directory(user_cwd=self.cwd, project_root_dir=self.project_root_dir)
 
         assert len(grouped_tests) == 1
 
         test_ids = [test for tests in grouped_tests.values() for test in tests]
+        self.run_ids = common.get_run_ids(self.test_data, self.suite.suite_id)
+
+        def run_tests(executable, test_ids, watchdog):
+            parser = common.get_generic_parser(parser=self.parser,
+                                               test_data=watchdog,
+                                               suite_id=self.suite.suite_id,
+                                               executable=executable)
 
-        parser = common.get_generic_parser(parser=self.parser,
-                                           test_data=self.test_data,
-                                           suite_id=self.suite.suite_id,
-                                           executable='cargo')
+            if parser is None:
+                parser = OutputParser(watchdog, self.suite.suite_id)
 
-        if parser is None:
-            parser = OutputParser(self.test_data, self.suite.suite_id)
+            run_args = self.get_cargo() + self.run_args + self.args + self.get_filters(executable, test_ids)
+            usage = process.get_output_streamed(run_args,
+                                                parser.feed, watchdog,
+                                                queue=watchdog.queue, transport=watchdog.transport,
+                                                ignore_errors=True, env=self.env, cwd=cwd, chunked=True)
 
-        run_args = self.get_cargo() + self.run_args + self.args + test_ids
-        process.get_output_streamed(run_args,
-                                    parser.feed, self.test_data.stop_tests_event,
-                                    queue='cargo', ignore_errors=True, env=self.env, cwd=cwd)
+            parser.close()
+            return usage
 
-        parser.close()
+        scheduler.run_grouped_tests(self, {'cargo': test_ids}, run_tests, queue='cargo')
 
 
 register_framework('cargo', 'cargo test (Rust)', Cargo.from_json, Cargo.get_default_settings())
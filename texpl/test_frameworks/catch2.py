@@ -1,16 +1,17 @@
 import os
 import logging
+import json
 import xml.etree.ElementTree as ET
-import xml.sax
-from xml.sax.xmlreader import IncrementalParser
 from typing import Dict, List, Optional
+from tempfile import TemporaryDirectory
 
 from ..test_framework import (TestFramework, register_framework)
 from ..test_suite import TestSuite
-from ..test_data import (DiscoveredTest, DiscoveryError, TestLocation, TestData,
-                         StartedTest, FinishedTest, TEST_SEPARATOR, TestStatus, TestOutput)
+from ..test_data import (DiscoveredTest, DiscoveryError, DiscoveryScope, TestLocation, TestData, TestItem,
+                         TestEventBuffer, StartedTest, FinishedTest, TEST_SEPARATOR, TestStatus, TestOutput)
+from ..transport import CommandPrefixTransport
 from .. import process
-from . import common
+from . import common, scheduler
 
 logger = logging.getLogger('TestManager.catch2')
 
@@ -21,7 +22,7 @@ captured_elements = ['Info', 'Original', 'Expanded',
 
 class OutputParser(common.XmlParser):
     def __init__(self, test_data: TestData, suite_id: str, executable: str):
-        self.test_data = test_data
+        self.test_data = TestEventBuffer(test_data)
         self.test_list = test_data.get_test_list()
         self.suite_id = suite_id
         self.executable = executable
@@ -35,16 +36,16 @@ class OutputParser(common.XmlParser):
         self.last_results_content = {}
         self.last_expression_content = {}
 
-        xml_parser = xml.sax.make_parser()
-        assert isinstance(xml_parser, IncrementalParser)
-        self.xml_parser = xml_parser
-        self.xml_parser.setContentHandler(common.XmlStreamHandler(self, captured_elements))
+        self.xml_parser = common.XmlStreamParser(self, captured_elements)
 
-    def feed(self, line):
-        self.xml_parser.feed(line)
+    def feed(self, output):
+        # Test events are sent in one batch per chunk of output.
+        self.xml_parser.feed(output)
+        self.test_data.flush()
 
     def close(self):
         self.finish_current_test()
+        self.test_data.flush()
         self.xml_parser.close()
 
     def finish_current_test(self):
@@ -177,7 +178,10 @@ class Catch2(TestFramework):
                  args: List[str] = [],
                  discover_args: List[str] = [],
                  run_args: List[str] = [],
-                 parser: str = 'default'):
+                 parser: str = 'default',
+                 discovery_cache: bool = True,
+                 executable_ignore: List[str] = ['CMakeFiles'],
+                 input_file: bool = False):
         super().__init__(suite)
         self.executable_pattern = executable_pattern
         self.env = env
@@ -186,6 +190,9 @@ class Catch2(TestFramework):
         self.discover_args = discover_args
         self.run_args = run_args
         self.parser = parser
+        self.discovery_cache = discovery_cache
+        self.executable_ignore = executable_ignore
+        self.input_file = input_file
 
     @staticmethod
     def get_default_settings():
@@ -196,7 +203,10 @@ class Catch2(TestFramework):
             'args': [],
             'discover_args': ['-r', 'xml', '--list-tests'],
             'run_args': ['-r', 'xml'],
-            'parser': 'default'
+            'parser': 'default',
+            'discovery_cache': True,
+            'executable_ignore': ['CMakeFiles'],
+            'input_file': False
         }
 
     @staticmethod
@@ -209,9 +219,25 @@ class Catch2(TestFramework):
                       args=settings['args'],
                       discover_args=settings['discover_args'],
                       run_args=settings['run_args'],
-                      parser=settings['parser'])
+                      parser=settings['parser'],
+                      discovery_cache=settings['discovery_cache'],
+                      executable_ignore=settings['executable_ignore'],
+                      input_file=settings['input_file'])
 
-    def discover(self) -> List[DiscoveredTest]:
+    def get_watched_paths(self) -> List[str]:
+        return [common.get_executable_directory(self.executable_pattern, self.project_root_dir)]
+
+    def get_changed_scope(self, changed_files: List[str]) -> Optional[DiscoveryScope]:
+        return common.get_changed_executables_scope(self, self.executable_pattern, changed_files)
+
+    def get_scope(self, tests: List[TestItem]) -> DiscoveryScope:
+        return common.get_executables_scope(self, tests)
+
+    def get_result_cache_key(self, executable: str) -> Optional[str]:
+        cwd = common.get_working_directory(user_cwd=self.cwd, project_root_dir=self.project_root_dir)
+        return common.get_result_cache_key(self, executable, json.dumps([self.run_args + self.args, self.env, cwd]))
+
+    def discover(self, scope: Optional[DiscoveryScope] = None) -> List[DiscoveredTest]:
         cwd = common.get_working_directory(user_cwd=self.cwd, project_root_dir=self.project_root_dir)
 
         errors = []
@@ -226,15 +252,18 @@ class Catch2(TestFramework):
                 return self.parse_discovery(output, executable)
             except DiscoveryError as e:
                 errors.append(e.details if e.details else str(e))
-                return []
+                return None
 
-        executables = common.discover_executables(self.executable_pattern, cwd=self.project_root_dir)
+        executables = common.discover_executables(self.executable_pattern, cwd=self.project_root_dir,
+                                                  scope=scope, ignored=self.executable_ignore)
         if len(executables) == 0:
             logger.warning(f'no executable found with pattern "{self.executable_pattern}" ' +
                            f'(cwd: {self.project_root_dir})')
 
+        discovery_key = json.dumps([self.discover_args + self.args, self.env, cwd,
+                                     self.suite.custom_prefix, self.suite.path_prefix_style])
         for executable in executables:
-            tests += run_discovery(executable)
+            tests += common.discover_cached(self, executable, discovery_key, run_discovery)
 
         if errors:
             raise DiscoveryError('Error when discovering tests. See panel for more information', details=errors)
@@ -289,32 +318,63 @@ class Catch2(TestFramework):
 
         return tests
 
+    def is_whole_executable(self, executable: str, test_ids: List[str]):
+        # Without a filter, Catch2 runs the same (non-hidden) tests as it lists on discovery.
+        return common.minimize_filters(test_ids, self.run_ids.get(executable, set())) is None
+
+    def use_input_file(self, transport):
+        # The file is written locally, so it cannot be used with remote workers.
+        return self.input_file and not isinstance(transport, CommandPrefixTransport)
+
+    def get_batches(self, executable: str, test_ids: List[str], transport) -> List[List[str]]:
+        if self.use_input_file(transport) or self.is_whole_executable(executable, test_ids):
+            return [test_ids]
+
+        exe = common.make_executable_path(executable, project_root_dir=self.project_root_dir)
+        return common.make_batches(test_ids, [exe] + self.run_args + self.args, transport,
+                                   single_argument=True, escape=lambda t: t.replace(',', '\\,'))
+
     def run(self, grouped_tests: Dict[str, List[str]]) -> None:
         cwd = common.get_working_directory(user_cwd=self.cwd, project_root_dir=self.project_root_dir)
+        self.run_ids = common.get_run_ids(self.test_data, self.suite.suite_id)
 
-        def run_tests(executable, test_ids):
+        def run_tests(executable, test_ids, watchdog):
             logger.debug('starting tests from {}: "{}"'.format(executable, '" "'.join(test_ids)))
 
             test_filters = ','.join(test.replace(',', '\\,') for test in test_ids)
             exe = common.make_executable_path(executable, project_root_dir=self.project_root_dir)
 
             parser = common.get_generic_parser(parser=self.parser,
-                                               test_data=self.test_data,
+                                               test_data=watchdog,
                                                suite_id=self.suite.suite_id,
                                                executable=executable)
 
             if parser is None:
-                parser = OutputParser(self.test_data, self.suite.suite_id, executable)
-
-            run_args = [exe] + self.run_args + self.args + [test_filters]
-            process.get_output_streamed(run_args,
-                                        parser.feed, self.test_data.stop_tests_event,
-                                        queue='catch2', ignore_errors=True, env=self.env, cwd=cwd)
+                parser = OutputParser(watchdog, self.suite.suite_id, executable)
+
+            with TemporaryDirectory() as temp_dir:
+                if self.is_whole_executable(executable, test_ids):
+                    run_args = [exe] + self.run_args + self.args
+                elif self.use_input_file(watchdog.transport):
+                    # One test name per line; Catch2 quotes each line, so commas need no escaping.
+                    input_file = os.path.join(temp_dir, 'tests.txt')
+                    with open(input_file, 'w', encoding='utf-8') as f:
+                        f.write(''.join(test + '\n' for test in test_ids))
+
+                    run_args = [exe] + self.run_args + self.args + ['--input-file', input_file]
+                else:
+                    run_args = [exe] + self.run_args + self.args + [test_filters]
+
+                usage = process.get_output_streamed(run_args,
+                                                    parser.feed, watchdog,
+                                                    queue=watchdog.queue, transport=watchdog.transport,
+                                                    ignore_errors=True, env=self.env, cwd=cwd,
+                                                    chunked=True)
 
             parser.close()
+            return usage
 
-        for executable, test_ids in grouped_tests.items():
-            run_tests(executable, test_ids)
+        scheduler.run_grouped_tests(self, grouped_tests, run_tests, queue='catch2')
 
 
 register_framework('catch2', 'Catch2 (C++)', Catch2.from_json, Catch2.get_default_settings())
@@ -1,14 +1,33 @@
 import sys
-from typing import Optional, List
+from typing import Callable, Dict, Optional, List, Set, Tuple
 import os
-import xml.sax
+import time
+import threading
+import xml.parsers.expat
 from abc import ABC, abstractmethod
 import logging
-import glob
+import fnmatch
 
-from ..test_data import TestData
+from ..test_data import (TestData, TestList, StartedTest, FinishedTest, TestOutput, TestStatus, ResourceUsage,
+                         DiscoveryScope, DiscoveredTest, CachedDiscovery, TestItem, test_name_to_path,
+                         test_path_to_name, is_in_path, TestEvent)
+from .. import fingerprint
+from ..transport import Transport, CommandPrefixTransport
 from .teamcity import OutputParser as TeamcityOutputParser
 
+logger = logging.getLogger('TestManager.common')
+
+TEST_TIMEOUT_MESSAGE = 'TIMEOUT: test did not finish within {timeout} seconds; the test process was killed.'
+PROCESS_TIMEOUT_MESSAGE = 'TIMEOUT: test process did not finish within {timeout} seconds; it was killed.'
+
+# Limits on the length of a command line, in bytes. Linux limits each argument to 128 KiB, and
+# all the arguments and environment variables together to a quarter of the stack size (usually
+# 2 MiB). Windows limits the whole command line to 32767 characters.
+MAX_ARGUMENT_LENGTH = 32*1000 if sys.platform == 'win32' else 128*1024
+MAX_COMMAND_LINE_LENGTH = 32*1000 if sys.platform == 'win32' else 1024*1024
+# Room left for what is not counted (environment, quoting).
+COMMAND_LINE_MARGIN = 4*1024
+
 
 def get_setting(settings, name, defaults):
     return settings.get(name, defaults[name])
@@ -45,22 +64,302 @@ def change_parent_dir(path: str, old_cwd='.', new_cwd='.'):
 
 
 def is_executable(path: str):
-    if sys.platform == 'Windows':
+    if sys.platform == 'win32':
         return os.path.splitext(path)[1].lower() == '.exe'
     else:
         return (os.stat(path).st_mode & 0o111) != 0
 
 
-def discover_executables(executable_pattern: str, cwd='.') -> List[str]:
-    if '*' in executable_pattern:
-        old_cwd = os.getcwd()
-        os.chdir(cwd)
-        executables = [e for e in glob.glob(executable_pattern, recursive=True) if is_executable(e)]
-        os.chdir(old_cwd)
-        return executables
+def discover_executables(executable_pattern: str, cwd='.', scope: Optional[DiscoveryScope] = None,
+                         ignored: List[str] = []) -> List[str]:
+    if scope is not None and scope.executables is not None:
+        # Partial discovery: only keep the requested executables that still exist.
+        return [e for e in scope.executables if os.path.isfile(make_executable_path(e, cwd)) and
+                is_executable(make_executable_path(e, cwd))]
+
+    executables = discover_all_executables(executable_pattern, cwd, ignored)
+    if scope is not None and scope.paths is not None:
+        executables = [e for e in executables if any(is_in_path(e, p) for p in scope.paths)]
+
+    return executables
+
+
+# Listing of the directories visited when searching for executables, by path:
+# (modification time, sub-directories as (name, is symbolic link), files). The listing of a
+# directory can be reused as long as its modification time does not change.
+directory_index: Dict[str, Tuple[int, List[Tuple[str, bool]], List[str]]] = {}
+directory_index_mutex = threading.Lock()
+
+# Directories modified more recently than this are not added to the index, since they could be
+# modified again without their modification time changing (coarse file system timestamps).
+DIRECTORY_INDEX_MIN_AGE = 2.0  # seconds
+
+
+def list_directory(path: str) -> Optional[Tuple[List[Tuple[str, bool]], List[str]]]:
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+    with directory_index_mutex:
+        cached = directory_index.get(path, None)
+
+    if cached is not None and cached[0] == mtime:
+        return cached[1], cached[2]
+
+    dirs = []
+    files = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        dirs.append((entry.name, entry.is_symlink()))
+                    elif entry.is_file():
+                        files.append(entry.name)
+                except OSError:
+                    pass
+    except OSError:
+        return None
+
+    if time.time() - mtime/1e9 > DIRECTORY_INDEX_MIN_AGE:
+        with directory_index_mutex:
+            directory_index[path] = (mtime, dirs, files)
+
+    return dirs, files
+
+
+def has_wildcard(part: str):
+    return any(c in part for c in '*?[')
+
+
+def match_name(name: str, part: str):
+    # Like glob, wildcards do not match hidden files and directories.
+    if name.startswith('.') and not part.startswith('.'):
+        return False
+
+    return fnmatch.fnmatchcase(name, part)
+
+
+def find_files(directory: str, relative: str, parts: List[str], ignored: List[str],
+               select: Callable[[str], bool], files: List[str]):
+    """
+    Append to 'files' the files under 'directory' that match the remaining parts of the pattern
+    ('**' matches any number of directories) and for which 'select(path)' is true. Only the
+    directories that can match are visited. Paths are appended as 'relative' joined with the
+    matched names.
+    """
+    def is_ignored(name: str, path: str):
+        return any(fnmatch.fnmatchcase(name, i) or fnmatch.fnmatchcase(path, i) for i in ignored)
+
+    part = parts[0]
+    rest = parts[1:]
+
+    if part == '**':
+        find_files(directory, relative, rest if len(rest) > 0 else ['*'], ignored, select, files)
+
+        listing = list_directory(directory)
+        if listing is None:
+            return
+
+        # Symbolic links are not followed, to avoid cycles.
+        for name, is_link in listing[0]:
+            path = os.path.join(relative, name)
+            if not is_link and not name.startswith('.') and not is_ignored(name, path):
+                find_files(os.path.join(directory, name), path, parts, ignored, select, files)
+    elif not has_wildcard(part):
+        path = os.path.join(directory, part)
+        if len(rest) > 0:
+            if os.path.isdir(path):
+                find_files(path, os.path.join(relative, part), rest, ignored, select, files)
+        elif os.path.isfile(path) and select(path):
+            files.append(os.path.join(relative, part))
     else:
+        listing = list_directory(directory)
+        if listing is None:
+            return
+
+        dirs, names = listing
+        if len(rest) > 0:
+            for name, _ in dirs:
+                path = os.path.join(relative, name)
+                if match_name(name, part) and not is_ignored(name, path):
+                    find_files(os.path.join(directory, name), path, rest, ignored, select, files)
+        else:
+            for name in names:
+                path = os.path.join(relative, name)
+                if match_name(name, part) and not is_ignored(name, path):
+                    try:
+                        if select(os.path.join(directory, name)):
+                            files.append(path)
+                    except OSError:
+                        pass
+
+
+def discover_all_files(pattern: str, cwd='.', ignored: List[str] = [],
+                       select: Callable[[str], bool] = lambda path: True) -> List[str]:
+    """
+    Return the files matching the pattern (with '*' and '**' wildcards) for which 'select(path)'
+    is true, relative to 'cwd' unless the pattern is absolute. Files and directories matching one
+    of the 'ignored' patterns (by name, or by path relative to 'cwd') are skipped.
+    """
+    parts = pattern.replace('\\', '/').split('/')
+
+    # Leading parts without wildcards are used as they are. An absolute pattern starts with an
+    # empty part.
+    base = []
+    while len(parts) > 1 and not has_wildcard(parts[0]):
+        base.append(parts.pop(0))
+
+    relative = '/'.join(base) if base != [''] else '/'
+
+    files: List[str] = []
+    find_files(os.path.join(cwd, relative), relative, [p for p in parts if len(p) > 0], ignored, select, files)
+    return sorted(set(files))
+
+
+def discover_all_executables(executable_pattern: str, cwd='.', ignored: List[str] = []) -> List[str]:
+    """
+    Return the executables matching the pattern, relative to 'cwd' unless the pattern is absolute.
+    Files and directories matching one of the 'ignored' patterns (by name, or by path relative
+    to 'cwd') are skipped.
+    """
+    if '*' not in executable_pattern:
         return [executable_pattern]
 
+    return discover_all_files(executable_pattern, cwd, ignored, is_executable)
+
+
+def discover_cached(framework, executable: str, discovery_key: str,
+                    run_discovery: Callable[[str], Optional[List[DiscoveredTest]]]) -> List[DiscoveredTest]:
+    """
+    Return the tests of the executable from the last discovery, if neither the executable nor
+    the 'discovery_key' (discovery arguments, environment, etc.) have changed since. Otherwise,
+    run 'run_discovery()' and cache its result, unless it returned None (discovery error).
+    """
+    if not framework.discovery_cache:
+        return run_discovery(executable) or []
+
+    suite_id = framework.suite.suite_id
+    path = make_executable_path(executable, framework.project_root_dir)
+    try:
+        stat_key = fingerprint.get_stat_key(path)
+    except OSError:
+        return run_discovery(executable) or []
+
+    cached = framework.test_data.get_cached_discovery(suite_id, executable)
+    if cached is not None and cached.discovery_key == discovery_key:
+        if cached.stat_key == stat_key:
+            logger.debug(f'{executable} is unchanged; using cached discovery')
+            return cached.tests
+
+        # Rebuilt or touched, but possibly identical.
+        content_hash = fingerprint.get_content_hash(path)
+        if cached.content_hash == content_hash:
+            logger.debug(f'{executable} has the same content; using cached discovery')
+            cached.stat_key = stat_key
+            framework.test_data.save_cached_discovery(cached)
+            return cached.tests
+    else:
+        content_hash = fingerprint.get_content_hash(path)
+
+    # Fingerprints are taken before discovery: if the executable changes in the meantime, the
+    # cache will be out of date and the next discovery will run again.
+    tests = run_discovery(executable)
+    if tests is None:
+        return []
+
+    framework.test_data.save_cached_discovery(CachedDiscovery(suite_id=suite_id,
+                                                              executable=executable,
+                                                              stat_key=stat_key,
+                                                              content_hash=content_hash,
+                                                              discovery_key=discovery_key,
+                                                              tests=tests))
+    return tests
+
+
+def get_result_cache_key(framework, executable: str, run_key: str) -> Optional[str]:
+    """
+    Key of the results of an executable in the result cache, from the content of the executable
+    and the 'run_key' (run arguments, environment, etc.). Return None if the executable cannot be
+    read. The content hash saved by the discovery cache is reused if the executable is unchanged.
+    """
+    path = make_executable_path(executable, framework.project_root_dir)
+    try:
+        stat_key = fingerprint.get_stat_key(path)
+        cached = framework.test_data.get_cached_discovery(framework.suite.suite_id, executable)
+        if cached is not None and cached.stat_key == stat_key:
+            content_hash = cached.content_hash
+        else:
+            content_hash = fingerprint.get_content_hash(path)
+    except OSError:
+        return None
+
+    return fingerprint.get_data_hash(content_hash + run_key)
+
+
+def get_executable_directory(executable_pattern: str, project_root_dir: str) -> str:
+    """
+    Return the deepest existing directory that can contain executables matching the pattern.
+    """
+    parts = []
+    for part in executable_pattern.replace('\\', '/').split('/'):
+        if any(c in part for c in '*?['):
+            break
+        parts.append(part)
+    else:
+        parts = parts[:-1]
+
+    directory = make_executable_path(os.path.join(*parts) if parts else '', project_root_dir)
+    while not os.path.isdir(directory) and os.path.dirname(directory) != directory:
+        directory = os.path.dirname(directory)
+
+    return directory
+
+
+def get_executables_scope(framework, tests: List[TestItem]) -> DiscoveryScope:
+    """
+    Scope to discover again the given tests, for frameworks with test executables: the
+    executables that contain them.
+    """
+    executables = set(t.location.executable for t in tests if t.location is not None)
+    return DiscoveryScope(framework.suite.suite_id, sorted(executables))
+
+
+def get_changed_executables_scope(framework, executable_pattern: str,
+                                  changed_files: List[str]) -> Optional[DiscoveryScope]:
+    """
+    Watch mode: return the scope of the test executables that were modified, created, or deleted
+    among the changed files. Other changes (e.g., source files) do not affect compiled tests.
+    """
+    root = framework.project_root_dir
+    suite_id = framework.suite.suite_id
+
+    candidates = set(discover_executables(executable_pattern, cwd=root,
+                                          ignored=getattr(framework, 'executable_ignore', [])))
+    candidates.update(t.location.executable for t in framework.test_data.get_test_list().tests()
+                      if t.suite_id == suite_id and t.location is not None)
+
+    changed = set(os.path.normpath(f) for f in changed_files)
+    executables = [e for e in candidates if os.path.normpath(make_executable_path(e, root)) in changed]
+    if len(executables) == 0:
+        return None
+
+    return DiscoveryScope(suite_id, sorted(executables))
+
+
+def get_changed_sources_scope(framework, changed_files: List[str], extensions: List[str],
+                              file_names: List[str] = []) -> Optional[DiscoveryScope]:
+    """
+    Watch mode: return the scope of the whole suite if a source or configuration file was
+    changed (identified by its extension or file name), otherwise None.
+    """
+    for file in changed_files:
+        if os.path.splitext(file)[1] in extensions or os.path.basename(file) in file_names:
+            return DiscoveryScope(framework.suite.suite_id)
+
+    return None
+
 
 def get_generic_parser(parser: str, test_data: TestData, suite_id: str, executable: str):
     if parser == 'teamcity':
@@ -69,6 +368,277 @@ def get_generic_parser(parser: str, test_data: TestData, suite_id: str, executab
     return None
 
 
+class ProcessWatchdog:
+    """
+    Watches over a single test process. It is given to the output parser in place of the TestData,
+    so it sees which tests are running from the parser events, and to the process runner in place
+    of the stop token, so the process is killed when a test (or the whole process) times out.
+    It also carries the work queue and transport the process must be launched with.
+    """
+
+    def __init__(self, test_data: TestData, test_list: TestList,
+                 test_timeout: Optional[float] = None, process_timeout: Optional[float] = None,
+                 queue: str = 'default', transport: Optional[Transport] = None):
+        self.test_data = test_data
+        self.test_list = test_list
+        self.stop_token = test_data.stop_tests_event
+        self.test_timeout = test_timeout
+        self.process_timeout = process_timeout
+        self.queue = queue
+        self.transport = transport
+
+        self.mutex = threading.Lock()
+        self.start_time = time.time()
+        self.running_tests: Dict[str, float] = {}
+        self.started_tests: Set[str] = set()
+        self.timeout_messages: Dict[str, str] = {}
+        self.timed_out = False
+
+    # TestData interface, for the output parser.
+
+    def get_test_list(self) -> TestList:
+        return self.test_list
+
+    def watch_test_started(self, test: StartedTest):
+        name = test_path_to_name(test.full_name)
+        with self.mutex:
+            self.running_tests[name] = time.time()
+            self.started_tests.add(name)
+
+    def watch_test_finished(self, test: FinishedTest) -> List[TestEvent]:
+        """
+        Returns the events to forward for this finished test: a test that timed out is reported
+        as crashed, with the timeout message as output.
+        """
+        name = test_path_to_name(test.full_name)
+        with self.mutex:
+            self.running_tests.pop(name, None)
+            message = self.timeout_messages.pop(name, None)
+
+        if message is None:
+            return [test]
+
+        return [TestOutput(test.full_name, f'\n{message}\n'),
+                FinishedTest(test.full_name, TestStatus.CRASHED, message=message)]
+
+    def notify_test_started(self, test: StartedTest):
+        self.watch_test_started(test)
+        self.test_data.notify_test_started(test)
+
+    def notify_test_output(self, test: TestOutput):
+        self.test_data.notify_test_output(test)
+
+    def notify_test_finished(self, test: FinishedTest):
+        self.test_data.notify_test_events(self.watch_test_finished(test))
+
+    def notify_test_events(self, events: List[TestEvent]):
+        forwarded: List[TestEvent] = []
+        for event in events:
+            if isinstance(event, StartedTest):
+                self.watch_test_started(event)
+                forwarded.append(event)
+            elif isinstance(event, FinishedTest):
+                forwarded += self.watch_test_finished(event)
+            else:
+                forwarded.append(event)
+
+        self.test_data.notify_test_events(forwarded)
+
+    # Stop token interface, for the process runner.
+
+    def is_set(self):
+        return self.stop_token.is_set() or self.check_timeouts()
+
+    def wait(self, timeout: Optional[float] = None):
+        if self.stop_token.wait(timeout):
+            return True
+
+        return self.check_timeouts()
+
+    def check_timeouts(self):
+        with self.mutex:
+            if self.timed_out:
+                return True
+
+            now = time.time()
+
+            if self.test_timeout is not None:
+                for name, start in self.running_tests.items():
+                    if now - start > self.test_timeout:
+                        self.timeout_messages[name] = TEST_TIMEOUT_MESSAGE.format(timeout=self.test_timeout)
+                        self.timed_out = True
+
+            if self.process_timeout is not None and now - self.start_time > self.process_timeout:
+                for name in self.running_tests:
+                    self.timeout_messages.setdefault(name, PROCESS_TIMEOUT_MESSAGE.format(
+                        timeout=self.process_timeout))
+                self.timed_out = True
+
+            if self.timed_out:
+                logger.warning('test process timed out; running tests: ' + ', '.join(self.running_tests))
+
+            return self.timed_out
+
+    def close(self):
+        """
+        Finish the tests that timed out but were not finished by the parser, so their
+        timeout message is recorded.
+        """
+        with self.mutex:
+            names = list(self.timeout_messages.keys())
+
+        for name in names:
+            self.notify_test_finished(FinishedTest(test_name_to_path(name), TestStatus.CRASHED))
+
+    def get_started_run_ids(self) -> Set[str]:
+        run_ids = set()
+        with self.mutex:
+            for name in self.started_tests:
+                item = self.test_list.find_test(test_name_to_path(name))
+                if item is not None:
+                    run_ids.add(item.run_id)
+
+        return run_ids
+
+
+def get_run_ids(test_data: TestData, suite_id: str) -> Dict[str, Set[str]]:
+    """
+    Return the run IDs of all the known tests of the suite, for each executable.
+    """
+    run_ids: Dict[str, Set[str]] = {}
+    for test in test_data.get_test_list().tests():
+        if test.suite_id == suite_id and test.location is not None:
+            run_ids.setdefault(test.location.executable, set()).add(test.run_id)
+
+    return run_ids
+
+
+def minimize_filters(test_ids: List[str], available: Set[str],
+                     get_group: Optional[Callable[[str], Optional[str]]] = None,
+                     make_group_filter: Callable[[str], str] = lambda g: g) -> Optional[List[str]]:
+    """
+    Replace the selected test IDs by as few filters as possible. Returns None if all the
+    'available' tests (of the executable) are selected, so no filter is needed. Otherwise, if
+    'get_group' is given, the tests of each group (e.g., a fixture) that is fully selected are
+    replaced by a single filter for the group, made with 'make_group_filter'.
+    """
+    selected = set(test_ids)
+    if len(available) > 0 and selected.issuperset(available):
+        return None
+
+    if get_group is None:
+        return test_ids
+
+    groups: Dict[str, List[str]] = {}
+    for test in available:
+        group = get_group(test)
+        if group is not None:
+            groups.setdefault(group, []).append(test)
+
+    complete = set(g for g, tests in groups.items() if len(tests) > 1 and selected.issuperset(tests))
+    if len(complete) == 0:
+        return test_ids
+
+    filters = []
+    added: Set[str] = set()
+    for test in test_ids:
+        group = get_group(test)
+        if group not in complete:
+            filters.append(test)
+        elif group not in added:
+            added.add(group)
+            filters.append(make_group_filter(group))
+
+    return filters
+
+
+def make_batches(test_ids: List[str], fixed_args: List[str], transport: Optional[Transport],
+                 single_argument=False, escape: Callable[[str], str] = lambda t: t) -> List[List[str]]:
+    """
+    Split the tests into consecutive batches, so that each batch fits on the command line of a
+    single process. The command is made of 'fixed_args' followed by the (escaped) test IDs,
+    either as separate arguments, or joined in a 'single_argument' with one-character separators.
+    """
+    limit = MAX_COMMAND_LINE_LENGTH
+    overhead = 1
+    if isinstance(transport, CommandPrefixTransport):
+        # The whole command is quoted into a single argument of the wrapper command.
+        limit = min(limit, MAX_ARGUMENT_LENGTH)
+        overhead = 1 if single_argument else 3
+    elif single_argument:
+        limit = min(limit, MAX_ARGUMENT_LENGTH)
+
+    budget = limit - sum(len(a.encode('utf-8')) + 1 for a in fixed_args) - COMMAND_LINE_MARGIN
+
+    batches: List[List[str]] = []
+    batch: List[str] = []
+    length = 0
+    for test in test_ids:
+        test_length = len(escape(test).encode('utf-8')) + overhead
+        if len(batch) > 0 and length + test_length > budget:
+            batches.append(batch)
+            batch = []
+            length = 0
+
+        batch.append(test)
+        length += test_length
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+
+def run_with_watchdog(framework, executable: str, test_ids: List[str], run_tests: Callable,
+                      queue: str = 'default', transport: Optional[Transport] = None):
+    """
+    Run the tests with 'run_tests(executable, test_ids, watchdog)', under a ProcessWatchdog
+    configured from the suite's timeouts, and the given work queue and transport. If the process
+    is killed because of a timeout, the executable is launched again for the tests which have not
+    started yet. If the tests do not fit on a single command line (see the framework's
+    'get_batches()'), they are run in several consecutive processes. 'run_tests' returns the
+    ResourceUsage of the process(es) it launched; the total is reported to the TestData.
+    """
+    test_data = framework.test_data
+    test_list = test_data.get_test_list()
+    usage = ResourceUsage(suite_id=framework.suite.suite_id, executable=executable)
+
+    batches = framework.get_batches(executable, test_ids, transport)
+    if len(batches) > 1:
+        logger.info(f'{executable}: running {len(test_ids)} tests in {len(batches)} batches')
+
+    for batch in batches:
+        if test_data.stop_tests_event.is_set():
+            break
+
+        remaining = batch
+        while len(remaining) > 0:
+            watchdog = ProcessWatchdog(test_data, test_list,
+                                       test_timeout=framework.suite.test_timeout,
+                                       process_timeout=framework.suite.process_timeout,
+                                       queue=queue, transport=transport)
+            process_usage = run_tests(executable, remaining, watchdog)
+            watchdog.close()
+
+            if process_usage is not None:
+                usage.add(process_usage)
+
+            if not watchdog.timed_out or test_data.stop_tests_event.is_set():
+                break
+
+            started = watchdog.get_started_run_ids()
+            not_started = [t for t in remaining if t not in started]
+            if len(not_started) == len(remaining):
+                logger.warning(f'{executable} timed out before starting any test; not relaunching')
+                break
+
+            logger.warning(f'relaunching {executable} for {len(not_started)} remaining tests')
+            remaining = not_started
+
+    if usage.processes > 0:
+        test_data.notify_process_finished(usage)
+
+
 def make_header(text, length=64, pattern='='):
     remaining = max(0, length - len(text) - 2)
     return f"{pattern*(remaining//2)} {text} {pattern*(remaining - remaining//2)}"
@@ -101,57 +671,108 @@ class XmlParser(ABC):
 
 xml_parser_logger = logging.getLogger('TestManagerParser.xml-base')
 
+# Character data is reported in pieces of at most this size.
+XML_BUFFER_SIZE = 64*1024
+
+
+def clean_xml_content(content: str):
+    """
+    Remove the line jump after the opening tag, and the indentation before the closing tag.
+    """
+    if content.startswith('\n'):
+        content = content[1:]
+
+    last_line = content.rfind('\n') + 1
+    if len(content[last_line:].strip()) == 0:
+        content = content[:last_line]
+
+    return content
+
+
+class XmlStreamParser:
+    """
+    Incremental XML parser (expat), to which the output can be fed in chunks of any size.
+    Content of non-captured elements is forwarded to 'XmlParser.output()' as it comes.
+    """
 
-class XmlStreamHandler(xml.sax.handler.ContentHandler):
     def __init__(self, parser: XmlParser, captured_elements: List[str] = []):
         self.parser = parser
-        self.captured_elements = captured_elements
+        self.captured_elements = set(captured_elements)
+        self.debug = xml_parser_logger.isEnabledFor(logging.DEBUG)
 
         self.current_element: List[str] = []
-        self.content = {}
+        self.content: List[List[str]] = []
+        self.segment_start = True
 
-    def clean_xml_content(self, content, tag):
-        # Remove first and last entry; will be line jump and indentation whitespace, ignored.
-        if not tag in content:
-            return ''
+        self.expat = xml.parsers.expat.ParserCreate()
+        self.expat.buffer_text = True
+        self.expat.buffer_size = XML_BUFFER_SIZE
+        self.expat.StartElementHandler = self.startElement
+        self.expat.EndElementHandler = self.endElement
+        self.expat.CharacterDataHandler = self.characters
 
-        returned_content = content[tag]
-        del content[tag]
+    def feed(self, data: str):
+        self.expat.Parse(data, False)
+        self.flush_output(final=False)
 
-        if len(returned_content) <= 2:
-            return ''
+    def close(self):
+        self.expat.Parse('', True)
 
-        return ''.join(returned_content[1:-1])
+    def flush_output(self, final: bool):
+        """
+        Forward the content of the current element if it is not captured. Unless 'final' (i.e.,
+        the element is closed or a child element is opened), output stops at the last line jump.
+        """
+        if len(self.current_element) == 0 or self.current_element[-1] in self.captured_elements:
+            return
+
+        content = ''.join(self.content[-1])
+        if len(content) == 0:
+            return
+
+        if self.segment_start:
+            self.segment_start = False
+            if content.startswith('\n'):
+                content = content[1:]
+
+        if final:
+            content = clean_xml_content(content)
+            self.content[-1] = []
+            self.segment_start = True
+        else:
+            last_line = content.rfind('\n') + 1
+            self.content[-1] = [content[last_line:]]
+            content = content[:last_line]
+
+        if len(content) > 0:
+            self.parser.output(content)
 
     def startElement(self, name, attrs):
-        if len(self.current_element) > 0 and self.current_element[-1] not in self.captured_elements:
-            content = self.clean_xml_content(self.content, self.current_element[-1])
-            self.parser.output(content)
+        if self.debug:
+            attrs_str = ', '.join(['"{}": "{}"'.format(k, v) for k, v in attrs.items()])
+            xml_parser_logger.debug('startElement(' + name + ', ' + attrs_str + ')')
 
-        attrs_str = ', '.join(['"{}": "{}"'.format(k, v) for k, v in attrs.items()])
-        xml_parser_logger.debug('startElement(' + name + ', ' + attrs_str + ')')
+        self.flush_output(final=True)
         self.current_element.append(name)
+        self.content.append([])
+        self.segment_start = True
 
         self.parser.startElement(name, attrs)
 
     def endElement(self, name):
-        if name not in self.captured_elements:
-            content = self.clean_xml_content(self.content, name)
-            self.parser.output(content)
+        if self.debug:
+            xml_parser_logger.debug('endElement(' + name + ')')
 
-        xml_parser_logger.debug('endElement(' + name + ')')
+        self.flush_output(final=True)
         self.current_element.pop()
+        content = ''.join(self.content.pop())
+        self.segment_start = True
 
-        self.parser.endElement(name, self.clean_xml_content(self.content, name))
+        self.parser.endElement(name, clean_xml_content(content) if name in self.captured_elements else '')
 
     def characters(self, content):
-        xml_parser_logger.debug('characters(' + content + ')')
+        if self.debug:
+            xml_parser_logger.debug('characters(' + content + ')')
+
         if len(self.current_element) > 0:
-            self.content.setdefault(self.current_element[-1], []).append(content)
-
-            if self.current_element[-1] not in self.captured_elements:
-                content = self.content[self.current_element[-1]]
-                if len(content) > 1 and len(content[-1].strip()) > 0:
-                    output_content = ''.join(content[1:])
-                    del content[1:]
-                    self.parser.output(output_content)
+            self.content[-1].append(content)
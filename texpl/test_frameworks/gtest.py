@@ -6,67 +6,63 @@ from tempfile import TemporaryDirectory
 
 from ..test_framework import (TestFramework, register_framework)
 from ..test_suite import TestSuite
-from ..test_data import (DiscoveredTest, DiscoveryError, TestLocation, TestData,
-                         StartedTest, FinishedTest, TEST_SEPARATOR, TestStatus, TestOutput)
+from ..test_data import (DiscoveredTest, DiscoveryError, DiscoveryScope, TestLocation, TestData, TestItem,
+                         TestEventBuffer, RunningTests, TEST_SEPARATOR, TestStatus)
 from .. import process
-from . import common
+from . import common, scheduler
 
 logger = logging.getLogger('TestManager.gtest')
 parser_logger = logging.getLogger('TestManagerParser.gtest')
 
 
+GTEST_RUN_TAG = '[ RUN      ] '
+GTEST_STATUS_TAGS = {
+    '[       OK ] ': TestStatus.PASSED,
+    '[  FAILED  ] ': TestStatus.FAILED,
+    '[  SKIPPED ] ': TestStatus.SKIPPED
+}
+
+
 class OutputParser:
     def __init__(self, test_data: TestData, suite_id: str, executable: str):
-        self.test_data = test_data
+        self.test_data = TestEventBuffer(test_data)
         self.test_list = test_data.get_test_list()
         self.suite_id = suite_id
         self.executable = executable
-        self.current_test: Optional[List[str]] = None
+        self.running = RunningTests(self.test_data)
 
     def parse_test_id(self, line: str):
         return line[12:].strip().split(' ')[0]
 
-    def finish_current_test(self):
-        if self.current_test is not None:
-            self.test_data.notify_test_finished(FinishedTest(self.current_test, TestStatus.CRASHED))
-            self.current_test = None
-
     def close(self):
-        self.finish_current_test()
-
-    def feed(self, line: str):
-        parser_logger.debug(line.rstrip())
+        self.running.finish_all()
+        self.test_data.flush()
 
-        if line.startswith('[ RUN      ] '):
-            self.finish_current_test()
-            self.current_test = self.test_list.find_test_by_report_id(
-                self.suite_id, self.executable, self.parse_test_id(line))
-            if self.current_test is None:
-                return
+    def feed(self, output: str):
+        # Output comes in chunks of whole lines; test events are sent in one batch per chunk.
+        for line in process.split_lines(output):
+            self.feed_line(line)
 
-            self.test_data.notify_test_started(StartedTest(self.current_test))
+        self.test_data.flush()
 
-        if self.current_test:
-            self.test_data.notify_test_output(TestOutput(self.current_test, line))
-
-        if line.startswith('[       OK ] '):
-            if self.current_test is None:
-                return
-
-            self.test_data.notify_test_finished(FinishedTest(self.current_test, TestStatus.PASSED))
-            self.current_test = None
-        elif line.startswith('[  FAILED  ] '):
-            if self.current_test is None:
-                return
+    def feed_line(self, line: str):
+        parser_logger.debug(line.rstrip())
 
-            self.test_data.notify_test_finished(FinishedTest(self.current_test, TestStatus.FAILED))
-            self.current_test = None
-        elif line.startswith('[  SKIPPED ] '):
-            if self.current_test is None:
-                return
+        tag = line[:len(GTEST_RUN_TAG)]
+        if tag == GTEST_RUN_TAG:
+            test_id = self.parse_test_id(line)
+            test = self.test_list.find_test_by_report_id(self.suite_id, self.executable, test_id)
+            if test is not None:
+                self.running.start(test_id, test)
 
-            self.test_data.notify_test_finished(FinishedTest(self.current_test, TestStatus.SKIPPED))
-            self.current_test = None
+            self.running.output(test_id, line)
+        elif tag in GTEST_STATUS_TAGS:
+            # Also matches the final summary, for tests that are already finished (ignored).
+            test_id = self.parse_test_id(line)
+            self.running.output(test_id, line)
+            self.running.finish(test_id, GTEST_STATUS_TAGS[tag])
+        else:
+            self.running.output(None, line)
 
 
 class GoogleTest(TestFramework):
@@ -78,7 +74,9 @@ class GoogleTest(TestFramework):
                  args: List[str] = [],
                  discover_args: List[str] = [],
                  run_args: List[str] = [],
-                 parser: str = 'default'):
+                 parser: str = 'default',
+                 discovery_cache: bool = True,
+                 executable_ignore: List[str] = ['CMakeFiles']):
         super().__init__(suite)
         self.executable_pattern = executable_pattern
         self.env = env
@@ -87,6 +85,8 @@ class GoogleTest(TestFramework):
         self.discover_args = discover_args
         self.run_args = run_args
         self.parser = parser
+        self.discovery_cache = discovery_cache
+        self.executable_ignore = executable_ignore
 
     @staticmethod
     def get_default_settings():
@@ -97,7 +97,9 @@ class GoogleTest(TestFramework):
             'args': [],
             'discover_args': ['--gtest_list_tests'],
             'run_args': [],
-            'parser': 'default'
+            'parser': 'default',
+            'discovery_cache': True,
+            'executable_ignore': ['CMakeFiles']
         }
 
     @staticmethod
@@ -110,9 +112,24 @@ class GoogleTest(TestFramework):
                           args=settings['args'],
                           discover_args=settings['discover_args'],
                           run_args=settings['run_args'],
-                          parser=settings['parser'])
+                          parser=settings['parser'],
+                          discovery_cache=settings['discovery_cache'],
+                          executable_ignore=settings['executable_ignore'])
+
+    def get_watched_paths(self) -> List[str]:
+        return [common.get_executable_directory(self.executable_pattern, self.project_root_dir)]
 
-    def discover(self) -> List[DiscoveredTest]:
+    def get_changed_scope(self, changed_files: List[str]) -> Optional[DiscoveryScope]:
+        return common.get_changed_executables_scope(self, self.executable_pattern, changed_files)
+
+    def get_scope(self, tests: List[TestItem]) -> DiscoveryScope:
+        return common.get_executables_scope(self, tests)
+
+    def get_result_cache_key(self, executable: str) -> Optional[str]:
+        cwd = common.get_working_directory(user_cwd=self.cwd, project_root_dir=self.project_root_dir)
+        return common.get_result_cache_key(self, executable, json.dumps([self.run_args + self.args, self.env, cwd]))
+
+    def discover(self, scope: Optional[DiscoveryScope] = None) -> List[DiscoveredTest]:
         cwd = common.get_working_directory(user_cwd=self.cwd, project_root_dir=self.project_root_dir)
 
         errors = []
@@ -128,15 +145,18 @@ class GoogleTest(TestFramework):
                     return self.parse_discovery(output_file, executable)
                 except DiscoveryError as e:
                     errors.append(e.details if e.details else str(e))
-                    return []
+                    return None
 
-            executables = common.discover_executables(self.executable_pattern, cwd=self.project_root_dir)
+            executables = common.discover_executables(self.executable_pattern, cwd=self.project_root_dir,
+                                                      scope=scope, ignored=self.executable_ignore)
             if len(executables) == 0:
                 logger.warning(f'no executable found with pattern "{self.executable_pattern}" ' +
                                f'(cwd: {self.project_root_dir})')
 
+            discovery_key = json.dumps([self.discover_args + self.args, self.env, cwd,
+                                         self.suite.custom_prefix, self.suite.path_prefix_style])
             for executable in executables:
-                tests += run_discovery(executable)
+                tests += common.discover_cached(self, executable, discovery_key, run_discovery)
 
         if errors:
             raise DiscoveryError('Error when discovering tests. See panel for more information', details=errors)
@@ -184,32 +204,52 @@ class GoogleTest(TestFramework):
 
         return tests
 
+    def get_filters(self, executable: str, test_ids: List[str]) -> Optional[List[str]]:
+        # Fully selected test suites (fixtures) are run with 'Suite.*'.
+        return common.minimize_filters(test_ids, self.run_ids.get(executable, set()),
+                                       get_group=lambda t: t.split('.', 1)[0],
+                                       make_group_filter=lambda g: g + '.*')
+
+    def get_batches(self, executable: str, test_ids: List[str], transport) -> List[List[str]]:
+        exe = common.make_executable_path(executable, project_root_dir=self.project_root_dir)
+        fixed_args = [exe] + self.run_args + self.args + ['--gtest_filter=']
+        filters = self.get_filters(executable, test_ids)
+        if filters is None or len(common.make_batches(filters, fixed_args, transport, single_argument=True)) == 1:
+            return [test_ids]
+
+        return common.make_batches(test_ids, fixed_args, transport, single_argument=True)
+
     def run(self, grouped_tests: Dict[str, List[str]]) -> None:
         cwd = common.get_working_directory(user_cwd=self.cwd, project_root_dir=self.project_root_dir)
+        self.run_ids = common.get_run_ids(self.test_data, self.suite.suite_id)
 
-        def run_tests(executable, test_ids):
+        def run_tests(executable, test_ids, watchdog):
             logger.debug('starting tests from {}: "{}"'.format(executable, '" "'.join(test_ids)))
 
-            test_filters = ':'.join(test_ids)
+            test_filters = self.get_filters(executable, test_ids)
             exe = common.make_executable_path(executable, project_root_dir=self.project_root_dir)
 
             parser = common.get_generic_parser(parser=self.parser,
-                                               test_data=self.test_data,
+                                               test_data=watchdog,
                                                suite_id=self.suite.suite_id,
                                                executable=executable)
 
             if parser is None:
-                parser = OutputParser(self.test_data, self.suite.suite_id, executable)
+                parser = OutputParser(watchdog, self.suite.suite_id, executable)
+
+            run_args = [exe] + self.run_args + self.args
+            if test_filters is not None:
+                run_args += ['--gtest_filter=' + ':'.join(test_filters)]
 
-            run_args = [exe] + self.run_args + self.args + ['--gtest_filter=' + test_filters]
-            process.get_output_streamed(run_args,
-                                        parser.feed, self.test_data.stop_tests_event,
-                                        queue='gtest', ignore_errors=True, env=self.env, cwd=cwd)
+            usage = process.get_output_streamed(run_args,
+                                                parser.feed, watchdog,
+                                                queue=watchdog.queue, transport=watchdog.transport,
+                                                ignore_errors=True, env=self.env, cwd=cwd, chunked=True)
 
             parser.close()
+            return usage
 
-        for executable, test_ids in grouped_tests.items():
-            run_tests(executable, test_ids)
+        scheduler.run_grouped_tests(self, grouped_tests, run_tests, queue='gtest')
 
 
 register_framework('gtest', 'GoogleTest (C++)', GoogleTest.from_json, GoogleTest.get_default_settings())
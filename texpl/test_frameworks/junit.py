@@ -0,0 +1,265 @@
+import os
+import glob
+import time
+import logging
+from xml.etree import ElementTree
+from typing import Dict, Iterator, List, Optional, Union
+
+from ..test_framework import (TestFramework, register_framework)
+from ..test_suite import TestSuite
+from ..errors import FrameworkError
+from ..test_data import (DiscoveredTest, DiscoveryScope, TestLocation, TestEventBuffer, TEST_SEPARATOR,
+                         StartedTest, TestOutput, FinishedTest, TestStatus)
+from .. import process
+from . import common, scheduler
+
+logger = logging.getLogger('TestManager.junit')
+parser_logger = logging.getLogger('TestManagerParser.junit')
+
+# Number of test cases read from a report before their results are sent to the TestData.
+JUNIT_EVENT_BATCH_SIZE = 1000
+
+JUNIT_STATUS_MAP = {
+    'failure': TestStatus.FAILED,
+    'error': TestStatus.FAILED,
+    'skipped': TestStatus.SKIPPED
+}
+
+
+class JUnitTestCase:
+    def __init__(self, classname: str, name: str, file: str, line: int, duration: Optional[float],
+                 status: TestStatus, output: str):
+        self.classname = classname
+        self.name = name
+        self.file = file
+        self.line = line
+        self.duration = duration  # seconds
+        self.status = status
+        self.output = output
+
+    def get_report_id(self):
+        return f'{self.classname}.{self.name}' if len(self.classname) > 0 else self.name
+
+
+def parse_testcase(element: ElementTree.Element) -> JUnitTestCase:
+    status = TestStatus.PASSED
+    output = []
+    for child in element:
+        if child.tag in JUNIT_STATUS_MAP:
+            status = JUNIT_STATUS_MAP[child.tag] if status == TestStatus.PASSED else status
+            header = child.tag.upper() + (f": {child.attrib['message']}" if 'message' in child.attrib else '')
+            output.append(f'{common.make_header(header)}\n{child.text or ""}\n')
+        elif child.tag in ['system-out', 'system-err'] and child.text:
+            output.append(f'{common.make_header(child.tag.upper())}\n{child.text}\n')
+
+    try:
+        duration = float(element.attrib['time'])
+    except (KeyError, ValueError):
+        duration = None
+
+    try:
+        line = int(element.attrib.get('line', 0))
+    except ValueError:
+        line = 0
+
+    return JUnitTestCase(classname=element.attrib.get('classname', ''), name=element.attrib.get('name', ''),
+                         file=element.attrib.get('file', ''), line=line, duration=duration, status=status,
+                         output='\n'.join(output))
+
+
+def read_report(path: str) -> Iterator[JUnitTestCase]:
+    """
+    Read the test cases of a JUnit XML report as a stream. Elements are dropped as soon as they
+    are read, so memory use does not grow with the size of the report.
+    """
+    parents: List[ElementTree.Element] = []
+    for event, element in ElementTree.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+
+        parents.pop()
+        if element.tag == 'testcase':
+            yield parse_testcase(element)
+
+        # Children of a test case are needed until the test case ends.
+        if len(parents) > 0 and parents[-1].tag != 'testcase':
+            element.clear()
+            parents[-1].remove(element)
+
+
+def read_reports(paths: List[str]) -> Iterator[JUnitTestCase]:
+    for path in paths:
+        try:
+            yield from read_report(path)
+        except (OSError, ElementTree.ParseError) as e:
+            logger.error(f'could not read JUnit report {path}: {e}')
+
+
+class JUnit(TestFramework):
+    def __init__(self,
+                 suite: TestSuite,
+                 command: Union[str, List[str]] = [],
+                 discover_command: Union[None, str, List[str]] = None,
+                 report: str = 'junit.xml',
+                 env: Dict[str, str] = {},
+                 cwd: Optional[str] = None,
+                 args: List[str] = [],
+                 discover_args: List[str] = [],
+                 run_args: List[str] = []):
+        super().__init__(suite)
+        self.command = command
+        self.discover_command = discover_command
+        self.report = report
+        self.env = env
+        self.cwd = cwd
+        self.args = args
+        self.discover_args = discover_args
+        self.run_args = run_args
+
+    @staticmethod
+    def get_default_settings():
+        return {
+            'command': [],
+            'discover_command': None,
+            'report': 'junit.xml',
+            'env': {},
+            'cwd': None,
+            'args': [],
+            'discover_args': [],
+            'run_args': []
+        }
+
+    @staticmethod
+    def from_json(suite: TestSuite, settings: Dict):
+        assert settings['type'] == 'junit'
+        if len(settings['command']) == 0:
+            raise FrameworkError('Missing "command" in JUnit suite definition.')
+
+        return JUnit(suite=suite,
+                     command=settings['command'],
+                     discover_command=settings['discover_command'],
+                     report=settings['report'],
+                     env=settings['env'],
+                     cwd=settings['cwd'],
+                     args=settings['args'],
+                     discover_args=settings['discover_args'],
+                     run_args=settings['run_args'])
+
+    def get_command(self, command: Union[str, List[str]]):
+        if isinstance(command, list):
+            return command
+
+        if not os.path.isabs(command) and len(os.path.dirname(command)) > 0:
+            return [os.path.join(self.project_root_dir, command)]
+
+        return [command]
+
+    def get_reports(self, cwd: str, since: Optional[float] = None) -> List[str]:
+        """
+        Report files matching the 'report' pattern; if 'since' is given, only those written after
+        that time (so a report left by an earlier run is not mistaken for a new one).
+        """
+        paths = []
+        for path in sorted(glob.glob(os.path.join(cwd, self.report), recursive=True)):
+            try:
+                if since is None or os.stat(path).st_mtime >= since:
+                    paths.append(path)
+            except OSError:
+                pass
+
+        return paths
+
+    def discover(self, scope: Optional[DiscoveryScope] = None) -> List[DiscoveredTest]:
+        cwd = common.get_working_directory(user_cwd=self.cwd, project_root_dir=self.project_root_dir)
+
+        command = self.command if self.discover_command is None else self.discover_command
+        if len(command) > 0:
+            discover_args = self.get_command(command) + self.discover_args + self.args
+            process.get_output(discover_args, ignore_errors=True, env=self.env, cwd=cwd)
+
+        tests = []
+        run_ids = set()
+        for testcase in read_reports(self.get_reports(cwd)):
+            test = self.parse_discovered_test(testcase, cwd)
+            if test.run_id not in run_ids:
+                run_ids.add(test.run_id)
+                tests.append(test)
+
+        return tests
+
+    def parse_discovered_test(self, testcase: JUnitTestCase, working_directory: str):
+        path = []
+
+        if self.suite.custom_prefix is not None:
+            path += self.suite.custom_prefix.split(TEST_SEPARATOR)
+
+        if len(testcase.classname) > 0:
+            path += testcase.classname.split('.')
+
+        path += [testcase.name]
+
+        # Reports give paths relative to the working directory, or absolute; make them relative to
+        # the project directory.
+        file = testcase.file
+        if len(file) > 0:
+            file = os.path.relpath(os.path.join(working_directory, file), start=self.project_root_dir)
+
+        run_id = testcase.get_report_id()
+
+        return DiscoveredTest(
+            full_name=path, suite_id=self.suite.suite_id, run_id=run_id, report_id=run_id,
+            location=TestLocation(executable='junit', file=file, line=testcase.line))
+
+    def report_results(self, paths: List[str], test_ids: List[str], watchdog):
+        test_data = TestEventBuffer(watchdog)
+        test_list = watchdog.get_test_list()
+        selected = set(test_ids)
+
+        count = 0
+        for testcase in read_reports(paths):
+            report_id = testcase.get_report_id()
+            if report_id not in selected:
+                continue
+
+            test = test_list.find_test_by_report_id(self.suite.suite_id, 'junit', report_id)
+            if test is None:
+                parser_logger.debug(f'unknown test: {report_id}')
+                continue
+
+            test_data.notify_test_started(StartedTest(test))
+            if len(testcase.output) > 0:
+                test_data.notify_test_output(TestOutput(test, testcase.output))
+            test_data.notify_test_finished(FinishedTest(test, testcase.status, duration=testcase.duration))
+
+            count += 1
+            if count % JUNIT_EVENT_BATCH_SIZE == 0:
+                test_data.flush()
+
+        test_data.flush()
+        logger.info(f'read {count} test results from {len(paths)} reports')
+
+    def run(self, grouped_tests: Dict[str, List[str]]) -> None:
+        cwd = common.get_working_directory(user_cwd=self.cwd, project_root_dir=self.project_root_dir)
+
+        test_ids = [test for tests in grouped_tests.values() for test in tests]
+
+        def run_tests(executable, test_ids, watchdog):
+            # The command cannot select tests; it runs them all, and only the selected ones are reported.
+            start = time.time()
+            run_args = self.get_command(self.command) + self.run_args + self.args
+            usage = process.get_output_streamed(run_args,
+                                                lambda output: parser_logger.debug(output.rstrip()), watchdog,
+                                                queue=watchdog.queue, transport=watchdog.transport,
+                                                ignore_errors=True, env=self.env, cwd=cwd, chunked=True)
+
+            if not watchdog.is_set():
+                # Allow for file systems with a coarse modification time.
+                self.report_results(self.get_reports(cwd, since=start - 2), test_ids, watchdog)
+
+            return usage
+
+        scheduler.run_jobs(self, [('junit', test_ids)], run_tests, queue='junit')
+
+
+register_framework('junit', 'Any command writing a JUnit XML report', JUnit.from_json, JUnit.get_default_settings())
@@ -1,15 +1,14 @@
 import os
 import logging
-import re
 from xml.etree import ElementTree
 from typing import Dict, List, Optional, Union
 from tempfile import TemporaryDirectory
 
 from ..test_framework import (TestFramework, register_framework)
 from ..test_suite import TestSuite
-from ..test_data import (TestData, DiscoveredTest, TestLocation, TEST_SEPARATOR)
+from ..test_data import (TestData, DiscoveredTest, DiscoveryScope, TestLocation, TEST_SEPARATOR, ResourceUsage)
 from .. import process
-from . import common, teamcity
+from . import common, scheduler, teamcity
 
 logger = logging.getLogger('TestManager.phpunit')
 parser_logger = logging.getLogger('TestManagerParser.phpunit')
@@ -17,23 +16,23 @@ parser_logger = logging.getLogger('TestManagerParser.phpunit')
 class OutputParser(teamcity.OutputParser):
     def __init__(self, test_data: TestData, suite_id: str, executable: str):
         super().__init__(test_data, suite_id, executable)
-        self.current_suite = None
-
-    def parse_name(self, line: str):
-        return re.search("name='([^']+)'", line).group(1)
-
-    def parse_test_id(self, line: str):
-        if self.current_suite is None:
-            return self.parse_name(line)
+        # Current test suite, by flow ID.
+        self.current_suites: Dict[str, str] = {}
+
+    def get_test_id(self, attributes: Dict[str, str]) -> Optional[str]:
+        name = attributes.get('name', None)
+        suite = self.current_suites.get(attributes.get('flowId', ''), None)
+        if name is None or suite is None:
+            return name
         else:
-            return f'{self.current_suite}::{self.parse_name(line)}'
+            return f'{suite}::{name}'
 
-    def feed(self, line: str):
-        super().feed(line)
+    def feed_message(self, name: str, attributes: Dict[str, str]):
+        super().feed_message(name, attributes)
 
-        if line.startswith('##teamcity[testSuiteStarted'):
-            self.current_suite = self.parse_name(line)
-            parser_logger.error(self.current_suite)
+        if name == 'testSuiteStarted' and 'name' in attributes:
+            self.current_suites[attributes.get('flowId', '')] = attributes['name']
+            parser_logger.debug(attributes['name'])
 
 
 class PHPUnit(TestFramework):
@@ -88,7 +87,11 @@ class PHPUnit(TestFramework):
 
         return [self.phpunit]
 
-    def discover(self) -> List[DiscoveredTest]:
+    def get_changed_scope(self, changed_files: List[str]) -> Optional[DiscoveryScope]:
+        return common.get_changed_sources_scope(self, changed_files, extensions=['.php'],
+                                                file_names=['phpunit.xml', 'phpunit.xml.dist', 'composer.json'])
+
+    def discover(self, scope: Optional[DiscoveryScope] = None) -> List[DiscoveredTest]:
         cwd = common.get_working_directory(user_cwd=self.cwd, project_root_dir=self.project_root_dir)
 
         with TemporaryDirectory() as temp_dir:
@@ -136,22 +139,30 @@ class PHPUnit(TestFramework):
 
         test_ids = [test for tests in grouped_tests.values() for test in tests]
 
-        parser = common.get_generic_parser(parser=self.parser,
-                                           test_data=self.test_data,
-                                           suite_id=self.suite.suite_id,
-                                           executable='phpunit')
+        def run_tests(executable, test_ids, watchdog):
+            parser = common.get_generic_parser(parser=self.parser,
+                                               test_data=watchdog,
+                                               suite_id=self.suite.suite_id,
+                                               executable=executable)
 
-        if parser is None:
-            parser = OutputParser(self.test_data, self.suite.suite_id, 'phpunit')
+            if parser is None:
+                parser = OutputParser(watchdog, self.suite.suite_id, executable)
 
-        # TODO: This is inefficient; how to run more than one test in the same process?
-        for test_id in test_ids:
-            run_args = self.get_phpunit() + self.run_args + self.args + ['--filter', test_id]
-            process.get_output_streamed(run_args,
-                                        parser.feed, self.test_data.stop_tests_event,
-                                        queue='phpunit', ignore_errors=True, env=self.env, cwd=cwd)
+            usage = ResourceUsage(executable=executable)
+            for test_id in test_ids:
+                run_args = self.get_phpunit() + self.run_args + self.args + ['--filter', test_id]
+                usage.add(process.get_output_streamed(run_args,
+                                                      parser.feed, watchdog,
+                                                      queue=watchdog.queue, transport=watchdog.transport,
+                                                      ignore_errors=True, env=self.env, cwd=cwd,
+                                                      chunked=True))
 
-            parser.close()
+                parser.close()
+
+            return usage
+
+        # TODO: This is inefficient; how to run more than one test in the same process?
+        scheduler.run_jobs(self, [('phpunit', [test_id]) for test_id in test_ids], run_tests, queue='phpunit')
 
 
 register_framework('phpunit', 'PHPUnit (PHP) -- experimental', PHPUnit.from_json, PHPUnit.get_default_settings())
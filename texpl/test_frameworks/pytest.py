@@ -1,20 +1,28 @@
 import os
 import json
+import fnmatch
 import logging
+import threading
+from tempfile import TemporaryDirectory
 from typing import Dict, List, Optional
 
 from ..test_framework import (TestFramework, register_framework)
 from ..test_suite import TestSuite
-from ..test_data import (DiscoveredTest, DiscoveryError, TestLocation, TestData,
-                         StartedTest, FinishedTest, TEST_SEPARATOR, TestStatus, TestOutput)
+from ..test_data import (DiscoveredTest, DiscoveryError, DiscoveryScope, TestLocation, TestData, ResourceUsage,
+                         TestCoverage, TestItem,
+                         TestEventBuffer, RunningTests, TEST_SEPARATOR, TestStatus)
+from ..transport import CommandPrefixTransport
 from .. import process
-from . import common
+from . import common, scheduler, pytest_worker
 
 PYTEST_PLUGIN_PATH = 'pytest_plugins'
 PYTEST_PLUGIN = 'sublime_test_runner'
 PYTEST_DISCOVERY_HEADER = 'SUBLIME_DISCOVERY: '
 PYTEST_STATUS_HEADER = 'SUBLIME_STATUS: '
 
+# Default value of pytest's 'python_files' option.
+PYTEST_TEST_FILES = ['test_*.py', '*_test.py']
+
 # Pytest returns 5 if no test was found.
 PYTEST_SUCCESS_CODES = [0, 5]
 
@@ -30,49 +38,53 @@ parser_logger = logging.getLogger('TestManagerParser.pytest')
 
 class OutputParser:
     def __init__(self, test_data: TestData, suite_id: str):
-        self.test_data = test_data
+        self.test_data = TestEventBuffer(test_data)
         self.test_list = test_data.get_test_list()
         self.suite_id = suite_id
-        self.current_test: Optional[List[str]] = None
-        self.current_status: Optional[TestStatus] = None
+        # Tests are tracked by name, so that tests run concurrently (e.g., pytest-xdist) are reported.
+        self.running = RunningTests(self.test_data)
 
-    def finish_current_test(self):
-        if self.current_test is None:
-            return
-        if self.current_status is None:
-            self.current_status = TestStatus.CRASHED
-        self.test_data.notify_test_finished(FinishedTest(self.current_test, self.current_status))
-        self.current_test = None
-        self.current_status = None
-
-    def feed(self, line: str):
-        parser_logger.debug(line.rstrip())
-        if not line.startswith(PYTEST_STATUS_HEADER):
-            return
+    def feed(self, output: str):
+        # Output comes in chunks of whole lines; test events are sent in one batch per chunk.
+        for line in process.split_lines(output):
+            parser_logger.debug(line.rstrip())
+            if line.startswith(PYTEST_STATUS_HEADER):
+                self.feed_event(line[len(PYTEST_STATUS_HEADER):])
 
-        line = line.replace(PYTEST_STATUS_HEADER, '')
-        data = json.loads(line)
+        self.test_data.flush()
 
-        if data['status'] == 'started':
-            self.finish_current_test()
-            self.current_test = self.test_list.find_test_by_report_id(self.suite_id, 'pytest', data['test'])
-            if self.current_test is None:
-                return
+    def feed_events(self, events: str):
+        """
+        Parse a chunk of status events received from the event pipe, one per line.
+        """
+        for event in process.split_lines(events):
+            self.feed_event(event)
 
-            self.test_data.notify_test_started(StartedTest(self.current_test))
+        self.test_data.flush()
+
+    def feed_event(self, event: str):
+        """
+        Parse a status event, received from the event pipe or from stdout.
+        """
+        data = json.loads(event)
+        test_id = data['test']
+
+        if data['status'] == 'started':
+            test = self.test_list.find_test_by_report_id(self.suite_id, 'pytest', test_id)
+            if test is not None:
+                self.running.start(test_id, test)
         elif data['status'] == 'finished':
-            self.finish_current_test()
-        elif data['status'] == 'output':
-            if self.current_test is None:
-                return
-            self.test_data.notify_test_output(TestOutput(self.current_test, data['content']))
+            self.running.finish(test_id, self.running.get_status(test_id, TestStatus.CRASHED))
         else:
-            if self.current_status is None:
-                self.current_status = TestStatus.NOT_RUN
-            self.current_status = TestStatus(max(self.current_status.value, PYTEST_STATUS_MAP[data['status']].value))
+            if len(data.get('content', '')) > 0:
+                self.running.output(test_id, data['content'])
+            self.running.update_status(test_id, PYTEST_STATUS_MAP[data['status']])
 
     def close(self):
-        self.finish_current_test()
+        for test_id in self.running.keys():
+            self.running.finish(test_id, self.running.get_status(test_id, TestStatus.CRASHED))
+
+        self.test_data.flush()
 
 
 def get_os_python_path():
@@ -100,7 +112,10 @@ class PyTest(TestFramework):
                  args: List[str] = [],
                  discover_args: List[str] = [],
                  run_args: List[str] = [],
-                 parser: str = 'default'):
+                 parser: str = 'default',
+                 warm_worker: bool = False,
+                 coverage: bool = False,
+                 args_file: bool = False):
         super().__init__(suite)
         self.python = python
         self.env = env
@@ -109,6 +124,9 @@ class PyTest(TestFramework):
         self.discover_args = discover_args
         self.run_args = run_args
         self.parser = parser
+        self.warm_worker = warm_worker
+        self.coverage = coverage
+        self.args_file = args_file
 
     @staticmethod
     def get_default_settings():
@@ -119,7 +137,10 @@ class PyTest(TestFramework):
             'args': [],
             'discover_args': ['--collect-only'],
             'run_args': [],
-            'parser': 'default'
+            'parser': 'default',
+            'warm_worker': False,
+            'coverage': False,
+            'args_file': False
         }
 
     @staticmethod
@@ -132,7 +153,10 @@ class PyTest(TestFramework):
                       args=settings['args'],
                       discover_args=settings['discover_args'],
                       run_args=settings['run_args'],
-                      parser=settings['parser'])
+                      parser=settings['parser'],
+                      warm_worker=settings['warm_worker'],
+                      coverage=settings['coverage'],
+                      args_file=settings['args_file'])
 
     def get_pytest(self):
         if not os.path.isabs(self.python) and len(os.path.dirname(self.python)) > 0:
@@ -142,6 +166,11 @@ class PyTest(TestFramework):
 
         return [python, '-m', 'pytest']
 
+    def get_worker(self, queue: str, env: Dict[str, str], cwd: str):
+        python = self.get_pytest()[0]
+        command = [python, '-m', pytest_worker.PYTEST_WORKER, self.project_root_dir]
+        return pytest_worker.get_worker(queue, command, cwd, env)
+
     def get_env(self):
         # Default discovery output of pytest does not contain file & line numbers.
         # We can import our own pytest plugin to fill the gap.
@@ -152,12 +181,51 @@ class PyTest(TestFramework):
         env['PYTHONPATH'] = os.pathsep.join(get_os_python_path() + [plugin_path])
         return env
 
-    def discover(self) -> List[DiscoveredTest]:
+    def get_scope(self, tests: List[TestItem]) -> DiscoveryScope:
+        files = set(t.location.file for t in tests if t.location is not None)
+        return DiscoveryScope(self.suite.suite_id, paths=sorted(files))
+
+    def get_changed_scope(self, changed_files: List[str]) -> Optional[DiscoveryScope]:
+        scope = common.get_changed_sources_scope(self, changed_files, extensions=['.py'],
+                                                 file_names=['pytest.ini', 'pyproject.toml', 'setup.cfg', 'tox.ini'])
+        if scope is None:
+            return None
+
+        # Only test modules changed: collecting them is enough. Other modules (conftest,
+        # helpers, code under test) may affect any test.
+        changed = [f for f in changed_files if os.path.splitext(f)[1] == '.py']
+        if all(any(fnmatch.fnmatch(os.path.basename(f), p) for p in PYTEST_TEST_FILES) for f in changed):
+            scope.paths = sorted(os.path.relpath(f, self.project_root_dir) for f in changed)
+
+        return scope
+
+    def discover(self, scope: Optional[DiscoveryScope] = None) -> List[DiscoveredTest]:
         env = self.get_env()
         cwd = common.get_working_directory(user_cwd=self.cwd, project_root_dir=self.project_root_dir)
 
-        discover_args = self.get_pytest() + self.discover_args + self.args
-        output = process.get_output(discover_args, env=env, cwd=cwd, success_codes=PYTEST_SUCCESS_CODES)
+        paths = []
+        if scope is not None and scope.paths is not None:
+            # Only collect the given files and directories.
+            paths = [os.path.join(self.project_root_dir, p) for p in scope.paths]
+            paths = [p for p in paths if os.path.exists(p)]
+            if len(paths) == 0:
+                return []
+
+        if self.warm_worker:
+            lines = []
+            args = self.discover_args + self.args + paths
+            # Same worker as for running the tests of this suite on a single slot (see scheduler.run_jobs()).
+            error_code = self.get_worker(f'pytest:{self.suite.suite_id}', env, cwd).run(args, lines.append,
+                                                                                      threading.Event())
+            output = ''.join(lines)
+            if error_code not in PYTEST_SUCCESS_CODES:
+                command_str = ' '.join(self.get_pytest() + args)
+                raise process.JobError(
+                    f'Error when executing command "{command_str}" (exit code {error_code}):\n\n{output}')
+        else:
+            discover_args = self.get_pytest() + self.discover_args + self.args + paths
+            output = process.get_output(discover_args, env=env, cwd=cwd, success_codes=PYTEST_SUCCESS_CODES)
+
         return self.parse_discovery(output, cwd)
 
     def parse_discovered_test(self, test: Dict, working_directory: str):
@@ -209,27 +277,114 @@ class PyTest(TestFramework):
 
         raise DiscoveryError('Could not find test discovery data; pytest plugin compatibility issue?')
 
+    def read_coverage(self, coverage_file: str, watchdog: common.ProcessWatchdog):
+        if not os.path.exists(coverage_file):
+            logger.warning('no coverage data was recorded; is coverage.py installed?')
+            return
+
+        with open(coverage_file, 'r') as f:
+            data = json.load(f)
+
+        names = {t.run_id: t.full_name for t in watchdog.get_test_list().tests() if t.suite_id == self.suite.suite_id}
+
+        # Tests which did not execute any project file are not listed by the plugin.
+        tests = {names[t]: [] for t in watchdog.get_started_run_ids() if t in names}
+        for test, files in data['tests'].items():
+            if test not in names:
+                continue
+
+            files = [os.path.relpath(f, self.project_root_dir) for f in files]
+            tests[names[test]] = [f for f in files if not f.startswith('..')]
+
+        self.test_data.notify_test_coverage(TestCoverage(tests))
+
+    def use_worker(self, transport):
+        return self.warm_worker and not isinstance(transport, CommandPrefixTransport)
+
+    def use_event_pipe(self, transport, parser):
+        # The pipe is local, so it cannot be used with remote workers.
+        return isinstance(parser, OutputParser) and process.has_event_pipe() and \
+            not isinstance(transport, CommandPrefixTransport)
+
+    def use_args_file(self, transport):
+        # The file is written locally, so it cannot be used with remote workers.
+        return self.args_file and not isinstance(transport, CommandPrefixTransport)
+
+    def get_filters(self, executable: str, test_ids: List[str]) -> List[str]:
+        if len(self.suite.test_ranks) > 0:
+            # Whole files would run in pytest's order rather than the requested one.
+            return test_ids
+
+        # When all the tests are selected, let pytest collect them (no arguments). Fully selected
+        # test modules are run by path.
+        filters = common.minimize_filters(test_ids, self.run_ids.get(executable, set()),
+                                          get_group=lambda t: t.split('::', 1)[0])
+        return filters if filters is not None else []
+
+    def get_batches(self, executable: str, test_ids: List[str], transport) -> List[List[str]]:
+        if self.use_worker(transport) or self.use_args_file(transport):
+            # Arguments are not passed on the command line.
+            return [test_ids]
+
+        fixed_args = self.get_pytest() + self.run_args + self.args
+        if len(common.make_batches(self.get_filters(executable, test_ids), fixed_args, transport)) <= 1:
+            return [test_ids]
+
+        return common.make_batches(test_ids, fixed_args, transport)
+
     def run(self, grouped_tests: Dict[str, List[str]]) -> None:
         env = self.get_env()
         cwd = common.get_working_directory(user_cwd=self.cwd, project_root_dir=self.project_root_dir)
 
         assert len(grouped_tests) == 1
         test_ids = [test for tests in grouped_tests.values() for test in tests]
-
-        parser = common.get_generic_parser(parser=self.parser,
-                                           test_data=self.test_data,
-                                           suite_id=self.suite.suite_id,
-                                           executable='pytest')
-
-        if parser is None:
-            parser = OutputParser(self.test_data, self.suite.suite_id)
-
-        run_args = self.get_pytest() + self.run_args + self.args + test_ids
-        process.get_output_streamed(run_args,
-                                    parser.feed, self.test_data.stop_tests_event,
-                                    queue='pytest', ignore_errors=True, env=env, cwd=cwd)
-
-        parser.close()
+        self.run_ids = common.get_run_ids(self.test_data, self.suite.suite_id)
+
+        def run_tests(executable, test_ids, watchdog):
+            parser = common.get_generic_parser(parser=self.parser,
+                                               test_data=watchdog,
+                                               suite_id=self.suite.suite_id,
+                                               executable=executable)
+
+            if parser is None:
+                parser = OutputParser(watchdog, self.suite.suite_id)
+
+            with TemporaryDirectory() as temp_dir:
+                coverage_file = os.path.join(temp_dir, 'coverage.json')
+                coverage_args = ['--sublime-coverage-map=' + coverage_file] if self.coverage else []
+                args = self.run_args + self.args + coverage_args
+                test_filters = self.get_filters(executable, test_ids)
+
+                if len(test_filters) > 0 and self.use_args_file(watchdog.transport) and \
+                        not self.use_worker(watchdog.transport):
+                    # One argument per line (requires pytest 8.2).
+                    args_file = os.path.join(temp_dir, 'args.txt')
+                    with open(args_file, 'w', encoding='utf-8') as f:
+                        f.write(''.join(test + '\n' for test in test_filters))
+
+                    args += ['@' + args_file]
+                else:
+                    args += test_filters
+
+                if self.use_worker(watchdog.transport):
+                    usage = ResourceUsage(executable=executable)
+                    self.get_worker(watchdog.queue, env, cwd).run(args, parser.feed, watchdog, usage)
+                else:
+                    event_reader = parser.feed_events if self.use_event_pipe(watchdog.transport, parser) else None
+                    usage = process.get_output_streamed(self.get_pytest() + args,
+                                                        parser.feed, watchdog,
+                                                        queue=watchdog.queue, transport=watchdog.transport,
+                                                        ignore_errors=True, env=env, cwd=cwd,
+                                                        chunked=True, event_reader=event_reader)
+
+                parser.close()
+
+                if self.coverage:
+                    self.read_coverage(coverage_file, watchdog)
+
+            return usage
+
+        scheduler.run_grouped_tests(self, {'pytest': test_ids}, run_tests, queue='pytest')
 
 
 register_framework('pytest', 'pytest & unittest (Python)', PyTest.from_json, PyTest.get_default_settings())
@@ -9,6 +9,35 @@ PYTEST_MIN_VERSION = 3
 DISCOVERY_HEADER = 'SUBLIME_DISCOVERY: '
 STATUS_HEADER = 'SUBLIME_STATUS: '
 
+# File descriptor of the pipe to send status events to, if any (see process.py). Otherwise, events
+# are printed to stdout, after STATUS_HEADER.
+EVENTS_FD_VARIABLE = 'SUBLIME_TEST_EVENTS_FD'
+
+
+def open_event_pipe():
+    # Removed from the environment, so processes started by the tests do not write to it.
+    fd = os.environ.pop(EVENTS_FD_VARIABLE, None)
+    if fd is None:
+        return None
+
+    try:
+        return os.fdopen(int(fd), 'w', encoding='utf-8')
+    except (OSError, ValueError):
+        return None
+
+
+event_pipe = open_event_pipe()
+
+
+def send_event(event, flush=False):
+    # Events sent to the pipe are buffered until the next flush (at the start and end of each test).
+    if event_pipe is not None:
+        event_pipe.write(json.dumps(event) + '\n')
+        if flush:
+            event_pipe.flush()
+    else:
+        print('\n' + STATUS_HEADER + json.dumps(event))
+
 
 def get_file(item, config):
     try:
@@ -36,6 +65,75 @@ def make_name(item):
 
 
 collected_errors = []
+coverage_data = None
+session_config = None
+# Test names of the collected items, by node ID.
+test_names = {}
+
+
+def get_test_name(nodeid):
+    name = test_names.get(nodeid, None)
+    if name is not None:
+        return name
+
+    # Not collected by this process (e.g., run by a pytest-xdist worker); node IDs are relative to
+    # the root directory.
+    file, sep, rest = nodeid.partition('::')
+    root = str(getattr(session_config, 'rootpath', os.getcwd()))
+    return os.path.relpath(os.path.join(root, file), start=os.getcwd()) + sep + rest
+
+
+def is_xdist_worker():
+    # Events are reported by the pytest-xdist controller.
+    return hasattr(session_config, 'workerinput')
+
+
+def pytest_addoption(parser):
+    parser.addoption('--sublime-coverage-map', default=None,
+                     help='Record which source files each test executes, and save the result to this JSON file.')
+
+
+def pytest_sessionstart(session):
+    # The same process may run several sessions (see sublime_test_worker).
+    global collected_errors
+    global coverage_data
+    global session_config
+    global test_names
+    collected_errors = []
+    coverage_data = None
+    session_config = session.config
+    test_names = {}
+
+    if session.config.getoption('sublime_coverage_map', None):
+        try:
+            import coverage
+            root = str(getattr(session.config, 'rootpath', os.getcwd()))
+            coverage_data = coverage.Coverage(data_file=None, include=[os.path.join(root, '*')])
+            coverage_data.start()
+        except Exception as e:
+            print(f'\nCould not start coverage.py (version 5.0 or later is required): {e}')
+
+
+def pytest_sessionfinish(session):
+    global coverage_data
+    if coverage_data is None:
+        return
+
+    coverage_data.stop()
+
+    # Source files executed by each test; lines executed outside of a test have an empty context.
+    tests = {}
+    data = coverage_data.get_data()
+    for file in data.measured_files():
+        for contexts in data.contexts_by_lineno(file).values():
+            for context in contexts:
+                if context:
+                    tests.setdefault(context, set()).add(file)
+
+    with open(session.config.getoption('sublime_coverage_map'), 'w') as f:
+        json.dump({'tests': {test: sorted(files) for test, files in tests.items()}}, f)
+
+    coverage_data = None
 
 
 def pytest_collectreport(report):
@@ -50,7 +148,10 @@ def pytest_collection_finish(session):
     global collected_errors
 
     try:
-        tests = [{'name': make_name(item), 'file': get_file(item, session.config),
+        for item in session.items:
+            test_names[item.nodeid] = make_name(item)
+
+        tests = [{'name': test_names[item.nodeid], 'file': get_file(item, session.config),
                   'line': get_line_number(item)} for item in session.items]
     except:
         tests = []
@@ -63,16 +164,23 @@ def pytest_collection_finish(session):
 
 
 @pytest.hookimpl(hookwrapper=True, trylast=True)
-def pytest_report_teststatus(report):
-    print('\n' + STATUS_HEADER + json.dumps({'status': report.outcome}))
+def pytest_runtest_protocol(item):
+    if coverage_data is not None:
+        coverage_data.switch_context(get_test_name(item.nodeid))
     yield
+    if coverage_data is not None:
+        coverage_data.switch_context('')
 
 
-@pytest.hookimpl(hookwrapper=True, trylast=True)
-def pytest_runtest_protocol(item):
-    print('\n' + STATUS_HEADER + json.dumps({'test': make_name(item), 'status': 'started'}))
-    yield
-    print('\n' + STATUS_HEADER + json.dumps({'test': make_name(item), 'status': 'finished'}))
+# Tests are identified by name in all events, so tests may run concurrently.
+def pytest_runtest_logstart(nodeid, location):
+    if not is_xdist_worker():
+        send_event({'test': get_test_name(nodeid), 'status': 'started'}, flush=True)
+
+
+def pytest_runtest_logfinish(nodeid, location):
+    if not is_xdist_worker():
+        send_event({'test': get_test_name(nodeid), 'status': 'finished'}, flush=True)
 
 
 def make_header(text):
@@ -83,22 +191,9 @@ def make_header(text):
 
 @pytest.hookimpl(hookwrapper=True, trylast=True)
 def pytest_runtest_logreport(report):
-    longrepr = report.longreprtext
-    prev = ''
-    if len(longrepr) > 0:
-        print('\n' + STATUS_HEADER + json.dumps({'status': 'output', 'content': f'{make_header("FAILURES")}\n'}))
-        for line in longrepr.split("\n"):
-            print(STATUS_HEADER + json.dumps({'status': 'output', 'content': f'{line}\n'}))
-        prev = '\n\n'
-    stdout = report.capstdout
-    if len(stdout) > 0:
-        print('\n' + STATUS_HEADER + json.dumps({'status': 'output', 'content': f'{prev}{make_header("STDOUT")}\n'}))
-        for line in stdout.split("\n"):
-            print(STATUS_HEADER + json.dumps({'status': 'output', 'content': f'{line}\n'}))
-        prev = '\n\n'
-    stderr = report.capstderr
-    if len(stderr) > 0:
-        print('\n' + STATUS_HEADER + json.dumps({'status': 'output', 'content': f'{prev}{make_header("STDERR")}\n'}))
-        for line in stderr.split("\n"):
-            print(STATUS_HEADER + json.dumps({'status': 'output', 'content': f'{line}\n'}))
+    # One event per report (setup, call, teardown), with the outcome and all the output.
+    if not is_xdist_worker():
+        sections = [('FAILURES', report.longreprtext), ('STDOUT', report.capstdout), ('STDERR', report.capstderr)]
+        content = '\n\n'.join(f'{make_header(name)}\n{text}\n' for name, text in sections if len(text) > 0)
+        send_event({'test': get_test_name(report.nodeid), 'status': report.outcome, 'content': content})
     yield
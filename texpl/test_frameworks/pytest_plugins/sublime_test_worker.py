@@ -0,0 +1,57 @@
+# Long-lived pytest process: the interpreter, pytest, plugins, and the project modules (including
+# conftest) are only loaded once, and each request runs a new pytest session in this process.
+#
+# Requests are read from stdin, one JSON object per line: {"args": [...]}.
+# The pytest output is written to stdout as usual, followed by a single line:
+#   SUBLIME_WORKER_DONE: {"exit_code": N, "modules": {"path": mtime_ns, ...}}
+# where "modules" lists the source files of the project modules loaded so far, so the caller can
+# restart the worker when they change. The worker exits when stdin is closed.
+import sys
+import os
+import json
+
+import pytest
+import sublime_test_runner  # noqa: F401 (loaded once here, rather than on the first request)
+
+DONE_HEADER = 'SUBLIME_WORKER_DONE: '
+
+
+def get_module_files(root):
+    files = {}
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None)
+        if not path:
+            continue
+
+        path = os.path.abspath(path)
+        if not path.startswith(root):
+            continue
+
+        try:
+            files[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            pass
+
+    return files
+
+
+def main():
+    root = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else os.getcwd())
+
+    for line in sys.stdin:
+        if len(line.strip()) == 0:
+            continue
+
+        try:
+            request = json.loads(line)
+            exit_code = int(pytest.main(request['args']))
+        except BaseException as e:
+            print(f'\nError in pytest worker: {e}')
+            exit_code = int(pytest.ExitCode.INTERNAL_ERROR)
+
+        print('\n' + DONE_HEADER + json.dumps({'exit_code': exit_code, 'modules': get_module_files(root)}),
+              flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import logging
+import threading
+import subprocess
+from typing import Callable, Dict, List, Optional
+
+from ..test_data import ResourceUsage
+from ..pipeline import PipelineStage
+from .. import process
+
+PYTEST_WORKER = 'sublime_test_worker'
+PYTEST_WORKER_DONE_HEADER = 'SUBLIME_WORKER_DONE: '
+
+logger = logging.getLogger('TestManager.pytest-worker')
+
+
+class PytestWorker:
+    """
+    A long-lived pytest process, which runs one pytest session per request (see
+    pytest_plugins/sublime_test_worker.py). The process is restarted when one of the project
+    source files it has loaded is modified, or when it had to be stopped.
+    """
+
+    def __init__(self, command: List[str], cwd: Optional[str], env: Dict[str, str]):
+        self.command = command
+        self.cwd = cwd
+        self.env = env
+        self.mutex = threading.Lock()
+        self.proc: Optional[subprocess.Popen] = None
+        self.modules: Dict[str, int] = {}
+
+    def is_alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def is_stale(self):
+        for path, mtime in self.modules.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    logger.info(f'{path} was modified')
+                    return True
+            except OSError:
+                logger.info(f'{path} was removed')
+                return True
+
+        return False
+
+    def start(self):
+        environment = os.environ.copy()
+        environment.update(self.env)
+        environment['PYTHONUNBUFFERED'] = '1'
+
+        logger.info(f'starting pytest worker: {self.command}')
+        self.proc = subprocess.Popen(self.command,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT,
+                                     cwd=self.cwd,
+                                     env=environment,
+                                     **process.get_process_group_options())
+        self.modules = {}
+
+    def stop(self):
+        if self.proc is None:
+            return
+
+        logger.info('stopping pytest worker')
+        try:
+            # The worker exits on its own when its input is closed.
+            self.proc.stdin.close()
+            self.proc.wait(process.STOP_GRACE_PERIOD)
+        except (OSError, subprocess.TimeoutExpired):
+            process.kill_process_group(self.proc)
+            self.proc.wait()
+
+        self.proc.stdout.close()
+        self.proc = None
+
+    def run(self, args: List[str], stream_reader: Callable[[str], None], stop_token,
+            usage: Optional[ResourceUsage] = None, encoding='utf-8', fallback_encoding=[]) -> Optional[int]:
+        """
+        Run pytest with the given arguments in the worker, and feed its output to 'stream_reader'.
+        Returns the pytest exit code, or None if the run was stopped (the worker is then killed).
+        """
+        with self.mutex:
+            if self.is_alive() and self.is_stale():
+                self.stop()
+
+            if not self.is_alive():
+                self.stop()
+                self.start()
+
+            assert self.proc is not None
+            start = time.time()
+
+            self.proc.stdin.write((json.dumps({'args': args}) + '\n').encode(encoding))
+            self.proc.stdin.flush()
+
+            parser_stage = PipelineStage('parser[pytest-worker]', stream_reader)
+            result = {}
+
+            def read_stdout(proc):
+                for line in proc.stdout:
+                    line = process.decode(line, encoding, fallback_encoding)
+                    if line.startswith(PYTEST_WORKER_DONE_HEADER):
+                        result.update(json.loads(line[len(PYTEST_WORKER_DONE_HEADER):]))
+                        return
+
+                    parser_stage.put(line)
+
+            reader_thread = threading.Thread(target=read_stdout, args=(self.proc,), daemon=True)
+            reader_thread.start()
+
+            while reader_thread.is_alive() and not stop_token.wait(0.1):
+                pass
+
+            if reader_thread.is_alive():
+                process.stop_process_group(self.proc, reader_thread)
+                self.proc.wait()
+                self.proc = None
+            elif 'exit_code' not in result:
+                logger.warning('pytest worker exited unexpectedly')
+                self.stop()
+
+            parser_stage.close()
+
+            if usage is not None:
+                usage.wall_time += time.time() - start
+                usage.processes += 1
+
+            if 'modules' in result:
+                self.modules.update(result['modules'])
+
+            return result.get('exit_code', None)
+
+
+workers: Dict[str, PytestWorker] = {}
+workers_lock = threading.Lock()
+
+
+def get_worker(queue: str, command: List[str], cwd: Optional[str], env: Dict[str, str]) -> PytestWorker:
+    """
+    Return the worker for this work queue, creating a new one if the command, working directory,
+    or environment has changed since it was started.
+    """
+    with workers_lock:
+        worker = workers.get(queue, None)
+        if worker is not None and (worker.command, worker.cwd, worker.env) != (command, cwd, env):
+            with worker.mutex:
+                worker.stop()
+            worker = None
+
+        if worker is None:
+            worker = PytestWorker(command, cwd, env)
+            workers[queue] = worker
+
+        return worker
+
+
+def stop_workers():
+    """
+    Stop all the workers (e.g., when the plugin is unloaded).
+    """
+    with workers_lock:
+        for worker in workers.values():
+            with worker.mutex:
+                worker.stop()
+
+        workers.clear()
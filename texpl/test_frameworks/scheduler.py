@@ -0,0 +1,174 @@
+# coding: utf-8
+import heapq
+import logging
+import threading
+import time
+import traceback
+from functools import partial
+from queue import Queue, Empty
+from typing import Callable, Dict, List, Tuple
+
+from ..transport import Worker
+from .common import run_with_watchdog
+
+logger = logging.getLogger('TestManager.scheduler')
+
+# Estimated duration of a test that has never been run, if no other test of the suite has a
+# known duration either.
+DEFAULT_TEST_DURATION = 1.0  # seconds
+
+
+class Slot:
+    """
+    One process slot of a worker. Each slot runs one test process at a time, on its own work queue.
+    """
+
+    def __init__(self, worker: Worker, index: int, queue: str):
+        self.worker = worker
+        self.index = index
+        self.queue = queue
+
+
+class DurationEstimator:
+    """
+    Estimates how long tests will take from the duration of their last run. Tests with no
+    history are assumed to take the median duration of the tests that have one.
+    """
+
+    def __init__(self, durations: Dict[Tuple[str, str], float]):
+        self.durations = durations
+
+        known = sorted(durations.values())
+        self.default = known[len(known)//2] if len(known) > 0 else DEFAULT_TEST_DURATION
+
+    def get(self, executable: str, test_id: str) -> float:
+        return self.durations.get((executable, test_id), self.default)
+
+    def get_total(self, executable: str, test_ids: List[str]) -> float:
+        return sum(self.get(executable, t) for t in test_ids)
+
+
+def pack_into_shards(executable: str, test_ids: List[str], shards: int,
+                     estimator: DurationEstimator) -> List[List[str]]:
+    """
+    Split the tests into at most 'shards' groups of similar total duration, using
+    longest-processing-time-first bin packing. Tests keep their relative order within a shard.
+    """
+    shards = max(1, min(shards, len(test_ids)))
+    if shards == 1:
+        return [test_ids]
+
+    order = sorted(range(len(test_ids)), key=lambda i: estimator.get(executable, test_ids[i]), reverse=True)
+
+    bins: List[List[int]] = [[] for _ in range(shards)]
+    loads = [(0.0, b) for b in range(shards)]
+    for i in order:
+        load, b = heapq.heappop(loads)
+        bins[b].append(i)
+        heapq.heappush(loads, (load + estimator.get(executable, test_ids[i]), b))
+
+    return [[test_ids[i] for i in sorted(b)] for b in bins]
+
+
+def get_makespan(durations: List[float], slots: int) -> float:
+    """
+    Total duration of running jobs of the given durations, in order, each on the first free slot.
+    """
+    loads = [0.0] * max(1, slots)
+    for duration in durations:
+        heapq.heappush(loads, heapq.heappop(loads) + duration)
+
+    return max(loads)
+
+
+def get_slots(workers: List[Worker], queue: str) -> List[Slot]:
+    slots = [Slot(w, i, f'{queue}:{w.name}:{i}') for w in workers for i in range(w.slots)]
+    if len(slots) == 1:
+        # Single slot: keep using the framework's own work queue.
+        slots[0].queue = queue
+
+    return slots
+
+
+def run_budgeted(framework, executable: str, test_ids: List[str], run_tests: Callable, slot: Slot):
+    budget = framework.suite.process_budget
+    budget.acquire(framework.suite.run_priority)
+    try:
+        run_with_watchdog(framework, executable, test_ids, run_tests,
+                          queue=slot.queue, transport=slot.worker.transport)
+    finally:
+        budget.release()
+
+
+def run_jobs(framework, jobs: List[Tuple[str, List[str]]], run_tests: Callable, queue: str):
+    """
+    Run each (executable, test_ids) job with 'run_with_watchdog()', spreading the jobs over the
+    slots of the suite's workers. Jobs are started as soon as a slot is free: in the suite's
+    preferred run order if any, otherwise longest first.
+    Each process also takes a place in the suite's process budget, shared with the suites
+    running at the same time.
+    """
+    stop_event = framework.test_data.stop_tests_event
+    # Suites may run concurrently: each has its own work queues, even with the same framework.
+    queue = f'{queue}:{framework.suite.suite_id}'
+    slots = get_slots(framework.suite.workers, queue)
+    estimator = DurationEstimator(framework.suite.test_durations)
+
+    ranks = framework.suite.test_ranks
+    if len(ranks) > 0:
+        jobs = sorted(jobs, key=lambda job: min(ranks.get((job[0], t), len(ranks)) for t in job[1]))
+    elif len(slots) > 1:
+        jobs = sorted(jobs, key=lambda job: estimator.get_total(*job), reverse=True)
+
+    planned = get_makespan([estimator.get_total(*job) for job in jobs], len(slots))
+    logger.info(f'[{queue}] planned makespan: {planned:.2f}s for {len(jobs)} processes over {len(slots)} slots')
+    start = time.time()
+
+    if len(slots) == 1:
+        slot = slots[0]
+        for executable, test_ids in jobs:
+            if stop_event.is_set():
+                break
+
+            run_budgeted(framework, executable, test_ids, run_tests, slot)
+    else:
+        pending = Queue()
+        for job in jobs:
+            pending.put(job)
+
+        def run_slot(slot: Slot):
+            while not stop_event.is_set():
+                try:
+                    executable, test_ids = pending.get_nowait()
+                except Empty:
+                    return
+
+                logger.debug(f'[{slot.queue}] running {len(test_ids)} tests from {executable}')
+                try:
+                    run_budgeted(framework, executable, test_ids, run_tests, slot)
+                except Exception as e:
+                    logger.error("[%s] error when running tests: %s\n%s", slot.queue, e, traceback.format_exc())
+
+        threads = [threading.Thread(target=partial(run_slot, slot), name=f'TestManager.{slot.queue}')
+                   for slot in slots[:len(jobs)]]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+    logger.info(f'[{queue}] actual makespan: {time.time() - start:.2f}s (planned {planned:.2f}s)')
+
+
+def run_grouped_tests(framework, grouped_tests: Dict[str, List[str]], run_tests: Callable, queue: str):
+    """
+    Split the tests of each executable into the suite's number of shards, balanced by estimated
+    duration, and run them with 'run_jobs()'.
+    """
+    estimator = DurationEstimator(framework.suite.test_durations)
+    jobs = [(executable, shard) for executable, test_ids in grouped_tests.items()
+            for shard in pack_into_shards(executable, test_ids, framework.suite.shards, estimator)
+            if len(shard) > 0]
+
+    run_jobs(framework, jobs, run_tests, queue)
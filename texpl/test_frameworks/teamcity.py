@@ -1,60 +1,156 @@
 import logging
 import re
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
-from ..test_data import (TestData, StartedTest, FinishedTest, TestStatus, TestOutput)
+from ..test_data import (TestData, TestEventBuffer, RunningTests, TestStatus)
+from .. import process
 
 parser_logger = logging.getLogger('TestManagerParser.teamcity')
 
+SERVICE_MESSAGE_HEADER = '##teamcity['
+
+# Message name, and the attributes (or single unnamed value) as written.
+SERVICE_MESSAGE = re.compile(r"##teamcity\[([\w.-]+)(.*)\]\s*$")
+
+# One name='value' attribute, or an unnamed 'value'. Quotes in values are escaped with '|'.
+SERVICE_MESSAGE_ATTRIBUTE = re.compile(r"\s*(?:([\w.:-]+)\s*=\s*)?'((?:[^|']|\|.)*)'")
+
+SERVICE_MESSAGE_ESCAPE = re.compile(r"\|(0x[0-9a-fA-F]{4}|.)")
+SERVICE_MESSAGE_ESCAPES = {
+    "'": "'",
+    'n': '\n',
+    'r': '\r',
+    '[': '[',
+    ']': ']',
+    '|': '|',
+    'x': '\u0085',
+    'l': '\u2028',
+    'p': '\u2029',
+}
+
+
+def unescape(value: str) -> str:
+    def replace(match):
+        code = match.group(1)
+        if code.startswith('0x'):
+            return chr(int(code[2:], 16))
+        return SERVICE_MESSAGE_ESCAPES.get(code, code)
+
+    return SERVICE_MESSAGE_ESCAPE.sub(replace, value) if '|' in value else value
+
+
+def parse_service_message(line: str) -> Optional[Tuple[str, Dict[str, str]]]:
+    """
+    Parse a service message into its name and attributes (an unnamed value is stored under '').
+    Return None if the line is not a well-formed service message.
+    """
+    match = SERVICE_MESSAGE.match(line)
+    if match is None:
+        return None
+
+    name, body = match.groups()
+    attributes: Dict[str, str] = {}
+    position = 0
+    for attribute in SERVICE_MESSAGE_ATTRIBUTE.finditer(body):
+        if attribute.start() != position:
+            return None
+        attributes[attribute.group(1) or ''] = unescape(attribute.group(2))
+        position = attribute.end()
+
+    if len(body[position:].strip()) > 0:
+        return None
+
+    return name, attributes
+
+
+def get_duration(attributes: Dict[str, str]) -> Optional[float]:
+    # Reported in milliseconds.
+    try:
+        return float(attributes['duration'])/1000
+    except (KeyError, ValueError):
+        return None
+
 
 class OutputParser:
     def __init__(self, test_data: TestData, suite_id: str, executable: str):
-        self.test_data = test_data
+        self.test_data = TestEventBuffer(test_data)
         self.test_list = test_data.get_test_list()
         self.suite_id = suite_id
         self.executable = executable
-        self.current_test: Optional[List[str]] = None
-        self.current_status = TestStatus.PASSED
+        # Tests are tracked by flow (flowId) and name, so that several flows can run tests
+        # concurrently, including tests with the same name.
+        self.running = RunningTests(self.test_data)
 
-    def parse_test_id(self, line: str):
-        return re.search("name='([^']+)'", line).group(1)
-
-    def finish_current_test(self):
-        if self.current_test is not None:
-            self.test_data.notify_test_finished(FinishedTest(self.current_test, TestStatus.CRASHED))
-            self.current_test = None
+    def get_test_id(self, attributes: Dict[str, str]) -> Optional[str]:
+        return attributes.get('name', None)
 
     def close(self):
-        self.finish_current_test()
+        self.running.finish_all()
+        self.test_data.flush()
 
-    def feed(self, line: str):
-        parser_logger.debug(line.rstrip())
+    def feed(self, output: str):
+        # Output comes in chunks of whole lines; test events are sent in one batch per chunk.
+        for line in process.split_lines(output):
+            self.feed_line(line)
 
-        if self.current_test:
-            self.test_data.notify_test_output(TestOutput(self.current_test, line))
+        self.test_data.flush()
 
-        if not line.startswith('##teamcity['):
-            return
-
-        if line.startswith('##teamcity[testStarted'):
-            self.finish_current_test()
-            self.current_test = self.test_list.find_test_by_report_id(
-                self.suite_id, self.executable, self.parse_test_id(line))
-            self.current_status = TestStatus.PASSED
-            if self.current_test is None:
-                return
+    def feed_line(self, line: str):
+        parser_logger.debug(line.rstrip())
 
-            self.test_data.notify_test_started(StartedTest(self.current_test))
+        message = parse_service_message(line) if line.startswith(SERVICE_MESSAGE_HEADER) else None
+        if message is None:
+            self.running.output(None, line)
+            return
 
-        if line.startswith('##teamcity[testFinished'):
-            if self.current_test is None:
-                return
+        name, attributes = message
+        self.feed_message(name, attributes)
 
-            self.test_data.notify_test_finished(FinishedTest(self.current_test, self.current_status))
-            self.current_test = None
+    def feed_message(self, name: str, attributes: Dict[str, str]):
+        if name not in ['testStarted', 'testFinished', 'testFailed', 'testIgnored', 'testStdOut', 'testStdErr']:
+            return
 
-        if line.startswith('##teamcity[testIgnored'):
-            self.current_status = TestStatus.SKIPPED
+        test_id = self.get_test_id(attributes)
+        if test_id is None:
+            parser_logger.warning(f'no test name in {name} message')
+            return
 
-        if line.startswith('##teamcity[testFailed'):
-            self.current_status = TestStatus.FAILED
+        key = (attributes.get('flowId', ''), test_id)
+        if name == 'testStarted':
+            self.start(key, test_id)
+        elif name == 'testFinished':
+            self.running.finish(key, self.running.get_status(key, TestStatus.PASSED),
+                                duration=get_duration(attributes))
+        elif name in ['testStdOut', 'testStdErr']:
+            self.output(key, attributes, ['out'])
+        elif name == 'testIgnored':
+            # Ignored tests may be reported on their own, without being started.
+            was_running = self.running.get(key) is not None
+            if not was_running:
+                self.start(key, test_id)
+
+            self.output(key, attributes, ['message'])
+            self.running.update_status(key, TestStatus.SKIPPED)
+            if not was_running:
+                self.running.finish(key, TestStatus.SKIPPED)
+        elif name == 'testFailed':
+            self.output(key, attributes, ['message', 'details', 'expected', 'actual'])
+            self.running.update_status(key, TestStatus.FAILED)
+
+    def start(self, key: Tuple[str, str], test_id: str):
+        test = self.test_list.find_test_by_report_id(self.suite_id, self.executable, test_id)
+        if test is not None:
+            self.running.start(key, test)
+
+    def output(self, key: Tuple[str, str], attributes: Dict[str, str], keys: List[str]):
+        lines = []
+        for name in keys:
+            value = attributes.get(name, '')
+            if len(value) == 0:
+                continue
+            if name in ['expected', 'actual']:
+                value = f'{name}: {value}'
+            lines.append(value if value.endswith('\n') else value + '\n')
+
+        if len(lines) > 0:
+            self.running.output(key, ''.join(lines))
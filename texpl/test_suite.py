@@ -1,19 +1,46 @@
-from typing import Dict, List, Optional
+import os
+import json
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
 from .errors import FrameworkError
-from .test_data import TestData
+from .test_data import (TestData, DiscoveryScope, FinishedTest, CachedResult, TestStatus, test_name_to_path)
+from .transport import Worker, ProcessBudget, get_workers
+from . import fingerprint
+
+logger = logging.getLogger('TestManager.suite')
+
+# Cached results with these statuses are reused without running the test again.
+CACHEABLE_STATUSES = [TestStatus.PASSED, TestStatus.SKIPPED]
 
 
 class TestSuite:
     def __init__(self, suite_id: str, test_data: TestData, project_root_dir: str,
                  custom_prefix: Optional[str],
                  path_prefix_style: str,
-                 framework_name: str, framework_settings: Dict):
+                 framework_name: str, framework_settings: Dict,
+                 test_timeout: Optional[float] = None,
+                 process_timeout: Optional[float] = None,
+                 workers: Optional[List[Worker]] = None,
+                 shards: int = 1,
+                 result_cache: bool = False,
+                 result_cache_inputs: List[str] = []):
         self.test_data = test_data
         self.project_root_dir = project_root_dir
         self.suite_id = suite_id
         self.custom_prefix = custom_prefix
         self.path_prefix_style = path_prefix_style
+        self.test_timeout = test_timeout
+        self.process_timeout = process_timeout
+        self.workers = workers if workers is not None else get_workers(None)
+        self.shards = shards
+        self.result_cache = result_cache
+        self.result_cache_inputs = result_cache_inputs
+        self.test_ranks: Dict[Tuple[str, str], int] = {}
+        self.test_durations: Dict[Tuple[str, str], float] = {}
+        self.process_budget = ProcessBudget()
+        self.run_priority = 0
 
         from .test_framework import create_framework
         self.framework = create_framework(framework_name,
@@ -27,16 +54,129 @@ class TestSuite:
         if 'framework' not in settings:
             raise FrameworkError('Missing "framework" in suite definition.')
 
+        shards = settings.get('shards', 1)
+        if not isinstance(shards, int) or shards < 1:
+            raise FrameworkError(f'Invalid "shards" in suite definition: {shards}.')
+
         return TestSuite(suite_id=settings['id'],
                          test_data=test_data,
                          project_root_dir=project_root_dir,
                          custom_prefix=settings.get('custom_prefix', None),
                          path_prefix_style=settings.get('path_prefix_style', 'full'),
                          framework_name=settings['framework'],
-                         framework_settings=settings)
+                         framework_settings=settings,
+                         test_timeout=settings.get('test_timeout', None),
+                         process_timeout=settings.get('process_timeout', None),
+                         workers=get_workers(settings.get('workers', None)),
+                         shards=shards,
+                         result_cache=settings.get('result_cache', False),
+                         result_cache_inputs=settings.get('result_cache_inputs', []))
+
+    def discover(self, scope: Optional[DiscoveryScope] = None):
+        return self.framework.discover(scope)
+
+    def run(self, grouped_tests: Dict[str, List[str]], test_ranks: Dict[Tuple[str, str], int] = {},
+            test_durations: Dict[Tuple[str, str], float] = {},
+            process_budget: Optional[ProcessBudget] = None, run_priority: int = 0):
+        """
+        Run the tests. 'test_ranks' optionally gives the position of each (executable, run_id)
+        in the preferred run order; processes are started in that order when possible.
+        'test_durations' gives the duration of the last run of each (executable, run_id), if known;
+        it is used to balance the work between shards and slots. 'process_budget' is shared with
+        the suites running at the same time; when it is exhausted, the processes of the suites
+        with the lowest 'run_priority' start first.
+        """
+        self.test_ranks = test_ranks
+        self.test_durations = test_durations
+        self.process_budget = process_budget if process_budget is not None else ProcessBudget()
+        self.run_priority = run_priority
+
+        cache_keys = self.get_result_cache_keys(grouped_tests) if self.result_cache else {}
+        if len(cache_keys) > 0:
+            grouped_tests = self.reuse_cached_results(grouped_tests, cache_keys)
+
+        start = datetime.now()
+        if len(grouped_tests) > 0:
+            self.framework.run(grouped_tests)
+
+        if len(cache_keys) > 0:
+            self.save_cached_results(grouped_tests, cache_keys, start)
+
+    def get_result_cache_keys(self, grouped_tests: Dict[str, List[str]]) -> Dict[str, str]:
+        """
+        Key of each executable in the result cache, including the content of the declared input
+        files. Executables without a key are always run.
+        """
+        from .test_frameworks.common import discover_all_files
+
+        # Same walker and skipped directories as the executable discovery.
+        ignored = getattr(self.framework, 'executable_ignore', ['CMakeFiles'])
+
+        inputs = []
+        for pattern in self.result_cache_inputs:
+            for file in discover_all_files(pattern, cwd=self.project_root_dir, ignored=ignored):
+                path = os.path.join(self.project_root_dir, file)
+                inputs.append([os.path.relpath(path, self.project_root_dir), fingerprint.get_content_hash(path)])
+
+        inputs_key = json.dumps(inputs)
+
+        cache_keys = {}
+        for executable in grouped_tests:
+            key = self.framework.get_result_cache_key(executable)
+            if key is not None:
+                cache_keys[executable] = fingerprint.get_data_hash(key + inputs_key)
+
+        return cache_keys
+
+    def reuse_cached_results(self, grouped_tests: Dict[str, List[str]],
+                             cache_keys: Dict[str, str]) -> Dict[str, List[str]]:
+        """
+        Report the cached results that are still valid, and return the tests left to run.
+        """
+        paths = {(t.location.executable, t.run_id): test_name_to_path(t.full_name)
+                 for t in self.test_data.get_test_list().tests()
+                 if t.suite_id == self.suite_id and t.location is not None}
+        events = []
+        remaining = {}
+        for executable, test_ids in grouped_tests.items():
+            cached = self.test_data.get_cached_results(self.suite_id, executable) if executable in cache_keys else {}
+            to_run = []
+            for test_id in test_ids:
+                result = cached.get(test_id, None)
+                path = paths.get((executable, test_id), None)
+                if (result is not None and path is not None and result.cache_key == cache_keys[executable] and
+                        result.status in CACHEABLE_STATUSES):
+                    events.append(FinishedTest(path, result.status, cached=True))
+                else:
+                    to_run.append(test_id)
+
+            if len(to_run) > 0:
+                remaining[executable] = to_run
+
+        if len(events) > 0:
+            logger.info(f'{self.suite_id}: reusing {len(events)} cached results')
+            self.test_data.notify_test_events(events)
+
+        return remaining
+
+    def save_cached_results(self, grouped_tests: Dict[str, List[str]], cache_keys: Dict[str, str],
+                            start: datetime):
+        # Only the tests that were run since 'start' have a new result.
+        self.test_data.wait_for_updates()
+        test_list = self.test_data.get_test_list()
+
+        run_ids = {executable: set(test_ids) for executable, test_ids in grouped_tests.items()
+                   if executable in cache_keys}
+
+        results = []
+        for item in test_list.tests():
+            if item.suite_id != self.suite_id or item.location is None:
+                continue
 
-    def discover(self):
-        return self.framework.discover()
+            executable = item.location.executable
+            if (item.run_id in run_ids.get(executable, set()) and item.last_run is not None and
+                    item.last_run >= start and not item.cached):
+                results.append(CachedResult(suite_id=self.suite_id, executable=executable, run_id=item.run_id,
+                                            cache_key=cache_keys[executable], status=item.last_status))
 
-    def run(self, grouped_tests: Dict[str, List[str]]):
-        self.framework.run(grouped_tests)
+        self.test_data.save_cached_results(results)
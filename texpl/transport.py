@@ -0,0 +1,141 @@
+# coding: utf-8
+import heapq
+import shlex
+import logging
+import itertools
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from .errors import FrameworkError
+
+logger = logging.getLogger('TestManager.transport')
+
+LOCAL_WORKER_NAME = 'local'
+
+
+class Transport:
+    """
+    Executes commands on the local machine, as is.
+    """
+
+    def wrap(self, command: List[str], cwd: Optional[str], env: Dict[str, str]) -> Tuple[List[str], Optional[str], Dict[str, str]]:
+        """
+        Return the command, working directory, and environment variables to give to the local
+        process in order to run 'command' in 'cwd' with 'env' through this transport.
+        """
+        return command, cwd, env
+
+
+class CommandPrefixTransport(Transport):
+    """
+    Executes commands through a wrapper command, for example ["ssh", "host"] or
+    ["docker", "exec", "container", "sh", "-c"]. The wrapper receives a single extra argument:
+    a POSIX shell command line that changes directory, sets the environment, and runs the
+    command. The wrapper's output is streamed back as if the command ran locally.
+
+    Stopping a test only signals the local wrapper process. Whether the remote command is
+    stopped too depends on the wrapper: 'ssh -tt' hangs up the remote session when the client
+    exits, while plain 'ssh' or 'docker exec' leave the remote command running.
+    """
+
+    def __init__(self, prefix: List[str]):
+        self.prefix = prefix
+
+    def wrap(self, command: List[str], cwd: Optional[str], env: Dict[str, str]) -> Tuple[List[str], Optional[str], Dict[str, str]]:
+        remote_command = ''
+        if cwd:
+            remote_command += f'cd {shlex.quote(cwd)} && '
+
+        remote_command += 'exec '
+        if len(env) > 0:
+            remote_command += 'env ' + ' '.join(shlex.quote(f'{k}={v}') for k, v in env.items()) + ' '
+
+        remote_command += ' '.join(shlex.quote(c) for c in command)
+
+        return self.prefix + [remote_command], None, {}
+
+
+class LocalShellTransport(CommandPrefixTransport):
+    """
+    Stand-in for a remote host: executes commands through a local POSIX shell, with the same
+    command line a remote wrapper would receive. Used to try out a worker setup locally.
+    """
+
+    def __init__(self):
+        super().__init__(['sh', '-c'])
+
+
+class Worker:
+    """
+    A place where test processes can run, with the number of processes it can run at once.
+    """
+
+    def __init__(self, name: str, transport: Transport, slots: int = 1):
+        self.name = name
+        self.transport = transport
+        self.slots = slots
+
+    @staticmethod
+    def from_json(settings: Dict, index: int):
+        slots = settings.get('slots', 1)
+        if not isinstance(slots, int) or slots < 1:
+            raise FrameworkError(f'Invalid "slots" in worker definition: {slots}.')
+
+        command = settings.get('command', [])
+        if settings.get('local_shell', False):
+            if len(command) > 0:
+                raise FrameworkError('"command" and "local_shell" cannot be used together in worker definition.')
+            transport = LocalShellTransport()
+        elif len(command) > 0:
+            transport = CommandPrefixTransport(command)
+        else:
+            transport = Transport()
+
+        is_local = len(command) == 0 and not settings.get('local_shell', False)
+        name = settings.get('name', LOCAL_WORKER_NAME if is_local else f'worker{index}')
+        return Worker(name, transport, slots)
+
+
+class ProcessBudget:
+    """
+    Limits the number of test processes running at once across all the suites of a test run
+    (no limit if 'limit' is 0). Waiting processes are let through by priority (lowest first),
+    then in the order they asked.
+    """
+
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self.running = 0
+        self.waiting: List[Tuple[int, int]] = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def acquire(self, priority: int = 0):
+        if self.limit <= 0:
+            return
+
+        with self.condition:
+            ticket = (priority, next(self.counter))
+            heapq.heappush(self.waiting, ticket)
+            while self.running >= self.limit or self.waiting[0] != ticket:
+                self.condition.wait()
+
+            heapq.heappop(self.waiting)
+            self.running += 1
+            # The next in line may fit too.
+            self.condition.notify_all()
+
+    def release(self):
+        if self.limit <= 0:
+            return
+
+        with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+
+def get_workers(settings: Optional[List[Dict]]) -> List[Worker]:
+    if not settings:
+        return [Worker(LOCAL_WORKER_NAME, Transport())]
+
+    return [Worker.from_json(s, i) for i, s in enumerate(settings)]
@@ -0,0 +1,369 @@
+# coding: utf-8
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+import traceback
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Set
+
+import sublime
+from sublime_plugin import WindowCommand
+
+from .helpers import TestDataHelper
+from .discover import TestDiscoveryHelper
+from .run import TestRunHelper
+from .test_data import TestData, TestStatus, DiscoveryScope
+from .errors import FrameworkError
+
+logger = logging.getLogger('TestManager.watch')
+
+WATCH_RUN_ALL = 'all'
+WATCH_RUN_FAILED = 'failed'
+WATCH_RUN_NONE = 'none'
+
+# How often the watch thread wakes up to check for the end of the debounce delay, in seconds.
+WATCH_WAKE_INTERVAL = 0.2
+
+# inotify(7) constants.
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_EVENT_HEADER = struct.Struct('iIII')
+
+IN_WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+NO_INOTIFY_MESSAGE = 'inotify is not available ({}); falling back to polling'
+
+
+def is_ignored(path: str, ignored: List[str]):
+    """
+    Hidden files and directories (e.g., .git, or the default test data location), Python caches,
+    and the explicitly ignored directories are never watched.
+    """
+    if any(path == i or path.startswith(i + os.sep) for i in ignored):
+        return True
+
+    name = os.path.basename(path)
+    return name.startswith('.') or name == '__pycache__'
+
+
+class Watcher(ABC):
+    """
+    Reports the files created, modified, or deleted under a set of directories (recursively).
+    """
+
+    def __init__(self, ignored: List[str]):
+        self.ignored = [os.path.normpath(i) for i in ignored]
+        self.roots: Set[str] = set()
+
+    def add_paths(self, paths: List[str]):
+        for path in paths:
+            path = os.path.normpath(path)
+            if path not in self.roots and os.path.isdir(path):
+                self.roots.add(path)
+                self.add_root(path)
+
+    def add_root(self, path: str):
+        pass
+
+    @abstractmethod
+    def wait(self, timeout: float) -> Set[str]:
+        """
+        Wait for changes for at most 'timeout' seconds, and return the changed files.
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(Watcher):
+    """
+    Portable fallback: scan the watched directories periodically, and compare file sizes and
+    modification times.
+    """
+
+    def __init__(self, ignored: List[str], interval: float):
+        super().__init__(ignored)
+        self.interval = interval
+        self.files: Dict[str, tuple] = {}
+        self.last_scan = 0.0
+
+    def scan(self, root: str, files: Dict[str, tuple]):
+        for directory, dirs, names in os.walk(root):
+            dirs[:] = [d for d in dirs if not is_ignored(os.path.join(directory, d), self.ignored)]
+            for name in names:
+                path = os.path.join(directory, name)
+                if is_ignored(path, self.ignored):
+                    continue
+
+                try:
+                    stat = os.stat(path)
+                    files[path] = (stat.st_size, stat.st_mtime_ns, stat.st_mode)
+                except OSError:
+                    pass
+
+    def add_root(self, path: str):
+        self.scan(path, self.files)
+
+    def wait(self, timeout: float) -> Set[str]:
+        delay = self.last_scan + self.interval - time.time()
+        if delay > timeout:
+            time.sleep(timeout)
+            return set()
+
+        time.sleep(max(0.0, delay))
+        self.last_scan = time.time()
+
+        files: Dict[str, tuple] = {}
+        for root in self.roots:
+            self.scan(root, files)
+
+        changed = set(p for p in files.keys() | self.files.keys() if files.get(p) != self.files.get(p))
+        self.files = files
+        return changed
+
+
+class InotifyWatcher(Watcher):
+    """
+    Linux: get notified by the kernel of changes, without scanning. New directories are
+    watched as they are created.
+    """
+
+    def __init__(self, ignored: List[str]):
+        super().__init__(ignored)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+        self.directories: Dict[int, str] = {}
+
+    def add_directory(self, path: str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), IN_WATCH_MASK)
+        if wd < 0:
+            logger.warning(f'cannot watch {path}: {os.strerror(ctypes.get_errno())}')
+            return
+
+        self.directories[wd] = path
+
+    def add_root(self, path: str):
+        for directory, dirs, _ in os.walk(path):
+            dirs[:] = [d for d in dirs if not is_ignored(os.path.join(directory, d), self.ignored)]
+            self.add_directory(directory)
+
+    def wait(self, timeout: float) -> Set[str]:
+        changed: Set[str] = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return changed
+
+        try:
+            data = os.read(self.fd, 64*1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = IN_EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + IN_EVENT_HEADER.size:offset + IN_EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += IN_EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: assume everything changed.
+                logger.warning('inotify queue overflow')
+                changed.update(self.roots)
+                continue
+
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+
+            directory = self.directories.get(wd, None)
+            if directory is None:
+                continue
+
+            path = os.path.join(directory, os.fsdecode(name))
+            if is_ignored(path, self.ignored):
+                continue
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_root(path)
+                continue
+
+            changed.add(path)
+
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(ignored: List[str], poll_interval: float) -> Watcher:
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(ignored)
+        except (OSError, AttributeError) as e:
+            logger.warning(NO_INOTIFY_MESSAGE.format(e))
+
+    return PollingWatcher(ignored, poll_interval)
+
+
+class WatchSession(TestDataHelper, TestDiscoveryHelper, TestRunHelper):
+    """
+    Watch the test executables and sources of all the test suites. When they change, and once
+    no more changes come in for the debounce delay, discover the affected tests again and run
+    them in the background.
+    """
+
+    def __init__(self, window, data: TestData):
+        self.window = window
+        self.data = data
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.watcher: Optional[Watcher] = None
+
+    def start(self):
+        settings = self.get_settings()
+        self.debounce = settings.get('watch_debounce', 1.0)
+        self.watcher = create_watcher([self.data.location], settings.get('watch_poll_interval', 2.0))
+
+        self.thread = threading.Thread(target=self.watch, name='TestManager.watch', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Any discovery or test run already started by the session is allowed to finish.
+        self.stop_event.set()
+
+    def get_suites(self):
+        try:
+            return self.get_test_suites(self.data, self.get_project())
+        except FrameworkError as e:
+            logger.error(f'cannot load test suites: {e.message}')
+            return None
+
+    def update_watched_paths(self, suites):
+        assert self.watcher is not None
+        for suite in suites:
+            self.watcher.add_paths(suite.framework.get_watched_paths())
+
+    def watch(self):
+        assert self.watcher is not None
+        try:
+            suites = self.get_suites()
+            if suites is None:
+                return
+
+            self.update_watched_paths(suites)
+            logger.info(f'watching {len(self.watcher.roots)} directories')
+
+            pending: Set[str] = set()
+            last_change = 0.0
+            while not self.stop_event.is_set():
+                changed = self.watcher.wait(WATCH_WAKE_INTERVAL)
+                if len(changed) > 0:
+                    pending.update(changed)
+                    last_change = time.time()
+                    continue
+
+                if len(pending) == 0 or time.time() - last_change < self.debounce:
+                    continue
+
+                # Leave the tests alone until the current run or discovery is over.
+                if self.data.is_running_tests() or self.data.is_discovering_tests():
+                    continue
+
+                try:
+                    self.on_changes(sorted(pending))
+                except Exception as e:
+                    logger.error("error in watch mode: %s\n%s", e, traceback.format_exc())
+
+                pending = set()
+        finally:
+            self.watcher.close()
+            if sessions.get(self.data.location, None) is self:
+                del sessions[self.data.location]
+            logger.info('watch mode stopped')
+
+    def on_changes(self, changed_files: List[str]):
+        logger.debug(f'changed files: {changed_files}')
+
+        # Suites are loaded again, in case their settings changed.
+        suites = self.get_suites()
+        if suites is None:
+            return
+
+        self.update_watched_paths(suites)
+
+        scopes: List[DiscoveryScope] = []
+        for suite in suites:
+            scope = suite.framework.get_changed_scope(changed_files)
+            if scope is not None:
+                scopes.append(scope)
+
+        if len(scopes) == 0:
+            return
+
+        logger.info('tests changed in: ' + ', '.join(s.describe() for s in scopes))
+
+        if not self.discover_tests(self.data, suites, scopes=scopes, interactive=False):
+            return
+
+        watch_run = self.get_settings().get('watch_run', WATCH_RUN_ALL)
+        if watch_run == WATCH_RUN_NONE:
+            return
+
+        test_list = self.data.get_test_list()
+        tests = [t.full_name for t in test_list.tests() if any(s.contains(t) for s in scopes) and
+                 (watch_run != WATCH_RUN_FAILED or t.last_status in [TestStatus.FAILED, TestStatus.CRASHED])]
+
+        if len(tests) > 0:
+            self.run_tests(self.data, test_list, suites, tests)
+
+
+sessions: Dict[str, WatchSession] = {}
+
+
+class TestManagerStartWatchCommand(WindowCommand, TestDataHelper):
+
+    def run(self):
+        data = self.get_test_data()
+        if not data:
+            return
+
+        if not self.get_project():
+            return
+
+        if data.location in sessions:
+            sublime.status_message('TestManager: watch mode is already on')
+            return
+
+        session = WatchSession(self.window, data)
+        sessions[data.location] = session
+        session.start()
+        sublime.status_message('TestManager: watch mode on')
+
+
+class TestManagerStopWatchCommand(WindowCommand, TestDataHelper):
+
+    def run(self):
+        data = self.get_test_data(create=False)
+        if not data or data.location not in sessions:
+            sublime.status_message('TestManager: watch mode is not on')
+            return
+
+        sessions.pop(data.location).stop()
+        sublime.status_message('TestManager: watch mode off')
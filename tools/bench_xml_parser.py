@@ -0,0 +1,203 @@
+# coding: utf-8
+"""
+Benchmark of the streaming XML parser used for Catch2 and doctest output
+('common.XmlStreamParser', expat fed by chunks), against the xml.sax handler it replaced, fed
+line by line. Both parse the same synthetic Catch2 report, and must produce the same element
+events. Run outside of Sublime Text, from the root of the package:
+
+    python tools/bench_xml_parser.py [--tests N] [--expressions N] [--repeat N]
+"""
+import os
+import sys
+import time
+import types
+import logging
+import argparse
+import xml.sax
+from typing import List
+
+# Load the plugin modules without the Sublime Text API, and without registering the commands
+# (texpl/__init__.py).
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for name, path in [('texpl', 'texpl'), ('texpl.test_frameworks', os.path.join('texpl', 'test_frameworks'))]:
+    package = types.ModuleType(name)
+    package.__path__ = [os.path.join(ROOT, path)]
+    sys.modules[name] = package
+
+sys.modules.setdefault('sublime', types.ModuleType('sublime'))
+
+from texpl.test_frameworks.common import XmlParser, XmlStreamParser  # noqa: E402
+from texpl.test_frameworks.catch2 import captured_elements  # noqa: E402
+
+xml_parser_logger = logging.getLogger('TestManagerParser.xml-base')
+
+
+class SaxXmlStreamHandler(xml.sax.handler.ContentHandler):
+    """
+    The previous parser (xml.sax content handler), kept as the baseline.
+    """
+
+    def __init__(self, parser: XmlParser, captured_elements: List[str] = []):
+        self.parser = parser
+        self.captured_elements = captured_elements
+
+        self.current_element: List[str] = []
+        self.content = {}
+
+    def clean_xml_content(self, content, tag):
+        # Remove first and last entry; will be line jump and indentation whitespace, ignored.
+        if not tag in content:
+            return ''
+
+        returned_content = content[tag]
+        del content[tag]
+
+        if len(returned_content) <= 2:
+            return ''
+
+        return ''.join(returned_content[1:-1])
+
+    def startElement(self, name, attrs):
+        if len(self.current_element) > 0 and self.current_element[-1] not in self.captured_elements:
+            content = self.clean_xml_content(self.content, self.current_element[-1])
+            self.parser.output(content)
+
+        attrs_str = ', '.join(['"{}": "{}"'.format(k, v) for k, v in attrs.items()])
+        xml_parser_logger.debug('startElement(' + name + ', ' + attrs_str + ')')
+        self.current_element.append(name)
+
+        self.parser.startElement(name, attrs)
+
+    def endElement(self, name):
+        if name not in self.captured_elements:
+            content = self.clean_xml_content(self.content, name)
+            self.parser.output(content)
+
+        xml_parser_logger.debug('endElement(' + name + ')')
+        self.current_element.pop()
+
+        self.parser.endElement(name, self.clean_xml_content(self.content, name))
+
+    def characters(self, content):
+        xml_parser_logger.debug('characters(' + content + ')')
+        if len(self.current_element) > 0:
+            self.content.setdefault(self.current_element[-1], []).append(content)
+
+            if self.current_element[-1] not in self.captured_elements:
+                content = self.content[self.current_element[-1]]
+                if len(content) > 1 and len(content[-1].strip()) > 0:
+                    output_content = ''.join(content[1:])
+                    del content[1:]
+                    self.parser.output(output_content)
+
+
+class Recorder(XmlParser):
+    def __init__(self):
+        self.events = []
+        self.output_text = []
+
+    def startElement(self, name, attrs):
+        self.events.append(('start', name, dict(attrs)))
+
+    def endElement(self, name, content):
+        self.events.append(('end', name, content))
+
+    def output(self, content):
+        self.output_text.append(content)
+
+
+def make_report(tests: int, expressions: int) -> str:
+    """
+    A Catch2 XML report ('-r xml -s'), with successful expressions and some output.
+    """
+    report = ['<?xml version="1.0" encoding="UTF-8"?>\n<Catch2TestRun name="bench">\n']
+    for i in range(tests):
+        report.append(f'  <TestCase name="test {i}" filename="test.cpp" line="{i}">\n')
+        if i % 3 == 0:
+            report.append(f'printed by test {i}: a &lt; b\nmore output\n')
+        for j in range(expressions):
+            success = 'false' if j == 3 else 'true'
+            report.append(f'    <Expression success="{success}" type="CHECK" filename="test.cpp" line="{j}">\n'
+                          f'      <Original>\n        x == {j} &amp;&amp; y\n      </Original>\n'
+                          f'      <Expanded>\n        {j} == {j}\n      </Expanded>\n    </Expression>\n')
+        report.append(f'    <OverallResult success="true" skips="0">\n'
+                      f'      <StdOut>\nhello from test {i}\n      </StdOut>\n    </OverallResult>\n  </TestCase>\n')
+    report.append('</Catch2TestRun>\n')
+    return ''.join(report)
+
+
+def split_chunks(text: str, size: int) -> List[str]:
+    """
+    Chunks of whole lines of at most 'size' characters, as given by 'process.read_chunks()'.
+    """
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = text.rfind('\n', start, start + size) + 1
+        if end <= start:
+            end = text.find('\n', start) + 1 or len(text)
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
+
+def parse_sax(lines: List[str]) -> Recorder:
+    recorder = Recorder()
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(SaxXmlStreamHandler(recorder, captured_elements))
+    for line in lines:
+        parser.feed(line)
+    parser.close()
+    return recorder
+
+
+def parse_expat(chunks: List[str]) -> Recorder:
+    recorder = Recorder()
+    parser = XmlStreamParser(recorder, captured_elements)
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+    return recorder
+
+
+def measure(function, data, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(data)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tests', type=int, default=2000, help='number of test cases in the report')
+    parser.add_argument('--expressions', type=int, default=20, help='number of expressions per test case')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs; the best time is reported')
+    args = parser.parse_args()
+
+    report = make_report(args.tests, args.expressions)
+    lines = report.splitlines(keepends=True)
+    chunks = split_chunks(report, 64*1024)
+    print(f'report: {args.tests} test cases, {len(lines)} lines, {len(report)/1e6:.1f} MB')
+
+    sax = parse_sax(lines)
+    expat = parse_expat(chunks)
+    if sax.events != expat.events:
+        print('error: the parsers produced different element events')
+        sys.exit(1)
+
+    cases = [('xml.sax, by line', parse_sax, lines),
+             ('expat, by line', parse_expat, lines),
+             ('expat, by 64 KiB chunk', parse_expat, chunks)]
+
+    baseline = None
+    for name, function, data in cases:
+        duration = measure(function, data, args.repeat)
+        baseline = baseline or duration
+        print(f'{name:<24} {duration:.3f}s  (x{baseline/duration:.1f})')
+
+
+if __name__ == '__main__':
+    main()